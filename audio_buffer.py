@@ -0,0 +1,124 @@
+import os
+import struct
+import numpy as np
+
+class EpisodeAudio:
+    """
+    The decoded audio of an episode, memory-mapped from its 16-bit mono WAV file.
+
+    The samples are mapped rather than read, so transcription and diarization share one copy of the
+    audio in the page cache however many times and from however many threads they read it, and
+    nothing is decoded twice.
+
+    Args:
+        wav_file (str): The path to a 16-bit mono PCM WAV file, as written by convert_audio_to_wav.
+    """
+
+    def __init__(self, wav_file):
+        self.path = wav_file
+        offset, size, self.sample_rate = _find_pcm_data(wav_file)
+        frames = size // 2
+        if frames:
+            self.samples = np.memmap(wav_file, dtype='<i2', mode='r', offset=offset, shape=(frames,))
+        else:
+            self.samples = np.empty(0, dtype='<i2')
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __str__(self):
+        return self.path
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.sample_rate
+
+    def pcm_blocks(self, block_frames, start_time=0.0, end_time=None):
+        """
+        Yields the raw 16-bit little-endian PCM of the audio in blocks of block_frames frames, as fed to Vosk.
+
+        Args:
+            block_frames (int): The number of frames in each block (the last block may be shorter).
+            start_time (float, optional): Position in seconds to start from. Defaults to 0.
+            end_time (float, optional): Position in seconds to stop at. Defaults to the end of the audio.
+        """
+        start = min(int(start_time * self.sample_rate), len(self.samples))
+        end = len(self.samples) if end_time is None else min(int(end_time * self.sample_rate), len(self.samples))
+        for i in range(start, end, block_frames):
+            # Only the block is copied, Vosk takes bytes rather than buffers
+            yield self.samples[i:min(i + block_frames, end)].tobytes()
+
+    def waveform(self):
+        """
+        Returns the audio as a (1, frames) float32 array scaled to [-1, 1), the layout pyannote expects.
+        This is the one full copy of the audio, since the models work on floats.
+        """
+        return _to_waveform(self.samples)
+
+def diarization_input(audio, regions=None):
+    """
+    Returns the {"waveform", "sample_rate", "uri"} dict pyannote takes in place of a file path, built from an
+    EpisodeAudio. It's a plain dict since pyannote's Audio.validate_file sets keys on the file it's given.
+    The waveform is a numpy array, which the models of models.ModelRegistry turn into a torch tensor.
+
+    With regions (a speech_activity.SpeechRegions), the waveform holds only the speech regions back to back,
+    and the times the pipeline reports have to be mapped back with regions.to_original.
+    """
+    samples = audio.samples if regions is None else regions.extract(audio.samples)
+    return {
+        'waveform': _to_waveform(samples),
+        'sample_rate': audio.sample_rate,
+        'uri': os.path.splitext(os.path.basename(audio.path))[0],
+    }
+
+def _to_waveform(samples):
+    waveform = samples.astype(np.float32)
+    waveform /= 32768.0
+    return waveform.reshape(1, -1)
+
+def open_audio(source):
+    """
+    Returns source as an EpisodeAudio, mapping it if it's a path.
+    """
+    return source if isinstance(source, EpisodeAudio) else EpisodeAudio(source)
+
+def is_pcm_wav(path, sample_rate):
+    """
+    Checks whether a file already is a 16-bit mono PCM WAV file at sample_rate, as written by convert_audio_to_wav.
+    """
+    try:
+        return _find_pcm_data(path)[2] == sample_rate
+    except (OSError, ValueError, struct.error):
+        return False
+
+def _find_pcm_data(wav_file):
+    """
+    Walks the RIFF chunks of a WAV file.
+
+    Returns:
+        tuple: The offset and size in bytes of the sample data, and the sample rate.
+    """
+    file_size = os.path.getsize(wav_file)
+    with open(wav_file, 'rb') as f:
+        riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            raise ValueError(f'{wav_file} is not a WAV file')
+        sample_rate = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f'{wav_file} has no data chunk')
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                audio_format, channels, sample_rate, _, _, bits = struct.unpack('<HHIIHH', f.read(16))
+                if audio_format != 1 or channels != 1 or bits != 16:
+                    raise ValueError(f'{wav_file} is not 16-bit mono PCM')
+                f.seek(chunk_size - 16 + chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                if sample_rate is None:
+                    raise ValueError(f'{wav_file} has no fmt chunk before its data')
+                offset = f.tell()
+                # Streamed WAVs may leave the size unset, the data then runs to the end of the file
+                return offset, min(chunk_size, file_size - offset), sample_rate
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
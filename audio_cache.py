@@ -0,0 +1,391 @@
+import fcntl
+import hashlib
+import itertools
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from collections import Counter, deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from audio_buffer import is_pcm_wav
+from config import FRAME_RATE
+from download import download_file, download_checksum, hash_file, convert_audio_to_wav
+
+# How long an entry handed out by fetch is protected from eviction, in seconds. The process holding it renews
+# the lease every third of that until it releases the entry, so the lease only runs out for runs that die
+# while holding one, however long their episodes take.
+IN_USE_LEASE = 15 * 60
+
+# Columns added to the entries table after it was first created, with their definitions
+_ADDED_COLUMNS = {
+    'holders': 'INTEGER NOT NULL DEFAULT 0',
+}
+
+CachedAudio = namedtuple('CachedAudio', ['sha256', 'audio_file', 'wav_file'])
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def _url_name(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+class AudioCache:
+    """
+    A content-addressed store of downloaded episode audio and the WAV files converted from it, shared
+    by every podcast.
+
+    Downloads are named after the SHA-256 of their content, so enclosures with the same file name in
+    different feeds never collide, and the same audio served under several URLs is stored once. An
+    index database in the cache directory maps URLs to contents and records the size, last use and
+    state of every entry.
+
+    Once the cache holds more than budget bytes, WAV files and the audio of processed episodes are
+    evicted, least recently used first. The audio of episodes that haven't been processed yet and
+    entries in use are kept. An evicted WAV is converted again when it's needed, and evicted audio is
+    downloaded again.
+
+    Args:
+        root (str): The cache directory.
+        budget (int, optional): Disk budget in bytes. Nothing is evicted if not given.
+    """
+
+    def __init__(self, root, budget=None):
+        self.root = root
+        self.budget = budget
+        self._local = threading.local()
+        # The number of fetches of every entry this process holds, whose leases it renews
+        self._held = Counter()
+        self._held_lock = threading.Lock()
+        self._renewer = None
+        os.makedirs(os.path.join(root, 'partial'), exist_ok=True)
+        with self._conn as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS urls (
+                    url TEXT PRIMARY KEY,
+                    sha256 TEXT NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    sha256 TEXT PRIMARY KEY,
+                    extension TEXT NOT NULL,
+                    audio_size INTEGER NOT NULL DEFAULT 0,
+                    wav_size INTEGER NOT NULL DEFAULT 0,
+                    last_used REAL NOT NULL,
+                    processed INTEGER NOT NULL DEFAULT 0,
+                    in_use_until REAL NOT NULL DEFAULT 0,
+                    holders INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(entries)")}
+            for column, definition in _ADDED_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE entries ADD COLUMN {column} {definition}")
+
+    @property
+    def _conn(self):
+        # Pipeline stages and pool workers share the cache, so every thread gets its own connection
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(os.path.join(self.root, 'index.db'))
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout = 60000")
+        return conn
+
+    def _path(self, sha256, extension):
+        return os.path.join(self.root, sha256[:2], sha256 + extension)
+
+    def _entry(self, sha256, extension):
+        audio_file = self._path(sha256, extension)
+        if extension == '.wav' and is_pcm_wav(audio_file, FRAME_RATE):
+            # The download needs no conversion, so it's its own WAV file
+            return CachedAudio(sha256, audio_file, audio_file)
+        return CachedAudio(sha256, audio_file, self._path(sha256, '.pcm.wav'))
+
+    @contextmanager
+    def _url_lock(self, url):
+        # Held by one thread or process at a time while it downloads or imports url. flock locks are
+        # released by the OS when their holder dies, so a crashed download never blocks the next one.
+        with open(os.path.join(self.root, 'partial', _url_name(url) + '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _download(self, url):
+        """
+        Downloads url into the cache and returns the SHA-256 of its content.
+
+        Partial downloads are named after the URL, so an interrupted download resumes where it stopped.
+        Other threads and processes wanting the same URL wait for the download and then find it cached,
+        rather than writing to the same partial download.
+        """
+        extension = os.path.splitext(urlparse(url).path)[1] or '.audio'
+        with self._url_lock(url):
+            sha256 = self._cached(url)
+            if sha256 is None:
+                partial_file = download_file(url, os.path.join(self.root, 'partial'), filename=_url_name(url) + extension)
+                sha256 = self._store(url, partial_file, extension, *download_checksum(partial_file))
+                os.remove(partial_file + '.sha256')
+        return sha256
+
+    def _store(self, url, audio_file, extension, sha256, size, processed=False):
+        """
+        Moves the complete audio of url into the cache and returns the SHA-256 of its content.
+        """
+        with self._conn as conn:
+            row = conn.execute("SELECT extension FROM entries WHERE sha256 = ?", (sha256,)).fetchone()
+            if row is not None and os.path.exists(self._path(sha256, row[0])):
+                # Another URL already brought the same audio
+                os.remove(audio_file)
+            else:
+                if row is not None:
+                    extension = row[0]
+                os.makedirs(os.path.dirname(self._path(sha256, extension)), exist_ok=True)
+                os.replace(audio_file, self._path(sha256, extension))
+                conn.execute("""
+                    INSERT INTO entries (sha256, extension, audio_size, last_used, processed) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (sha256) DO UPDATE SET audio_size = excluded.audio_size
+                """, (sha256, extension, size, time.time(), int(processed)))
+            conn.execute("INSERT OR REPLACE INTO urls (url, sha256) VALUES (?, ?)", (url, sha256))
+        return sha256
+
+    def import_file(self, url, path, processed=False, complete=True):
+        """
+        Moves audio downloaded from url outside of the cache into it, unless url is already cached.
+
+        Args:
+            url (str): The URL the audio was downloaded from.
+            path (str): The download. It's moved, or removed if the cache already has its content.
+            processed (bool, optional): Whether its episode has been processed, so it may be evicted. Defaults to False.
+            complete (bool, optional): Whether the download is known to be complete. If not, it's moved in as the
+                partial download of url, to be verified and resumed by the next fetch. Defaults to True.
+        """
+        extension = os.path.splitext(urlparse(url).path)[1] or '.audio'
+        partial_file = os.path.join(self.root, 'partial', _url_name(url) + extension)
+        with self._url_lock(url):
+            if self._cached(url) is not None or (not complete and os.path.exists(partial_file)):
+                os.remove(path)
+            elif complete:
+                # Moved next to the partial downloads first, since path may be on another file system
+                shutil.move(path, partial_file + '.import')
+                self._store(url, partial_file + '.import', extension, hash_file(partial_file + '.import').hexdigest(),
+                            os.path.getsize(partial_file + '.import'), processed)
+            else:
+                shutil.move(path, partial_file)
+        if os.path.exists(path + '.sha256'):
+            os.remove(path + '.sha256')
+
+    def _cached(self, url):
+        """
+        Returns the SHA-256 of the cached audio of url, or None if it isn't cached.
+        """
+        row = self._conn.execute("""
+            SELECT e.sha256, e.extension FROM urls u JOIN entries e ON e.sha256 = u.sha256 WHERE u.url = ?
+        """, (url,)).fetchone()
+        return row[0] if row is not None and os.path.exists(self._path(*row)) else None
+
+    def fetch(self, url):
+        """
+        Returns the cached audio of url, downloading it if it isn't cached. The entry is protected from
+        eviction until every fetch of it, in any thread or process, has been released.
+
+        Returns:
+            CachedAudio: The SHA-256 of the audio, the path to it and the path its WAV file is (or will be) at.
+        """
+        sha256 = self._cached(url)
+        if sha256 is not None:
+            print(f'{url} is cached, skipping download')
+        else:
+            sha256 = self._download(url)
+        now = time.time()
+        with self._conn as conn:
+            # Holders of an expired lease are assumed to have died without releasing it
+            conn.execute("""
+                UPDATE entries SET last_used = ?, in_use_until = ?, holders = CASE WHEN in_use_until < ? THEN 1 ELSE holders + 1 END
+                WHERE sha256 = ?
+            """, (now, now + IN_USE_LEASE, now, sha256))
+            extension = conn.execute("SELECT extension FROM entries WHERE sha256 = ?", (sha256,)).fetchone()[0]
+        self._hold(sha256)
+        # Make room for what's being fetched, now that it's protected
+        self.trim()
+        return self._entry(sha256, extension)
+
+    def prefetch(self, pairs, max_concurrent=2):
+        """
+        Downloads audio into the cache ahead of its use, max_concurrent transfers at a time over the shared
+        pooled session.
+
+        pairs is read lazily, and nothing is downloaded more than max_concurrent pairs ahead of the one
+        last yielded, so the audio waiting to be processed stays bounded however long pairs is.
+
+        Args:
+            pairs (iterable): The (URL, value) pairs to download the URLs of, in the order they're used.
+            max_concurrent (int, optional): Maximum number of transfers running at once. Defaults to 2.
+
+        Yields:
+            The value of every pair in order, once its URL is cached. A failed download is yielded too, fetch
+            then tries it again and raises the error.
+        """
+        def download(url):
+            if self._cached(url) is None:
+                try:
+                    self._download(url)
+                except Exception as error:
+                    print(f'Prefetching {url} failed: {error!r}')
+
+        pairs = iter(pairs)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+            while True:
+                for url, value in itertools.islice(pairs, max_concurrent + 1 - len(pending)):
+                    pending.append((executor.submit(download, url), value))
+                if not pending:
+                    break
+                future, value = pending.popleft()
+                future.result()
+                yield value
+
+    def _hold(self, sha256):
+        with self._held_lock:
+            self._held[sha256] += 1
+            if self._renewer is None:
+                self._renewer = threading.Thread(target=self._renew_leases, name='AudioCacheLeases', daemon=True)
+                self._renewer.start()
+
+    def _renew_leases(self):
+        # Runs for the rest of the process on its own thread, with its own connection
+        while True:
+            time.sleep(IN_USE_LEASE / 3)
+            with self._held_lock:
+                held = list(self._held)
+            if held:
+                with self._conn as conn:
+                    conn.executemany("UPDATE entries SET in_use_until = MAX(in_use_until, ?) WHERE sha256 = ? AND holders > 0",
+                                     [(time.time() + IN_USE_LEASE, sha256) for sha256 in held])
+
+    def convert(self, entry):
+        """
+        Converts the audio of an entry handed out by fetch to its WAV file, unless the WAV file is still cached.
+        """
+        if not os.path.exists(entry.wav_file):
+            convert_audio_to_wav(entry.audio_file, entry.wav_file)
+            self.add_wav(entry)
+
+    def add_wav(self, entry):
+        """
+        Records the size of an entry's WAV file, for WAV files written outside of convert.
+        """
+        with self._conn as conn:
+            conn.execute("UPDATE entries SET wav_size = ? WHERE sha256 = ?", (os.path.getsize(entry.wav_file), entry.sha256))
+
+    def remove_wav(self, entry):
+        """
+        Removes the WAV file of an entry handed out by fetch, unless another fetch of the entry, in any thread
+        or process, still holds it and may be reading the WAV file. It's then left for eviction.
+        """
+        if entry.wav_file == entry.audio_file:
+            return
+        conn = self._conn
+        # Taking the write lock keeps another fetch from starting to hold the entry until the file is gone
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT holders FROM entries WHERE sha256 = ?", (entry.sha256,)).fetchone()[0] > 1:
+                print(f'{entry.wav_file} is still in use, leaving it in the cache')
+            else:
+                if os.path.exists(entry.wav_file):
+                    os.remove(entry.wav_file)
+                conn.execute("UPDATE entries SET wav_size = 0 WHERE sha256 = ?", (entry.sha256,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def release(self, entry, processed=False):
+        """
+        Releases an entry handed out by fetch, and marks its audio as no longer needed once its episode
+        has been processed. The entry stays protected while other episodes sharing it still hold it.
+        """
+        with self._conn as conn:
+            # The right-hand sides all see the row as it was before the update
+            conn.execute("""
+                UPDATE entries SET
+                    in_use_until = CASE WHEN holders > 1 THEN in_use_until ELSE 0 END,
+                    holders = MAX(holders - 1, 0),
+                    processed = MAX(processed, ?)
+                WHERE sha256 = ?
+            """, (int(processed), entry.sha256))
+        with self._held_lock:
+            self._held[entry.sha256] -= 1
+            if self._held[entry.sha256] <= 0:
+                del self._held[entry.sha256]
+        self.trim()
+
+    def usage(self):
+        """
+        Returns the bytes taken up by the cached audio and WAV files.
+        """
+        return self._conn.execute("SELECT COALESCE(SUM(audio_size + wav_size), 0) FROM entries").fetchone()[0]
+
+    def trim(self):
+        """
+        Evicts WAV files and the audio of processed episodes, least recently used first, until the
+        cache fits its budget.
+
+        Returns:
+            int: The number of bytes freed.
+        """
+        if self.budget is None:
+            return 0
+        conn = self._conn
+        evicted = []
+        # Take the write lock up front, so two processes don't both decide to evict
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            excess = conn.execute("SELECT COALESCE(SUM(audio_size + wav_size), 0) FROM entries").fetchone()[0] - self.budget
+            if excess > 0:
+                # A WAV file goes before the audio it was converted from, which is slower to get back
+                candidates = conn.execute("""
+                    SELECT sha256, extension, kind, size FROM (
+                        SELECT sha256, '.pcm.wav' AS extension, 0 AS kind, wav_size AS size, last_used, in_use_until FROM entries WHERE wav_size > 0
+                        UNION ALL
+                        SELECT sha256, extension, 1 AS kind, audio_size AS size, last_used, in_use_until FROM entries WHERE audio_size > 0 AND processed
+                    )
+                    WHERE in_use_until < ?
+                    ORDER BY last_used, kind
+                """, (time.time(),)).fetchall()
+                for sha256, extension, kind, size in candidates:
+                    if excess <= 0:
+                        break
+                    column = 'wav_size' if kind == 0 else 'audio_size'
+                    conn.execute(f"UPDATE entries SET {column} = 0 WHERE sha256 = ?", (sha256,))
+                    evicted.append(self._path(sha256, extension))
+                    excess -= size
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        freed = 0
+        for path in evicted:
+            try:
+                freed += os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if evicted:
+            print(f'Evicted {len(evicted)} file(s) from the audio cache, freeing {freed / 2**20:.0f}MB')
+        return freed
+
+def open_audio_cache(root, budget=None):
+    """
+    Returns the AudioCache for a directory, shared by every thread of the process.
+    """
+    key = os.path.abspath(root)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = AudioCache(root, budget)
+        cache.budget = budget
+    return cache
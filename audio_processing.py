@@ -1,119 +1,226 @@
 import json
 import os
-import wave
-from pyannote.audio import Pipeline
-from config import PYANNOTE_ACCESS_TOKEN, FRAME_RATE
-from download import download_file, convert_audio_to_wav
-from google_drive import upload_to_google
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import metrics
+from audio_buffer import diarization_input, open_audio
+from audio_cache import open_audio_cache
+from config import FRAME_RATE
+from download import convert_audio_to_wav, is_download_complete, stream_audio_pcm
+from feed_sync import episode_key, mark_stage_complete, clear_stages, TRANSCRIPTION_STAGE, DIARIZATION_STAGE, TRANSCRIPT_STAGE
+from fingerprints import FINGERPRINTED_STAGES, discard_stage_outputs, stage_fingerprints, update_stage_fingerprints
+from punctuation import punctuate_turns
+from search import index_episode
+from speaker_assignment import assign_words_to_speakers
+from speech_activity import episode_speech_regions
+from word_store import load_episode_words, pack_episode_words
+
+# Number of frames fed to the recognizer at a time when streaming audio (half a second)
+PCM_BLOCK_FRAMES = FRAME_RATE // 2
+
+def run_diarization_pipeline(audio, models, num_speakers=None, min_speakers=None, max_speakers=None, speech_regions=None):
+    """
+    Applies the diarization pipeline to the audio of an episode, or to its speech regions only.
+
+    Returns:
+        list: The (speaker ID, start time, end time) of every speaker segment.
+    """
+    if speech_regions is not None and not speech_regions.duration:
+        # Nobody speaks, and pyannote rejects an empty waveform
+        print('No speech was detected, skipping diarization')
+        return []
+    # Apply the pre-trained pipeline, loading it on first use. It gets the samples rather than
+    # the path, so the audio isn't decoded again.
+    diarization = models.diarization_pipeline(
+        diarization_input(audio, speech_regions),
+        num_speakers=num_speakers,
+        min_speakers=min_speakers,
+        max_speakers=max_speakers
+    )
+    segments = [(speaker_id, segment.start, segment.end) for segment, _, speaker_id in diarization.itertracks(yield_label=True)]
+    if speech_regions is None:
+        return segments
+    # The pipeline only heard the speech back to back, so put every segment back where it was in the episode
+    return [(speaker_id, start, end) for speaker_id, speech_start, speech_end in segments
+            for start, end in speech_regions.to_original(speech_start, speech_end)]
+
+def diarize_audio(audio, models, num_speakers=None, min_speakers=None, max_speakers=None, speech_regions=None, window=None, window_workers=1):
+    """
+    Runs the diarization pipeline on the in-memory audio of an episode. It doesn't touch the database,
+    so it can run on another thread while the same audio is being transcribed.
 
-def perform_speaker_diarization(conn, episode_id, input_file, num_speakers=None, min_speakers=None, max_speakers=None):
+    Args:
+        audio (str or audio_buffer.EpisodeAudio): The episode's WAV file or its mapped audio.
+        models (models.ModelRegistry): The registry providing the diarization pipeline.
+        speech_regions (speech_activity.SpeechRegions, optional): If given, only the speech regions are diarized.
+        window (float, optional): If given, the audio is diarized in overlapping windows of this many seconds,
+            see windowed_diarization.diarize_in_windows. min_speakers is not used then.
+        window_workers (int, optional): Number of windows diarized at once. Defaults to 1.
+
+    Returns:
+        list: The (speaker ID, start time, end time) of every speaker segment.
+    """
+    with metrics.stage(metrics.DIARIZATION_STAGE):
+        if window:
+            from windowed_diarization import diarize_in_windows
+            return diarize_in_windows(open_audio(audio), models, window, num_speakers, max_speakers, speech_regions, window_workers)
+        return run_diarization_pipeline(open_audio(audio), models, num_speakers, min_speakers, max_speakers, speech_regions)
+
+def perform_speaker_diarization(conn, episode_id, input_file, models, num_speakers=None, min_speakers=None, max_speakers=None, segments=None,
+                                speech_regions=None, window=None, window_workers=1):
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM diarization_results WHERE episode_id = ?", (episode_id,))
     if cursor.fetchone():
         print(f'Diarization results for episode {episode_id} already exist, skipping diarization')
         return
 
-    # Instantiate pre-trained speaker diarization pipeline
-    diarization_pipeline = Pipeline.from_pretrained(
-        "pyannote/speaker-diarization",
-        use_auth_token=PYANNOTE_ACCESS_TOKEN,
-    )
+    # The segments may already have been computed alongside transcription
+    if segments is None:
+        segments = diarize_audio(input_file, models, num_speakers, min_speakers, max_speakers, speech_regions, window, window_workers)
+    rows = [(episode_id, speaker_id, start_time, end_time, end_time - start_time) for speaker_id, start_time, end_time in segments]
 
-    # Apply the pre-trained pipeline
-    diarization = diarization_pipeline(
-        input_file,
-        num_speakers=num_speakers,
-        min_speakers=min_speakers,
-        max_speakers=max_speakers
-    )
-
-    for segment, _, speaker_id in diarization.itertracks(yield_label=True):
-        start_time = segment.start
-        end_time = segment.end
-        duration = end_time - start_time
-
-        cursor.execute("""
+    with conn:
+        cursor.executemany("""
             INSERT INTO diarization_results (episode_id, speaker_id, start_time, end_time, duration)
             VALUES (?, ?, ?, ?, ?)
-        """, (episode_id, speaker_id, start_time, end_time, duration))
+        """, rows)
+        mark_stage_complete(conn, episode_id, DIARIZATION_STAGE)
 
-    conn.commit()
+def has_diarization_results(conn, episode_id):
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM diarization_results WHERE episode_id = ? LIMIT 1", (episode_id,))
+    return cursor.fetchone() is not None
+
+def _words_from_result(result, time_offset):
+    return [{
+        'word': word['word'],
+        'start': word['start'] + time_offset,
+        'end': word['end'] + time_offset,
+        'speaker_id': -1  # Initialize with a placeholder value
+    } for word in json.loads(result).get("result", [])]
+
+def _save_transcription_checkpoint(cursor, episode_id, words, audio_offset, completed):
+    cursor.executemany("""
+        INSERT INTO transcription_results (episode_id, word, start_time, end_time, speaker_id)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(episode_id, word['word'], word['start'], word['end'], word['speaker_id']) for word in words])
+    cursor.execute("""
+        INSERT OR REPLACE INTO transcription_progress (episode_id, audio_offset, completed)
+        VALUES (?, ?, ?)
+    """, (episode_id, audio_offset, int(completed)))
 
-def transcribe_audio(conn, episode_id, input_file, recognizer, chunk_size=3600):
+def transcribe_audio(conn, episode_id, input_file, models, pcm_source=None, checkpoint_interval=60, parallel_workers=1, speech_regions=None):
     """
     Transcribes the given audio file using Vosk and saves the transcription to the database.
 
+    The audio is fed to the recognizer in small blocks and the words of each finalized utterance are
+    collected as they are produced, so memory use doesn't grow with the length of the episode. Every
+    checkpoint_interval seconds of audio, the words so far are committed together with the audio offset
+    they cover, and an interrupted transcription resumes from the last checkpoint instead of starting over.
+
     Args:
         conn (sqlite3.Connection): The SQLite database connection.
         episode_id (int): The ID of the episode in the database.
-        input_file (str): The path to the input audio file.
-        recognizer (vosk.KaldiRecognizer): The Vosk recognizer object.
-        chunk_size (int, optional): The size of the audio chunks to transcribe in seconds. Defaults to 3600.
+        input_file (str or audio_buffer.EpisodeAudio): The path to the input audio file, or its mapped audio.
+        models (models.ModelRegistry): The registry providing the Vosk recognizer.
+        pcm_source (callable, optional): Called with a start time in seconds, returns the raw 16-bit mono PCM blocks
+            to transcribe from that point on. Defaults to reading input_file as a memory-mapped WAV file.
+        checkpoint_interval (int, optional): Seconds of audio between checkpoints. Defaults to 60.
+        parallel_workers (int, optional): If more than 1, the WAV file is split at quiet points and the segments are
+            transcribed on this many processes at once. Checkpoints are not written in this mode. Defaults to 1.
+        speech_regions (speech_activity.SpeechRegions, optional): If given, only the speech regions of the WAV file are
+            transcribed, each from a fresh recognizer state, and the words keep their times in the episode.
 
     Returns:
         list: The list of transcribed words with their timings and speaker ID placeholders.
     """
     print(f'Checking for existing transcription for episode ID {episode_id}')
+    packed_words = load_episode_words(conn, episode_id)
+    if packed_words is not None:
+        print(f'Transcription for episode ID {episode_id} already exists in the database, skipping transcription')
+        return packed_words
+
     cursor = conn.cursor()
+    cursor.execute("SELECT audio_offset, completed FROM transcription_progress WHERE episode_id = ?", (episode_id,))
+    progress = cursor.fetchone()
+
     cursor.execute("""
         SELECT word, start_time, end_time, speaker_id
         FROM transcription_results
         WHERE episode_id = ?
         ORDER BY start_time
     """, (episode_id,))
-    existing_transcription = cursor.fetchall()
+    transcription = [dict(zip(["word", "start", "end", "speaker_id"], row)) for row in cursor.fetchall()]
 
-    if existing_transcription:
+    # Transcriptions stored before progress was tracked have results but no progress row
+    if transcription and (progress is None or progress[1]):
         print(f'Transcription for episode ID {episode_id} already exists in the database, skipping transcription')
-        return [dict(zip(["word", "start", "end", "speaker_id"], row)) for row in existing_transcription]
-
-    with wave.open(input_file, "rb") as wf:
-        total_frames = wf.getnframes()
-        frame_position = 0
-        transcription = []
+        return transcription
+
+    with metrics.stage(metrics.ASR_STAGE):
+        resume_offset = progress[0] if progress else 0.0
+        if resume_offset:
+            print(f'Resuming transcription for episode ID {episode_id} at {resume_offset:.1f}s')
+
+        if parallel_workers > 1 and pcm_source is None:
+            from parallel_asr import transcribe_wav_parallel
+            audio = open_audio(input_file)
+            new_words = transcribe_wav_parallel(audio, parallel_workers, resume_offset, speech_regions)
+            _save_transcription_checkpoint(cursor, episode_id, new_words, audio.duration, completed=True)
+            mark_stage_complete(conn, episode_id, TRANSCRIPTION_STAGE)
+            conn.commit()
+            pack_episode_words(conn, episode_id)
+            return transcription + new_words
+
+        if pcm_source is None:
+            audio = open_audio(input_file)
+            pcm_range = lambda start_time, end_time: audio.pcm_blocks(PCM_BLOCK_FRAMES, start_time, end_time)
+        else:
+            audio = None
+            pcm_range = lambda start_time, end_time: pcm_source(start_time)
+        ranges = [(resume_offset, None)] if speech_regions is None or audio is None else speech_regions.after(resume_offset)
 
-        while frame_position < total_frames:
-            # Read one minute of audio at a time
-            num_frames = min(FRAME_RATE * chunk_size, total_frames - frame_position)
-            data = wf.readframes(num_frames)
-            frame_position += num_frames
+        recognizer = models.recognizer
+        pending_words = []
+        audio_offset = last_checkpoint = resume_offset
 
-            # Reset the recognizer for each one-minute segment
+        for range_start, range_end in ranges:
             recognizer.Reset()
+            frames_fed = 0
+            for data in pcm_range(range_start, range_end):
+                frames_fed += len(data) // 2
+                if recognizer.AcceptWaveform(data):
+                    # Vosk timestamps are relative to the last reset, which is where this range started
+                    pending_words.extend(_words_from_result(recognizer.Result(), range_start))
+                    audio_offset = range_start + frames_fed / FRAME_RATE
+                    if audio_offset - last_checkpoint >= checkpoint_interval:
+                        _save_transcription_checkpoint(cursor, episode_id, pending_words, audio_offset, completed=False)
+                        conn.commit()
+                        transcription.extend(pending_words)
+                        pending_words = []
+                        last_checkpoint = audio_offset
+            pending_words.extend(_words_from_result(recognizer.FinalResult(), range_start))
+            audio_offset = range_start + frames_fed / FRAME_RATE
+
+        # The skipped audio after the last speech region counts as transcribed too
+        audio_offset = audio.duration if audio is not None else audio_offset
+        _save_transcription_checkpoint(cursor, episode_id, pending_words, audio_offset, completed=True)
+        mark_stage_complete(conn, episode_id, TRANSCRIPTION_STAGE)
+        conn.commit()
+        transcription.extend(pending_words)
 
-            # Accept the waveform data
-            recognizer.AcceptWaveform(data)
-
-            # Get the result
-            result_dict = json.loads(recognizer.Result())
-
-            # Extract the words and their timings
-            words = result_dict.get("result", [])
-            for word in words:
-                word_info = {
-                    'word': word['word'],
-                    'start': word['start'],
-                    'end': word['end'],
-                    'speaker_id': -1  # Initialize with a placeholder value
-                }
-                transcription.append(word_info)
-
-                cursor.execute("""
-                    INSERT INTO transcription_results (episode_id, word, start_time, end_time, speaker_id)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (episode_id, word_info['word'], word_info['start'], word_info['end'], word_info['speaker_id']))
-
-    conn.commit()
-    # print(f'transcription:', transcription)
-    return transcription
+        # The rows were only needed for checkpointing, finished transcriptions are kept packed
+        pack_episode_words(conn, episode_id)
+        return transcription
 
 def transcribe_wav_file(wav_path, recognizer, punctuator):
     """
-    Transcribe a single .wav file without speaker diarization and print the result.
+    Transcribe a single .wav file without speaker diarization, print the result and return it.
 
     :param wav_path: str, path to the .wav file to be transcribed.
     :param recognizer: KaldiRecognizer, an instance of the Vosk KaldiRecognizer class.
     :param punctuator: Punctuator, an instance of the Punctuator class for punctuating the transcribed text.
+    :return: str, the punctuated transcript.
     """
     with open(wav_path, 'rb') as f:
         recognizer.AcceptWaveform(f.read())
@@ -122,77 +229,17 @@ def transcribe_wav_file(wav_path, recognizer, punctuator):
     text = results_dict['text']
     punctuated_text = punctuator.punctuate(text)
     print(punctuated_text)
+    return punctuated_text
 
-def format_transcript(punctuator, raw_transcript):
-    """
-    Formats a raw transcript by adding punctuation using the Punctuator model.
-
-    Args:
-        punctuator (punctuator.Punctuator): The Punctuator object.
-        raw_transcript (str): The raw transcript without punctuation.
-
-    Returns:
-        str: The formatted transcript with punctuation.
-    """
-    if not raw_transcript.strip():  # Add this line to check if the input is empty
-        return ""  # Return an empty string if the input is empty
-
-    formatted_transcript = punctuator.punctuate(raw_transcript)
-    return formatted_transcript
-
-def assign_words_to_speakers(conn, episode_id, words):
-    """
-    Assigns words to speakers based on the speaker diarization information.
-
-    Args:
-        conn (sqlite3.Connection): The SQLite database connection.
-        episode_id (int): The ID of the episode in the database.
-        words (list): The list of words and their timings from the transcription.
+def write_transcripts(conn, episode_id, speaker_word_list, models, episode_title, episode_date):
+    turn_texts = [' '.join([word['word'] for word in speaker_entry["words"]]) for speaker_entry in speaker_word_list]
+    formatted_turns = punctuate_turns(conn, models, turn_texts)
 
-    Returns:
-        list: A list of dictionaries containing speaker IDs and their associated words.
-    """
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT speaker_id, start_time, end_time
-        FROM diarization_results
-        WHERE episode_id = ?
-        ORDER BY start_time
-    """, (episode_id,))
-    speaker_segments = cursor.fetchall()
-
-    speaker_word_list = []
-
-    for word in words:
-        word_start_time = float(word['start'])
-        assigned = False
-        for segment in speaker_segments:
-            speaker_id, start_time, end_time = segment
-            if start_time <= word_start_time < end_time:
-                if not speaker_word_list or speaker_word_list[-1]["speaker_id"] != speaker_id:
-                    speaker_word_list.append({"speaker_id": speaker_id, "words": []})
-                speaker_word_list[-1]["words"].append(word)
-                assigned = True
-                break
-
-        if not assigned:
-            if not speaker_word_list:
-                # Assign the unassigned word(s) at the beginning of the transcript to the first speaker
-                speaker_word_list.append({"speaker_id": speaker_segments[0][0], "words": [word]})
-            else:
-                # Assign the unassigned word to the last speaker segment
-                speaker_word_list[-1]["words"].append(word)
-
-    return speaker_word_list
-
-def write_transcripts(conn, episode_id, speaker_word_list, punctuator, episode_title, episode_date):
     transcript_parts = []
 
-    for speaker_entry in speaker_word_list:
+    for speaker_entry, formatted_transcript in zip(speaker_word_list, formatted_turns):
         speaker_id = speaker_entry["speaker_id"]
         words = speaker_entry["words"]
-        transcript = ' '.join([word['word'] for word in words])
-        formatted_transcript = format_transcript(punctuator, transcript)
 
         start_time = words[0]['start']
         start_time_str = f"{int(start_time // 60)}:{int(start_time % 60):02d}"
@@ -202,75 +249,310 @@ def write_transcripts(conn, episode_id, speaker_word_list, punctuator, episode_t
 
     cursor = conn.cursor()
     cursor.execute("UPDATE transcripts SET transcript = ? WHERE id = ?", (transcript_text, episode_id))
+    mark_stage_complete(conn, episode_id, TRANSCRIPT_STAGE)
+    index_episode(conn, episode_id, speaker_word_list)
     conn.commit()
 
-def process_episode(item, downloads_dir, conn, recognizer, punctuator, num_speakers=None, min_speakers=None, max_speakers=None, upload_to_google_drive=False, overwrite=False):
+def fetch_episode_audio(item, downloads_dir, convert=True, cache_budget=None):
     """
-    Process a single podcast episode from the RSS feed by downloading the audio, transcribing it, and performing speaker diarization.
+    Gets the audio of an episode from the audio cache, downloading it if needed, and converts it to a WAV
+    file for transcription unless the WAV file is still cached.
 
     Args:
         item (bs4.element.Tag): A BeautifulSoup object representing an <item> tag in the RSS feed.
-        downloads_dir (str): Directory where downloaded audio files will be saved.
+        downloads_dir (str): The audio cache directory, see audio_cache.AudioCache.
+        convert (bool, optional): Whether to convert the audio to a WAV file now. Defaults to True.
+        cache_budget (int, optional): Disk budget of the audio cache in bytes. Defaults to no limit.
+
+    Returns:
+        audio_cache.CachedAudio: The cached audio and the path to its (possibly not yet created) WAV file. It's
+            protected from eviction until released with release_episode_audio.
+    """
+    cache = open_audio_cache(downloads_dir, cache_budget)
+    mp3_url = item.find('enclosure')['url']
+    print(f'Downloading {mp3_url} to {downloads_dir}')
+    with metrics.stage(metrics.DOWNLOAD_STAGE):
+        audio = cache.fetch(mp3_url)
+
+    if convert and not os.path.exists(audio.wav_file):
+        print(f'Converting {audio.audio_file} to {audio.wav_file}')
+        with metrics.stage(metrics.CONVERT_STAGE):
+            cache.convert(audio)
+    return audio
+
+def prefetch_episode_audio(items, downloads_dir, max_concurrent=2, cache_budget=None):
+    """
+    Downloads the audio of episodes into the audio cache ahead of processing them, max_concurrent at a
+    time, see audio_cache.AudioCache.prefetch.
+
+    Yields:
+        bs4.element.Tag: Every item in order, once its audio is cached.
+    """
+    return open_audio_cache(downloads_dir, cache_budget).prefetch(((item.find('enclosure')['url'], item) for item in items), max_concurrent)
+
+def import_legacy_downloads(podcast_dir, items, pending_items, downloads_dir, cache_budget=None):
+    """
+    Moves the audio that earlier versions downloaded to <podcast_dir>/downloads into the audio cache.
+
+    The audio of episodes that don't need work anymore is imported as processed. The audio of pending
+    episodes that wasn't verified when it was downloaded is moved in as a partial download, which
+    the next fetch verifies against the server and resumes if it was cut short. WAV files are left
+    in place, since the cache converts again from the imported audio.
+
+    Args:
+        podcast_dir (str): The podcast's directory.
+        items (list): Every <item> tag in the feed.
+        pending_items (list): The items that still need work, see feed_sync.plan_feed_sync.
+        downloads_dir (str): The audio cache directory, see audio_cache.AudioCache.
+        cache_budget (int, optional): Disk budget of the audio cache in bytes. Defaults to no limit.
+    """
+    legacy_dir = os.path.join(podcast_dir, 'downloads')
+    if not os.path.isdir(legacy_dir):
+        return
+
+    cache = open_audio_cache(downloads_dir, cache_budget)
+    pending = {id(item) for item in pending_items}
+    imported = 0
+    for item in items:
+        enclosure = item.find('enclosure')
+        if enclosure is None:
+            continue
+        path = os.path.join(legacy_dir, os.path.basename(urlparse(enclosure['url']).path))
+        if not os.path.isfile(path):
+            continue
+        processed = id(item) not in pending
+        cache.import_file(enclosure['url'], path, processed, complete=processed or is_download_complete(path))
+        imported += 1
+
+    if imported:
+        print(f'Moved {imported} download(s) from {legacy_dir} to the audio cache in {downloads_dir}, '
+              f'the files left in {legacy_dir} can be deleted')
+
+def release_episode_audio(audio, downloads_dir, processed=False, cache_budget=None):
+    """
+    Releases the cached audio of an episode for eviction, see audio_cache.AudioCache.release.
+    """
+    open_audio_cache(downloads_dir, cache_budget).release(audio, processed)
+
+def register_episode(conn, item, audio_sha256=None, overwrite=False):
+    """
+    Looks up the episode in the transcripts table, inserting it if it's new.
+
+    Episodes are looked up by their guid (or enclosure URL), falling back to their title and date for
+    episodes stored before episodes were keyed by guid.
+
+    Args:
         conn (sqlite3.Connection): The SQLite database connection.
-        recognizer (vosk.KaldiRecognizer): The Vosk recognizer object.
-        punctuator (punctuator.Punctuator): The Punctuator object.
-        num_speakers (int, optional): Number of speakers in the audio (if known).
-        min_speakers (int, optional): Minimum number of speakers in the audio.
-        max_speakers (int, optional): Maximum number of speakers in the audio.
-        upload_to_google_drive (bool, optional): Whether or not to upload the transcript to google.
+        item (bs4.element.Tag): A BeautifulSoup object representing an <item> tag in the RSS feed.
+        audio_sha256 (str, optional): The SHA-256 of the episode's audio, its key in the audio cache.
+        overwrite (bool, optional): Whether to clear the existing transcription and diarization results.
+
+    Returns:
+        int: The ID of the episode in the database.
     """
     episode_date = item.find('pubDate').text.strip()
     episode_title = item.find('title').text.strip()
     enclosure = item.find('enclosure')
+    key = episode_key(item)
 
-    mp3_url = enclosure['url']
-    print(f'Downloading {mp3_url} to {downloads_dir}')
-    mp3_file = download_file(mp3_url, downloads_dir)
-    wav_file = os.path.splitext(mp3_file)[0] + '.wav'
-
-    print(f'Converting {mp3_file} to {wav_file}')
-    convert_audio_to_wav(mp3_file, wav_file)
-
-    if enclosure and enclosure['type'].startswith('audio/mpeg'):
-        episode_exists_query = "SELECT id, transcript FROM transcripts WHERE episode_title = ? AND episode_date = ?"
-        cursor = conn.cursor()
-        cursor.execute(episode_exists_query, (episode_title, episode_date))
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, transcript FROM transcripts WHERE episode_guid = ?", (key,))
+    episode_exists = cursor.fetchone()
+    if not episode_exists:
+        cursor.execute("SELECT id, transcript FROM transcripts WHERE episode_title = ? AND episode_date = ?", (episode_title, episode_date))
         episode_exists = cursor.fetchone()
+        if episode_exists:
+            cursor.execute("UPDATE transcripts SET episode_guid = ?, enclosure_url = ? WHERE id = ?", (key, enclosure['url'], episode_exists[0]))
+            conn.commit()
 
     if episode_exists:
         episode_id, existing_transcript = episode_exists
+        if audio_sha256:
+            cursor.execute("UPDATE transcripts SET audio_sha256 = ? WHERE id = ?", (audio_sha256, episode_id))
+            conn.commit()
         if existing_transcript and existing_transcript.strip() and not overwrite:
             print(f"Transcript for '{episode_title}' already exists in the database, skipping transcription")
         elif overwrite:
             print(f"Overwriting transcript for '{episode_title}'")
-            cursor.execute("DELETE FROM transcription_results WHERE episode_id = ?", (episode_id,))
-            cursor.execute("DELETE FROM diarization_results WHERE episode_id = ?", (episode_id,))
+            discard_stage_outputs(conn, episode_id, FINGERPRINTED_STAGES)
+            cursor.execute("DELETE FROM stage_fingerprints WHERE episode_id = ?", (episode_id,))
+            clear_stages(conn, episode_id)
+            conn.commit()
         else:
             print(f"Updating empty transcript for '{episode_title}'")
     else:
         print(f"Inserting {episode_title} into the database")
-        cursor.execute("INSERT INTO transcripts (episode_title, episode_date, episode_wav_filename) VALUES (?, ?, ?)", (episode_title, episode_date, os.path.basename(wav_file)))
+        # The WAV file in the cache is named after the audio's hash, the episode keeps the name the feed gives it
+        wav_filename = os.path.splitext(urlparse(enclosure['url']).path.split('/')[-1])[0] + '.wav'
+        cursor.execute("""
+            INSERT INTO transcripts (episode_title, episode_date, episode_wav_filename, episode_guid, enclosure_url, audio_sha256)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (episode_title, episode_date, wav_filename, key, enclosure['url'], audio_sha256))
         conn.commit()
         episode_id = cursor.lastrowid
 
-    print(f'Transcribing {wav_file}')
-    words = transcribe_audio(conn, episode_id, wav_file, recognizer)
+    return episode_id
+
+def _diarize_in_background(audio, models, num_speakers=None, min_speakers=None, max_speakers=None, speech_regions=None, window=None, window_workers=1):
+    """
+    Starts diarize_audio on another thread, measured as a stage of the episode collected on this thread.
+
+    Returns:
+        concurrent.futures.Future: The future speaker segments.
+    """
+    collector = metrics.current_collector()
+
+    def run():
+        with metrics.collecting(collector):
+            return diarize_audio(audio, models, num_speakers, min_speakers, max_speakers, speech_regions, window, window_workers)
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(run)
+    executor.shutdown(wait=False)
+    return future
+
+def diarize_and_write_transcript(conn, item, episode_id, wav_file, words, models, num_speakers=None, min_speakers=None, max_speakers=None, segments=None,
+                                 speech_regions=None, window=None, window_workers=1):
+    """
+    Performs speaker diarization on a transcribed episode, assigns the words to speakers and writes the punctuated transcript.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite database connection.
+        item (bs4.element.Tag): A BeautifulSoup object representing an <item> tag in the RSS feed.
+        episode_id (int): The ID of the episode in the database.
+        wav_file (str or audio_buffer.EpisodeAudio): The path to the episode's WAV file, or its mapped audio.
+        words (list): The list of words and their timings from the transcription.
+        models (models.ModelRegistry): The registry holding the models shared across episodes.
+        num_speakers (int, optional): Number of speakers in the audio (if known).
+        min_speakers (int, optional): Minimum number of speakers in the audio.
+        max_speakers (int, optional): Maximum number of speakers in the audio.
+        segments (list, optional): The speaker segments from diarize_audio, if the episode was already diarized.
+        speech_regions (speech_activity.SpeechRegions, optional): If given, only the speech regions are diarized.
+        window (float, optional): If given, the audio is diarized in overlapping windows of this many seconds.
+        window_workers (int, optional): Number of windows diarized at once. Defaults to 1.
+    """
+    episode_date = item.find('pubDate').text.strip()
+    episode_title = item.find('title').text.strip()
 
     print(f'Performing speaker diarization on {wav_file}')
     perform_speaker_diarization(
         conn,
         episode_id,
         wav_file,
+        models,
         num_speakers=num_speakers,
         min_speakers=min_speakers,
-        max_speakers=max_speakers
+        max_speakers=max_speakers,
+        segments=segments,
+        speech_regions=speech_regions,
+        window=window,
+        window_workers=window_workers
     )
 
     print(f'Assigning words to speakers')
-    speaker_word_dict = assign_words_to_speakers(conn, episode_id, words)
+    with metrics.stage(metrics.SPEAKER_ASSIGNMENT_STAGE):
+        speaker_word_dict = assign_words_to_speakers(conn, episode_id, words)
 
     print(f'Writing transcripts for {episode_title} to the database')
-    write_transcripts(conn, episode_id, speaker_word_dict, punctuator, episode_title, episode_date)
+    write_transcripts(conn, episode_id, speaker_word_dict, models, episode_title, episode_date)
+
+def process_episode(item, downloads_dir, conn, models, num_speakers=None, min_speakers=None, max_speakers=None, upload_to_google_drive=False, overwrite=False, stream_audio=False, parallel_asr=1, metrics_file=None,
+                    concurrent_diarization=False, speech_detection=None, cache_budget=None, diarization_window=None, window_workers=1,
+                    on_overwritten=None):
+    """
+    Process a single podcast episode from the RSS feed by downloading the audio, transcribing it, and performing speaker diarization.
 
-    if upload_to_google_drive:
-        upload_to_google(conn, episode_id, episode_title, overwrite)
+    The results of earlier runs are reused, except for the stages whose audio, model version or parameters
+    changed since, and the stages downstream of them, see fingerprints.py.
+
+    Args:
+        item (bs4.element.Tag): A BeautifulSoup object representing an <item> tag in the RSS feed.
+        downloads_dir (str): The audio cache directory, see audio_cache.AudioCache.
+        conn (sqlite3.Connection): The SQLite database connection.
+        models (models.ModelRegistry): The registry holding the models shared across episodes.
+        num_speakers (int, optional): Number of speakers in the audio (if known).
+        min_speakers (int, optional): Minimum number of speakers in the audio.
+        max_speakers (int, optional): Maximum number of speakers in the audio.
+        upload_to_google_drive (bool, optional): Whether or not to upload the transcript to google.
+        stream_audio (bool, optional): Whether to stream the decoded audio straight into the recognizer instead of
+            transcribing from a WAV file. The WAV file is then only written if diarization needs it and removed afterwards.
+        parallel_asr (int, optional): Number of processes to transcribe the WAV file on, see transcribe_audio.
+        metrics_file (str, optional): File to write the stage metrics of the episode to, besides the stage_metrics
+            table, see metrics.EpisodeMetrics.flush.
+        concurrent_diarization (bool, optional): Whether to diarize on another thread while transcribing, both reading the
+            same memory-mapped audio. Not used with stream_audio.
+        speech_detection (str, optional): One of speech_activity.DETECTION_METHODS to find the speech in the episode
+            first, so silence and music are neither transcribed nor diarized. Not used with stream_audio.
+        cache_budget (int, optional): Disk budget of the audio cache in bytes, see audio_cache.AudioCache.
+        diarization_window (float, optional): If given, episodes are diarized in overlapping windows of this many seconds,
+            so the memory used by diarization doesn't grow with the length of the episode, see windowed_diarization.py.
+        window_workers (int, optional): Number of diarization windows processed at once. Defaults to 1.
+        on_overwritten (callable, optional): Called once the earlier results of the episode have been discarded with
+            overwrite, so a caller that may run the episode again can resume it instead of discarding them again.
+    """
+    episode_metrics = metrics.EpisodeMetrics()
+    episode_id = wav_file = cached = None
+    processed = False
+    try:
+        with metrics.collecting(episode_metrics):
+            cached = fetch_episode_audio(item, downloads_dir, convert=not stream_audio, cache_budget=cache_budget)
+            mp3_file, wav_file = cached.audio_file, cached.wav_file
+            episode_id = register_episode(conn, item, cached.sha256, overwrite)
+            if overwrite and on_overwritten is not None:
+                on_overwritten()
+            # Only the stages whose inputs changed since the last run are computed again
+            fingerprints = stage_fingerprints(cached.sha256, models, speech_detection, num_speakers, min_speakers, max_speakers, diarization_window)
+            update_stage_fingerprints(conn, episode_id, fingerprints)
+            segments = speech_regions = None
+            wrote_wav = False
+
+            if stream_audio:
+                needs_diarization = not has_diarization_results(conn, episode_id)
+                print(f'Transcribing {mp3_file}')
+                # The WAV file is written in the same ffmpeg pass, unless a resumed transcription only decodes part of the audio
+                write_wav = needs_diarization and not os.path.exists(wav_file)
+                pcm_source = lambda start_time: stream_audio_pcm(mp3_file, PCM_BLOCK_FRAMES, wav_file if write_wav and not start_time else None, start_time)
+                words = transcribe_audio(conn, episode_id, mp3_file, models, pcm_source=pcm_source)
+                if needs_diarization and not os.path.exists(wav_file):
+                    # Convert here if the WAV file wasn't written while transcribing
+                    with metrics.stage(metrics.CONVERT_STAGE):
+                        convert_audio_to_wav(mp3_file, wav_file)
+                    write_wav = True
+                # A WAV file that was already there may belong to another episode sharing the audio, so it's left alone
+                wrote_wav = write_wav and os.path.exists(wav_file)
+                if wrote_wav:
+                    open_audio_cache(downloads_dir, cache_budget).add_wav(cached)
+                audio = wav_file
+            else:
+                # Transcription and diarization both read this one mapping of the decoded audio
+                audio = open_audio(wav_file)
+                if speech_detection:
+                    speech_regions = episode_speech_regions(conn, episode_id, audio, models, speech_detection)
+                diarization = None
+                if concurrent_diarization and not has_diarization_results(conn, episode_id):
+                    diarization = _diarize_in_background(audio, models, num_speakers, min_speakers, max_speakers, speech_regions,
+                                                         diarization_window, window_workers)
+                print(f'Transcribing {wav_file}')
+                words = transcribe_audio(conn, episode_id, audio, models, parallel_workers=parallel_asr, speech_regions=speech_regions)
+                if diarization is not None:
+                    segments = diarization.result()
+
+            diarize_and_write_transcript(conn, item, episode_id, audio, words, models, num_speakers, min_speakers, max_speakers, segments,
+                                         speech_regions, diarization_window, window_workers)
+
+            # The audio isn't needed any more once the transcript is written, so the cache may evict it
+            processed = True
+            if wrote_wav:
+                open_audio_cache(downloads_dir, cache_budget).remove_wav(cached)
+
+            if upload_to_google_drive:
+                # The Google client libraries are slow to import, so only load them when uploading
+                from google_drive import upload_to_google
+                with metrics.stage(metrics.UPLOAD_STAGE):
+                    upload_to_google(conn, episode_id, item.find('title').text.strip())
+    finally:
+        # Stages that ran before a failure are recorded too, as long as the episode got as far as the database
+        if episode_id is not None:
+            episode_metrics.flush(conn, episode_id, metrics.episode_audio_duration(conn, episode_id, wav_file), metrics_file)
+        if cached is not None:
+            release_episode_audio(cached, downloads_dir, processed, cache_budget)
@@ -0,0 +1,228 @@
+import heapq
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from email.utils import parsedate_to_datetime
+from database import connect_database
+
+# Number of feeds fetched at once
+FEED_FETCH_WORKERS = 8
+
+# Bytes per second of audio assumed for enclosures without an itunes:duration, that of 128 kbit/s MP3s
+ASSUMED_BYTE_RATE = 16000
+
+# Duration assumed for episodes that give no hint of their length, in seconds
+DEFAULT_DURATION = 3600
+
+# Per-process state, set up once by init_worker in each pool process
+_worker_state = {}
+
+def estimate_duration(item):
+    """
+    Estimates the length of an episode in seconds from its itunes:duration, or else from the size of its enclosure.
+    """
+    duration = item.find('itunes:duration')
+    if duration is None:
+        duration = item.find('duration')
+    if duration is not None and duration.text.strip():
+        try:
+            seconds = 0.0
+            for part in duration.text.strip().split(':'):
+                seconds = seconds * 60 + float(part)
+            return seconds
+        except ValueError:
+            pass
+    enclosure = item.find('enclosure')
+    if enclosure is not None and enclosure.get('length', '').strip().isdigit() and int(enclosure['length']) > 0:
+        return int(enclosure['length']) / ASSUMED_BYTE_RATE
+    return DEFAULT_DURATION
+
+def _published(item):
+    try:
+        return parsedate_to_datetime(item.find('pubDate').text.strip()).timestamp()
+    except (AttributeError, TypeError, ValueError):
+        return 0.0
+
+class FairScheduler:
+    """
+    Orders the episodes of several feeds into one queue.
+
+    Every feed's episodes come newest first. The next episode is taken from the feed that has been
+    handed the least estimated audio so far, so every feed gets an equal share of the processing time
+    and a feed with a backlog of long episodes doesn't hold up the new episodes of the others. Ties go
+    to the feed whose next episode is the newest.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._feeds = []
+
+    def add(self, feed, items):
+        """
+        Adds the episodes of a feed, identified by feed in what next returns.
+        """
+        episodes = sorted(((_published(item), estimate_duration(item), item) for item in items), key=lambda episode: -episode[0])
+        if episodes:
+            self._feeds.append((feed, episodes))
+            heapq.heappush(self._heap, (0.0, -episodes[0][0], len(self._feeds) - 1))
+
+    def __len__(self):
+        return sum(len(episodes) for _, episodes in self._feeds)
+
+    def next(self):
+        """
+        Returns the feed, <item> tag and estimated duration of the next episode to process.
+        """
+        scheduled, _, index = heapq.heappop(self._heap)
+        feed, episodes = self._feeds[index]
+        _, duration, item = episodes.pop(0)
+        if episodes:
+            heapq.heappush(self._heap, (scheduled + duration, -episodes[0][0], index))
+        return feed, item, duration
+
+def plan_feed(rss_file_or_url, episode_title=None, upload_to_google_drive=False, overwrite=False, stage_fingerprints=None,
+              downloads_dir=None, cache_budget=None):
+    """
+    Reads a feed, creates its podcast directory and database and returns the episodes that need work.
+    If downloads_dir is given, the feed's audio in the old per-podcast downloads directory is moved into the audio cache.
+
+    Returns:
+        tuple: The path to the podcast's transcripts.db and the <item> tags of the episodes to process.
+    """
+    from bs4 import BeautifulSoup
+    from feed_sync import read_feed, podcast_dir_for, plan_feed_sync
+
+    soup = BeautifulSoup(read_feed(rss_file_or_url), 'xml')
+    podcast_dir = os.path.abspath(podcast_dir_for(soup))
+    os.makedirs(os.path.join(podcast_dir, "transcripts"), exist_ok=True)
+    database_path = os.path.join(podcast_dir, "transcripts.db")
+
+    # Create and migrate the database before the workers start so they never race on the schema or the journal mode
+    conn = connect_database(database_path)
+    try:
+        matching_items = [item for item in soup.find_all('item')
+                          if not episode_title or episode_title.lower() in item.find('title').text.strip().lower()]
+        items = matching_items
+        if not overwrite:
+            items = plan_feed_sync(conn, items, upload_to_google_drive, stage_fingerprints)
+    finally:
+        conn.close()
+    if downloads_dir is not None:
+        from audio_processing import import_legacy_downloads
+        import_legacy_downloads(podcast_dir, matching_items, items, downloads_dir, cache_budget)
+    return database_path, items
+
+def init_worker(downloads_dir):
+    """
+    Sets up a pool process with its own model registry. Database connections are opened per podcast as
+    its episodes come in.
+    """
+    from models import ModelRegistry
+
+    _worker_state['downloads_dir'] = downloads_dir
+    _worker_state['models'] = ModelRegistry()
+    _worker_state['connections'] = {}
+
+def run_episode(database_path, item_xml, options):
+    """
+    Processes one episode of any podcast inside a pool process, or in this process if it has no pool.
+
+    Returns:
+        float: The wall time spent on the episode in seconds.
+    """
+    from bs4 import BeautifulSoup
+    from audio_processing import process_episode
+
+    connections = _worker_state['connections']
+    if database_path not in connections:
+        connections[database_path] = connect_database(database_path)
+    item = BeautifulSoup(item_xml, 'xml').find('item')
+    start_time = time.perf_counter()
+    process_episode(item, _worker_state['downloads_dir'], connections[database_path], _worker_state['models'], **options)
+    return time.perf_counter() - start_time
+
+def process_feeds(feeds, downloads_dir, workers=1, episode_title=None, models=None, download_workers=2, **options):
+    """
+    Processes the new episodes of many feeds as one batch: fetches every feed concurrently, puts their
+    episodes in one queue ordered by FairScheduler and keeps workers processes busy with it. Every
+    podcast keeps its own directory and transcripts.db, and all of them share the audio cache.
+
+    Args:
+        feeds (list): The RSS feed URLs or paths.
+        downloads_dir (str): The audio cache directory, see audio_cache.AudioCache.
+        workers (int, optional): Number of episodes processed at once, each on its own process with its own models.
+            With 1, the episodes are processed in this process. Defaults to 1.
+        episode_title (str, optional): Only process the episodes whose title contains this.
+        models (models.ModelRegistry, optional): The registry used when processing in this process.
+        download_workers (int, optional): Number of downloads running ahead of the workers, in this process. Defaults to 2.
+        **options: Keyword arguments passed through to process_episode.
+
+    Returns:
+        list: The (episode or feed, error message) pairs of the episodes and feeds that failed.
+    """
+    from audio_cache import open_audio_cache
+    from fingerprints import options_fingerprints
+    from models import ModelRegistry
+
+    models = models or ModelRegistry()
+    stage_fingerprints = options_fingerprints(models, options)
+
+    def plan(rss_file_or_url):
+        try:
+            return plan_feed(rss_file_or_url, episode_title, options.get('upload_to_google_drive', False),
+                             options.get('overwrite', False), stage_fingerprints, downloads_dir, options.get('cache_budget'))
+        except Exception as error:
+            return error
+
+    with ThreadPoolExecutor(max_workers=FEED_FETCH_WORKERS) as executor:
+        plans = list(executor.map(plan, feeds))
+
+    failures = []
+    scheduler = FairScheduler()
+    for rss_file_or_url, planned in zip(feeds, plans):
+        if isinstance(planned, Exception):
+            print(f"Reading {rss_file_or_url} failed: {planned!r}")
+            failures.append((rss_file_or_url, str(planned)))
+        else:
+            scheduler.add(*planned)
+    total = len(scheduler)
+    print(f"{total} episode(s) from {len(feeds)} feed(s) to process on {workers} worker(s)")
+
+    if workers > 1:
+        # Use fresh interpreters rather than forking, since torch and the model libraries don't survive fork reliably
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=init_worker, initargs=(downloads_dir,))
+    else:
+        # A single worker thread, so its database connections are only ever used from the thread that opened them
+        _worker_state.update(downloads_dir=downloads_dir, models=models, connections={})
+        executor = ThreadPoolExecutor(max_workers=1)
+
+    # The audio of the next episodes in the queue downloads while the workers are busy
+    queued = (scheduler.next() for _ in range(total))
+    scheduled = open_audio_cache(downloads_dir, options.get('cache_budget')).prefetch(
+        ((item.find('enclosure')['url'], (database_path, item)) for database_path, item, _ in queued), download_workers)
+    completed = 0
+    with executor:
+        running = {}
+        while True:
+            # Episodes are handed out one at a time as workers free up, so the order follows the fair share
+            for database_path, item in itertools.islice(scheduled, workers - len(running)):
+                # Episode titles are only unique within a podcast
+                title = f"{os.path.basename(os.path.dirname(database_path))}: {item.find('title').text.strip()}"
+                running[executor.submit(run_episode, database_path, str(item), options)] = title
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                title = running.pop(future)
+                completed += 1
+                try:
+                    elapsed = future.result()
+                    print(f"[{completed}/{total}] Finished '{title}' in {elapsed:.1f}s")
+                except Exception as error:
+                    print(f"[{completed}/{total}] Failed '{title}': {error!r}")
+                    failures.append((title, str(error)))
+
+    return failures
@@ -0,0 +1,92 @@
+"""
+Benchmark for assign_words_to_speakers over synthetic words and diarization segments of increasing size.
+
+Each run also checks the result against the original nested-loop assignment, for the sizes where
+that is still fast enough to run.
+
+Usage:
+    python benchmarks/assign_speakers.py [--sizes 1000 10000 30000 100000] [--reference_limit 30000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audio_processing import assign_words_to_speakers
+from database import create_database
+
+def synthetic_episode(num_words, seed=0):
+    """
+    Generates words at a conversational rate of about 2.5 words per second and diarization segments of
+    a few seconds each, with some overlapping speech and some gaps between segments.
+    """
+    rng = random.Random(seed)
+    words = []
+    position = 0.0
+    for _ in range(num_words):
+        position += rng.uniform(0.1, 0.7)
+        words.append({'word': 'word', 'start': position, 'end': position + 0.3, 'speaker_id': -1})
+
+    segments = []
+    position = 0.0
+    while position < words[-1]['end']:
+        start_time = position + rng.uniform(-0.5, 1.0)
+        end_time = start_time + rng.uniform(1.0, 15.0)
+        segments.append((rng.randrange(4), start_time, end_time))
+        position = end_time
+    return words, segments
+
+def reference_assignment(speaker_segments, words):
+    # The nested loop assign_words_to_speakers used before the interval sweep
+    speaker_word_list = []
+    for word in words:
+        word_start_time = float(word['start'])
+        assigned = False
+        for speaker_id, start_time, end_time in speaker_segments:
+            if start_time <= word_start_time < end_time:
+                if not speaker_word_list or speaker_word_list[-1]["speaker_id"] != speaker_id:
+                    speaker_word_list.append({"speaker_id": speaker_id, "words": []})
+                speaker_word_list[-1]["words"].append(word)
+                assigned = True
+                break
+        if not assigned:
+            if not speaker_word_list:
+                speaker_word_list.append({"speaker_id": speaker_segments[0][0], "words": [word]})
+            else:
+                speaker_word_list[-1]["words"].append(word)
+    return speaker_word_list
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark assigning words to speakers.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 30000, 100000], help='Numbers of words to benchmark')
+    parser.add_argument('--reference_limit', type=int, default=30000, help='Largest size to also run and compare against the nested loop')
+    args = parser.parse_args()
+
+    print(f"{'words':>8} {'segments':>9} {'sweep':>10} {'nested loop':>12}")
+    for num_words in args.sizes:
+        words, segments = synthetic_episode(num_words)
+        conn = create_database(':memory:')
+        conn.executemany("INSERT INTO diarization_results (episode_id, speaker_id, start_time, end_time, duration) VALUES (1, ?, ?, ?, ?)",
+                         [(speaker_id, start_time, end_time, end_time - start_time) for speaker_id, start_time, end_time in segments])
+        speaker_segments = conn.execute("SELECT speaker_id, start_time, end_time FROM diarization_results ORDER BY start_time").fetchall()
+
+        start_time = time.perf_counter()
+        result = assign_words_to_speakers(conn, 1, words)
+        sweep_time = time.perf_counter() - start_time
+
+        reference_time = ''
+        if num_words <= args.reference_limit:
+            start_time = time.perf_counter()
+            expected = reference_assignment(speaker_segments, words)
+            reference_time = f'{(time.perf_counter() - start_time) * 1000:10.1f} ms'
+            if result != expected:
+                print(f'Assignment for {num_words} words differs from the nested loop')
+                sys.exit(1)
+
+        print(f'{num_words:8d} {len(segments):9d} {sweep_time * 1000:7.1f} ms {reference_time:>12}')
+
+if __name__ == '__main__':
+    main()
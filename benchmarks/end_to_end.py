@@ -0,0 +1,275 @@
+"""
+End-to-end benchmark of episode processing over synthetic episodes served from a local RSS feed.
+
+Generates synthetic episodes (see stand_ins.py), serves them and an RSS feed listing them over a local
+HTTP server and runs process_episode on every episode, then times transcribe_audio,
+assign_words_to_speakers, write_transcripts, the exporters and bulk database writes on their own.
+The recognizer, diarization pipeline and punctuator are stand-ins unless --real names them.
+
+Reports the real-time factor (processing time / audio duration), words per second, peak RSS and
+database write throughput, and fails if a metric is worse than the stored baseline by more than
+--tolerance. Baselines depend on the machine, so save one with --save_baseline before comparing.
+
+Usage:
+    python benchmarks/end_to_end.py [--episodes N] [--duration SECONDS] [--music SECONDS] [--speech_detection energy]
+                                    [--diarization_window SECONDS]
+                                    [--real recognizer diarization punctuator]
+                                    [--baseline PATH] [--save_baseline] [--tolerance FRACTION] [--verbose]
+"""
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+from bs4 import BeautifulSoup
+from audio_processing import process_episode, fetch_episode_audio, transcribe_audio, assign_words_to_speakers, write_transcripts
+from database import create_database
+from export import FORMATS, export_episode
+from stand_ins import StandInModels, write_synthetic_episode
+from word_store import load_transcription, save_episode_words
+
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, 'baseline.json')
+
+# Minimum time to repeat fast steps for, in seconds
+MIN_TIMING = 0.5
+
+# Number of rows written by the database throughput benchmark
+DB_BENCHMARK_ROWS = 200000
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def serve_directory(directory):
+    """
+    Serves a directory over HTTP on a free local port from a background thread.
+
+    Returns:
+        http.server.ThreadingHTTPServer: The running server, shut it down when done.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def write_feed(feed_dir, base_url, episodes, duration, num_speakers, music=0.0):
+    """
+    Writes the synthetic episodes and an RSS feed listing them to feed_dir.
+
+    Returns:
+        tuple: The path to the feed and the number of words in every episode.
+    """
+    items = []
+    word_counts = []
+    for number in range(episodes):
+        file_name = f'episode_{number}.wav'
+        word_counts.append(write_synthetic_episode(os.path.join(feed_dir, file_name), duration, num_speakers, seed=number, music=music))
+        items.append(f"""
+    <item>
+      <title>Benchmark Episode {number}</title>
+      <guid>benchmark-episode-{number}</guid>
+      <pubDate>Mon, {number + 1:02d} Jan 2024 00:00:00 +0000</pubDate>
+      <enclosure url="{base_url}/{file_name}" type="audio/wav"/>
+    </item>""")
+
+    feed_file = os.path.join(feed_dir, 'feed.xml')
+    with open(feed_file, 'w') as f:
+        f.write(f"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+  <channel>
+    <title>Benchmark Podcast</title>{''.join(items)}
+  </channel>
+</rss>
+""")
+    return feed_file, word_counts
+
+def timed(function, *args, **kwargs):
+    """
+    Calls function and returns its result with the wall and CPU time it took.
+    """
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start_wall, time.process_time() - start_cpu
+
+def time_per_call(function, min_time=MIN_TIMING):
+    """
+    Calls function repeatedly for at least min_time seconds and returns the mean wall time per call,
+    for steps too fast to time reliably in one call.
+    """
+    calls = 0
+    start_time = time.perf_counter()
+    while True:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start_time
+        if elapsed >= min_time:
+            return elapsed / calls
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def insert_episode(conn, title):
+    cursor = conn.execute("INSERT INTO transcripts (episode_title, episode_date, episode_wav_filename) VALUES (?, ?, ?)",
+                          (title, 'Mon, 01 Jan 2024 00:00:00 +0000', 'benchmark.wav'))
+    conn.commit()
+    return cursor.lastrowid
+
+def run_benchmarks(work_dir, models, episodes, duration, num_speakers, log, music=0.0, speech_detection=None, diarization_window=None):
+    """
+    Runs every benchmark and returns the metrics as a dict of name to (value, unit, better), where better
+    is 'lower' or 'higher'. Episodes get music seconds of music at both ends, and are processed with the
+    given speech_detection method and diarization window, if any.
+    """
+    feed_dir = os.path.join(work_dir, 'feed')
+    podcast_dir = os.path.join(work_dir, 'podcast')
+    downloads_dir = os.path.join(podcast_dir, 'downloads')
+    os.makedirs(feed_dir)
+    os.makedirs(downloads_dir)
+
+    server = serve_directory(feed_dir)
+    try:
+        base_url = f'http://127.0.0.1:{server.server_address[1]}'
+        feed_file, word_counts = write_feed(feed_dir, base_url, episodes, duration, num_speakers, music)
+        with open(feed_file) as f:
+            items = BeautifulSoup(f.read(), 'xml').find_all('item')
+
+        conn = create_database(os.path.join(podcast_dir, 'transcripts.db'))
+        metrics = {}
+
+        with contextlib.redirect_stdout(log):
+            _, wall, cpu = timed(lambda: [process_episode(item, downloads_dir, conn, models, speech_detection=speech_detection,
+                                                          diarization_window=diarization_window) for item in items])
+    finally:
+        server.shutdown()
+    audio_duration = episodes * duration
+    metrics['process_episode_rtf'] = (wall / audio_duration, 'x', 'lower')
+    metrics['process_episode_cpu_rtf'] = (cpu / audio_duration, 'x', 'lower')
+
+    episode_ids = [row[0] for row in conn.execute("SELECT id FROM transcripts ORDER BY id")]
+
+    # The stages on their own, on the first episode
+    with contextlib.redirect_stdout(log):
+        audio = fetch_episode_audio(items[0], downloads_dir)
+    episode_id = insert_episode(conn, 'Stage Benchmark')
+    with contextlib.redirect_stdout(log):
+        words, wall, _ = timed(transcribe_audio, conn, episode_id, audio.wav_file, models)
+    words = list(words)
+    metrics['transcribe_audio_rtf'] = (wall / duration, 'x', 'lower')
+    metrics['transcribe_audio_words_per_second'] = (len(words) / wall, 'words/s', 'higher')
+    if abs(len(words) - word_counts[0]) > word_counts[0] * 0.05:
+        print(f'Warning: transcribed {len(words)} words, the episode has {word_counts[0]}')
+
+    conn.execute("""
+        INSERT INTO diarization_results (episode_id, speaker_id, start_time, end_time, duration)
+        SELECT ?, speaker_id, start_time, end_time, duration FROM diarization_results WHERE episode_id = ?
+    """, (episode_id, episode_ids[0]))
+    conn.commit()
+    speaker_word_list = assign_words_to_speakers(conn, episode_id, words)
+    wall = time_per_call(lambda: assign_words_to_speakers(conn, episode_id, words))
+    metrics['assign_words_to_speakers_words_per_second'] = (len(words) / wall, 'words/s', 'higher')
+
+    # Punctuate every turn again rather than reading them from the cache filled by process_episode
+    conn.execute("DELETE FROM punctuation_cache")
+    conn.commit()
+    with contextlib.redirect_stdout(log):
+        _, wall, _ = timed(write_transcripts, conn, episode_id, speaker_word_list, models, 'Stage Benchmark', 'Mon, 01 Jan 2024 00:00:00 +0000')
+    metrics['write_transcripts_words_per_second'] = (len(words) / wall, 'words/s', 'higher')
+
+    exported_words = sum(len(load_transcription(conn, processed_id)) for processed_id in episode_ids)
+    with open(os.devnull, 'w') as null:
+        for fmt in FORMATS:
+            wall = time_per_call(lambda: [export_episode(conn, processed_id, fmt, null) for processed_id in episode_ids])
+            metrics[f'export_{fmt}_words_per_second'] = (exported_words / wall, 'words/s', 'higher')
+
+    # Bulk writes, one row per word as during transcription and packed as once an episode is finished
+    rows = [(episode_id, word['word'], word['start'], word['end'], -1) for word in words]
+    rows = (rows * (DB_BENCHMARK_ROWS // len(rows) + 1))[:DB_BENCHMARK_ROWS]
+    def write_rows():
+        with conn:
+            conn.executemany("INSERT INTO transcription_results (episode_id, word, start_time, end_time, speaker_id) VALUES (?, ?, ?, ?, ?)", rows)
+    _, wall, _ = timed(write_rows)
+    metrics['db_row_writes_per_second'] = (len(rows) / wall, 'rows/s', 'higher')
+
+    packed_words = [{'word': row[1], 'start': row[2], 'end': row[3], 'speaker_id': 0} for row in rows]
+    def write_packed():
+        with conn:
+            save_episode_words(conn, episode_id, packed_words)
+    _, wall, _ = timed(write_packed)
+    metrics['db_packed_words_per_second'] = (len(packed_words) / wall, 'words/s', 'higher')
+
+    conn.close()
+    metrics['peak_rss'] = (peak_rss_mb(), 'MB', 'lower')
+    return metrics
+
+def compare_to_baseline(metrics, baseline, tolerance):
+    """
+    Returns the names of the metrics that are worse than their baseline by more than tolerance.
+    """
+    regressions = []
+    for name, (value, _, better) in metrics.items():
+        if name not in baseline:
+            continue
+        if better == 'lower' and value > baseline[name] * (1 + tolerance):
+            regressions.append(name)
+        elif better == 'higher' and value < baseline[name] / (1 + tolerance):
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark episode processing end to end over synthetic episodes.')
+    parser.add_argument('--episodes', type=int, default=3, help='Number of synthetic episodes (default is 3)')
+    parser.add_argument('--duration', type=float, default=600, help='Duration of every episode in seconds (default is 600)')
+    parser.add_argument('--speakers', type=int, default=2, help='Number of speakers in every episode (default is 2)')
+    parser.add_argument('--music', type=float, default=0, help='Seconds of music at the start and the end of every episode (default is 0)')
+    parser.add_argument('--speech_detection', choices=['energy', 'pyannote'], help='Process the episodes with this speech detection method')
+    parser.add_argument('--diarization_window', type=float, help='Diarize the episodes in overlapping windows of this many seconds')
+    parser.add_argument('--real', nargs='*', default=[], choices=['recognizer', 'diarization', 'punctuator'],
+                        help='Models to load for real instead of using stand-ins, see config.py')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline file to compare against (default is benchmarks/baseline.json)')
+    parser.add_argument('--save_baseline', action='store_true', help='Store the results as the new baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed regression against the baseline as a fraction (default is 0.25)')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the code being benchmarked')
+    args = parser.parse_args()
+
+    log = sys.stdout if args.verbose else io.StringIO()
+    with tempfile.TemporaryDirectory() as work_dir:
+        metrics = run_benchmarks(work_dir, StandInModels(args.real), args.episodes, args.duration, args.speakers, log,
+                                 args.music, args.speech_detection, args.diarization_window)
+
+    baseline = {}
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare_to_baseline(metrics, baseline, args.tolerance)
+
+    print(f"{'metric':45} {'value':>12} {'unit':8} {'baseline':>12}")
+    for name, (value, unit, _) in metrics.items():
+        status = '  FAIL' if name in regressions else ''
+        reference = f'{baseline[name]:12.4g}' if name in baseline else ''
+        print(f'{name:45} {value:12.4g} {unit:8} {reference:>12}{status}')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({name: value for name, (value, _, _) in metrics.items()}, f, indent=2)
+        print(f'Saved the baseline to {args.baseline}')
+    elif not baseline:
+        print(f'No baseline at {args.baseline}, run with --save_baseline to store one')
+    elif regressions:
+        print(f"{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+"""
+Stand-ins for the Vosk recognizer, the pyannote diarization pipeline and speaker embedding model and
+the Punctuator, and a generator of synthetic episodes they understand.
+
+The synthetic audio consists of tone bursts ("words") separated by short gaps, in turns of a few
+seconds each, optionally between a music intro and outro of sustained chords. Every speaker talks at
+their own pitch. The stand-in recognizer finds the bursts by their energy and the stand-in diarization
+pipeline tells the speakers apart by pitch, so the stand-ins do real work on the audio and their output
+lines up with it like that of the real models.
+"""
+import json
+import random
+import wave
+from collections import namedtuple
+import numpy as np
+from audio_buffer import EpisodeAudio
+from config import FRAME_RATE
+
+# Pitch of the first speaker in Hz, speaker n talks at (n + 1) times this pitch
+BASE_PITCH = 150.0
+
+# Length of the windows the stand-ins measure the audio over, in seconds
+RECOGNIZER_WINDOW = 0.01
+DIARIZATION_WINDOW = 0.5
+
+# Silence after which the stand-in recognizer finalizes an utterance, in seconds
+UTTERANCE_PAUSE = 0.5
+
+# Mean squared amplitude above which a window counts as speech
+SPEECH_ENERGY = 1e5
+
+# Frequencies of the chord played as music, in Hz
+MUSIC_CHORD = [220.0, 277.2, 329.6]
+
+VOCABULARY = [
+    'the', 'and', 'that', 'you', 'know', 'think', 'really', 'about', 'people', 'just', 'podcast', 'episode',
+    'because', 'there', 'what', 'like', 'going', 'right', 'actually', 'question', 'interesting', 'so', "it's", "don't",
+]
+
+Segment = namedtuple('Segment', ['start', 'end'])
+
+def _word_at(start_time):
+    return VOCABULARY[int(start_time * 100) % len(VOCABULARY)]
+
+def _music(frames, noise):
+    times = np.arange(frames) / FRAME_RATE
+    return sum(1500 * np.sin(2 * np.pi * pitch * times) for pitch in MUSIC_CHORD) + noise.normal(0, 30, frames)
+
+def write_synthetic_episode(wav_file, duration, num_speakers=2, seed=0, music=0.0):
+    """
+    Writes a synthetic episode of the given duration in seconds to a 16-bit mono WAV file at FRAME_RATE.
+    With music, the first and last music seconds of the episode are music instead of speech.
+
+    Returns:
+        int: The number of words in the episode.
+    """
+    rng = random.Random(seed)
+    noise = np.random.default_rng(seed)
+    total_frames = int(duration * FRAME_RATE)
+    music_frames = min(int(music * FRAME_RATE), total_frames // 2)
+    written = 0
+    num_words = 0
+    speaker = 0
+
+    with wave.open(wav_file, 'wb') as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(FRAME_RATE)
+        if music_frames:
+            wf.writeframes(_music(music_frames, noise).astype('<i2').tobytes())
+            written += music_frames
+        while written < total_frames - music_frames:
+            # One turn: a few utterances of a few words each
+            pitch = BASE_PITCH * (speaker + 1)
+            turn = []
+            word_ends = []
+            turn_frames = 0
+            for _ in range(rng.randint(1, 4)):
+                for _ in range(rng.randint(3, 12)):
+                    word_frames = int(rng.uniform(0.15, 0.5) * FRAME_RATE)
+                    gap_frames = int(rng.uniform(0.08, 0.25) * FRAME_RATE)
+                    turn.append(3000 * np.sin(2 * np.pi * pitch * np.arange(word_frames) / FRAME_RATE))
+                    turn.append(np.zeros(gap_frames))
+                    word_ends.append(turn_frames + word_frames)
+                    turn_frames += word_frames + gap_frames
+                pause_frames = int(rng.uniform(0.6, 1.2) * FRAME_RATE)
+                turn.append(np.zeros(pause_frames))
+                turn_frames += pause_frames
+            samples = np.concatenate(turn)[:total_frames - music_frames - written]
+            num_words += sum(1 for end in word_ends if end <= len(samples))
+            samples += noise.normal(0, 30, len(samples))
+            wf.writeframes(samples.astype('<i2').tobytes())
+            written += len(samples)
+            speaker = (speaker + rng.randint(1, max(num_speakers - 1, 1))) % num_speakers
+        if music_frames:
+            wf.writeframes(_music(total_frames - written, noise).astype('<i2').tobytes())
+    return num_words
+
+class StandInRecognizer:
+    """
+    Implements the part of the vosk.KaldiRecognizer interface the transcription code uses. Every burst
+    of energy in the audio is recognized as one word, and an utterance is finalized after UTTERANCE_PAUSE
+    seconds of silence.
+    """
+
+    def __init__(self):
+        self.Reset()
+
+    def SetWords(self, enabled):
+        pass
+
+    def Reset(self):
+        self._window = int(RECOGNIZER_WINDOW * FRAME_RATE)
+        self._leftover = np.empty(0, dtype=np.float32)
+        self._position = 0
+        self._word_start = None
+        self._silent_windows = 0
+        self._words = []
+
+    def AcceptWaveform(self, data):
+        samples = np.concatenate([self._leftover, np.frombuffer(data, dtype='<i2').astype(np.float32)])
+        full = len(samples) // self._window * self._window
+        self._leftover = samples[full:]
+        speech = (samples[:full].reshape(-1, self._window) ** 2).mean(axis=1) > SPEECH_ENERGY
+
+        finalized = False
+        pause_windows = int(UTTERANCE_PAUSE / RECOGNIZER_WINDOW)
+        for is_speech in speech:
+            if is_speech:
+                if self._word_start is None:
+                    self._word_start = self._position
+                self._silent_windows = 0
+            else:
+                if self._word_start is not None:
+                    self._end_word()
+                self._silent_windows += 1
+                if self._silent_windows == pause_windows and self._words:
+                    finalized = True
+            self._position += 1
+        return finalized
+
+    def _end_word(self):
+        start_time = self._word_start * RECOGNIZER_WINDOW
+        self._words.append({'conf': 1.0, 'start': start_time, 'end': self._position * RECOGNIZER_WINDOW, 'word': _word_at(start_time)})
+        self._word_start = None
+
+    def _result(self):
+        words, self._words = self._words, []
+        return json.dumps({'result': words, 'text': ' '.join(word['word'] for word in words)})
+
+    def Result(self):
+        return self._result()
+
+    def FinalResult(self):
+        if self._word_start is not None:
+            self._end_word()
+        return self._result()
+
+class StandInDiarization:
+    """
+    Implements the part of the pyannote Annotation interface the diarization code uses.
+    """
+
+    def __init__(self, tracks):
+        self._tracks = tracks
+
+    def itertracks(self, yield_label=False):
+        for index, (segment, label) in enumerate(self._tracks):
+            yield (segment, index, label) if yield_label else (segment, index)
+
+def _input_samples(file):
+    """
+    Takes a WAV file path, or the {"waveform", "sample_rate"} dict the diarization code passes, which is
+    handled like pyannote's Audio.validate_file does: it sets the dict's uri and only accepts a
+    (channel, time) waveform with at least as many samples as channels.
+
+    Returns:
+        tuple: The samples on the 16-bit scale, and the sample rate.
+    """
+    if isinstance(file, str):
+        audio = EpisodeAudio(file)
+        return audio.samples, audio.sample_rate
+    file.setdefault('uri', 'waveform')
+    waveform = file['waveform']
+    if waveform.ndim != 2 or waveform.shape[0] > waveform.shape[1]:
+        raise ValueError("'waveform' must be provided as a (channel, time) array.")
+    return waveform[0] * 32768.0, file['sample_rate']
+
+class StandInDiarizationPipeline:
+    """
+    Tells every DIARIZATION_WINDOW of speech apart by the speaker whose pitch is closest to the strongest
+    frequency in it, and merges neighbouring windows of the same speaker into segments. Like pyannote,
+    it numbers the speakers in the order they first speak in the audio it's given.
+    """
+
+    def __call__(self, file, num_speakers=None, min_speakers=None, max_speakers=None):
+        audio_samples, sample_rate = _input_samples(file)
+        labels = {}
+        window_frames = int(DIARIZATION_WINDOW * sample_rate)
+        tracks = []
+        for start in range(0, len(audio_samples), window_frames):
+            samples = np.asarray(audio_samples[start:start + window_frames], dtype=np.float32)
+            voiced = samples[np.abs(samples) > 300]
+            if len(voiced) <= len(samples) // 10:
+                continue
+            pitch = np.argmax(np.abs(np.fft.rfft(samples))) * sample_rate / len(samples)
+            speaker = max(int(round(pitch / BASE_PITCH)) - 1, 0)
+            label = labels.setdefault(speaker, f'SPEAKER_{len(labels):02d}')
+            start_time = start / sample_rate
+            end_time = (start + len(samples)) / sample_rate
+            if tracks and tracks[-1][1] == label and tracks[-1][0].end == start_time:
+                tracks[-1] = (Segment(tracks[-1][0].start, end_time), label)
+            else:
+                tracks.append((Segment(start_time, end_time), label))
+        return StandInDiarization(tracks)
+
+class StandInSpeakerEmbedding:
+    """
+    Implements the call of a pyannote Inference with window="whole": the embedding of a voice is the
+    spectral energy around the pitch of every speaker, so the same speaker gets similar embeddings
+    wherever they talk.
+    """
+
+    def __call__(self, file):
+        samples, sample_rate = _input_samples(file)
+        spectrum = np.abs(np.fft.rfft(np.asarray(samples, dtype=np.float32)))
+        frequencies = np.fft.rfftfreq(len(samples), 1 / sample_rate)
+        bands = [spectrum[np.abs(frequencies - BASE_PITCH * (n + 1)) < BASE_PITCH / 4].sum() for n in range(8)]
+        return np.array(bands, dtype=np.float32)
+
+class StandInPunctuator:
+    """
+    Punctuates text by rule: a comma every 7 words, a full stop every 15 and capitals after full stops.
+    """
+
+    def punctuate(self, text):
+        words = text.split()
+        sentence_start = True
+        for index, word in enumerate(words):
+            if sentence_start:
+                words[index] = word[:1].upper() + word[1:]
+            sentence_start = False
+            if (index + 1) % 15 == 0 or index == len(words) - 1:
+                words[index] += '.'
+                sentence_start = True
+            elif (index + 1) % 7 == 0:
+                words[index] += ','
+        return ' '.join(words)
+
+class StandInModels:
+    """
+    Provides the ModelRegistry interface with stand-ins for every model, except the ones named in real,
+    which are loaded through a ModelRegistry as usual.
+
+    Args:
+        real (iterable, optional): The models to load for real, any of 'recognizer', 'diarization' and 'punctuator'.
+    """
+
+    def __init__(self, real=()):
+        self._real = set(real)
+        self._registry = None
+        self._diarization_pipeline = StandInDiarizationPipeline()
+        self._speaker_embedding = StandInSpeakerEmbedding()
+        self._punctuator = StandInPunctuator()
+        self.load_times = {}
+
+    @property
+    def registry(self):
+        if self._registry is None:
+            from models import ModelRegistry
+            self._registry = ModelRegistry()
+            self.load_times = self._registry.load_times
+        return self._registry
+
+    @property
+    def recognizer(self):
+        if 'recognizer' in self._real:
+            return self.registry.recognizer
+        if not hasattr(self, '_recognizer'):
+            self._recognizer = StandInRecognizer()
+        return self._recognizer
+
+    @property
+    def recognizer_version(self):
+        return self.registry.recognizer_version if 'recognizer' in self._real else 'stand-in'
+
+    def new_recognizer(self):
+        if 'recognizer' in self._real:
+            return self.registry.new_recognizer()
+        return StandInRecognizer()
+
+    @property
+    def punctuator(self):
+        return self.registry.punctuator if 'punctuator' in self._real else self._punctuator
+
+    @property
+    def punctuator_version(self):
+        return self.registry.punctuator_version if 'punctuator' in self._real else 'stand-in'
+
+    @property
+    def diarization_pipeline(self):
+        return self.registry.diarization_pipeline if 'diarization' in self._real else self._diarization_pipeline
+
+    @property
+    def diarization_version(self):
+        return self.registry.diarization_version if 'diarization' in self._real else 'stand-in'
+
+    @property
+    def speaker_embedding(self):
+        return self.registry.speaker_embedding if 'diarization' in self._real else self._speaker_embedding
+
+    @property
+    def speaker_embedding_version(self):
+        return self.registry.speaker_embedding_version if 'diarization' in self._real else 'stand-in'
+
+    @property
+    def speech_activity_pipeline(self):
+        # There's no stand-in for pyannote's speech activity detection, the energy method needs no model
+        return self.registry.speech_activity_pipeline
+
+    @property
+    def speech_activity_version(self):
+        return self.registry.speech_activity_version
@@ -0,0 +1,89 @@
+"""
+Startup-time benchmark for the read-only CLI commands.
+
+Runs each read-only command of main.py against a small throwaway database and fails if any of them
+takes longer than the budget. These commands only query SQLite, so they must not pay for importing
+the model libraries, the HTTP/XML stack or the Google client.
+
+Usage:
+    python benchmarks/startup.py [--budget SECONDS] [--runs N]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from database import create_database
+
+EPISODE_TITLE = "Benchmark Episode"
+
+READ_ONLY_COMMANDS = [
+    ['--print_urls'],
+    ['--print_transcript', '-e', EPISODE_TITLE],
+    ['--export_diarization', '-e', EPISODE_TITLE],
+    ['--export_transcription', '-e', EPISODE_TITLE],
+    ['--export', 'json', '-e', EPISODE_TITLE],
+    ['--search', 'word'],
+    ['--stats'],
+]
+
+HEAVY_MODULES = ['vosk', 'punctuator', 'pyannote', 'torch', 'numpy', 'bs4', 'requests', 'googleapiclient']
+
+def populate_database(podcast_dir):
+    conn = create_database(os.path.join(podcast_dir, "transcripts.db"))
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO transcripts (episode_title, episode_date, episode_wav_filename, transcript, doc_link) VALUES (?, ?, ?, ?, ?)",
+                   (EPISODE_TITLE, "Mon, 01 Jan 2024 00:00:00 +0000", "episode.wav", "Hello world.", "https://docs.google.com/document/d/benchmark"))
+    episode_id = cursor.lastrowid
+    cursor.executemany("INSERT INTO transcription_results (episode_id, word, start_time, end_time, speaker_id) VALUES (?, ?, ?, ?, ?)",
+                       [(episode_id, "word", i * 0.5, i * 0.5 + 0.4, 0) for i in range(1000)])
+    cursor.executemany("INSERT INTO diarization_results (episode_id, speaker_id, start_time, end_time, duration) VALUES (?, ?, ?, ?, ?)",
+                       [(episode_id, i % 2, i * 10.0, i * 10.0 + 10.0, 10.0) for i in range(50)])
+    conn.commit()
+    conn.close()
+
+def time_command(command, podcast_dir, runs):
+    """
+    Runs a read-only command several times and returns its fastest wall time and the heavy modules it imported.
+    """
+    best = None
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(REPO_DIR, 'main.py')] + command + ['-d', podcast_dir],
+                                check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, cwd=REPO_DIR)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+
+    # -X importtime writes one "import time: self | cumulative | module" line per imported module
+    imported = {line.rsplit('|', 1)[-1].strip() for line in result.stderr.splitlines() if line.startswith('import time:')}
+    heavy = [module for module in HEAVY_MODULES if module in imported]
+    return best, heavy
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that the read-only CLI commands start within a fixed time budget.')
+    parser.add_argument('--budget', type=float, default=0.5, help='Maximum allowed wall time per command in seconds (default is 0.5)')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs per command; the fastest run is reported (default is 5)')
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as podcast_dir:
+        populate_database(podcast_dir)
+        for command in READ_ONLY_COMMANDS:
+            elapsed, heavy = time_command(command, podcast_dir, args.runs)
+            status = 'ok'
+            if elapsed > args.budget or heavy:
+                status = 'FAIL'
+                failed = True
+            print(f"{' '.join(command):45} {elapsed * 1000:8.1f} ms  {status}" + (f"  (imported {', '.join(heavy)})" if heavy else ''))
+
+    if failed:
+        print(f'Read-only commands exceeded the {args.budget:.2f}s budget or imported heavy modules')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
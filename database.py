@@ -1,9 +1,6 @@
 import sqlite3
 
-def create_database(database_name):
-    conn = sqlite3.connect(database_name)
-    cursor = conn.cursor()
-
+def _create_tables(cursor):
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS transcripts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -39,5 +36,200 @@ def create_database(database_name):
         )
     """)
 
-    conn.commit()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS transcription_progress (
+            episode_id INTEGER PRIMARY KEY,
+            audio_offset REAL NOT NULL,
+            completed INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (episode_id) REFERENCES transcripts(id)
+        )
+    """)
+
+def _add_indexes(cursor):
+    # Every per-episode query filters on episode_id and orders by start_time
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_diarization_results_episode ON diarization_results (episode_id, start_time)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transcription_results_episode ON transcription_results (episode_id, start_time)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transcripts_title_date ON transcripts (episode_title, episode_date)")
+
+def _add_packed_words(cursor):
+    # Per-podcast dictionary of the words in episode_words
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS vocabulary (
+            id INTEGER PRIMARY KEY,
+            word TEXT NOT NULL UNIQUE
+        )
+    """)
+
+    # The words of a finished transcription as packed little-endian arrays, see word_store.py
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS episode_words (
+            episode_id INTEGER PRIMARY KEY,
+            word_count INTEGER NOT NULL,
+            word_ids BLOB NOT NULL,
+            start_times BLOB NOT NULL,
+            end_times BLOB NOT NULL,
+            speaker_ids BLOB NOT NULL,
+            FOREIGN KEY (episode_id) REFERENCES transcripts(id)
+        )
+    """)
+
+def _add_punctuation_cache(cursor):
+    # Punctuated speaker turns keyed by a hash of the punctuator model version and the raw turn text
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS punctuation_cache (
+            key TEXT PRIMARY KEY,
+            punctuated TEXT NOT NULL
+        )
+    """)
+
+def _add_episode_keys_and_stages(cursor):
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(transcripts)")}
+    # Episodes are identified by their RSS guid (or enclosure URL), see feed_sync.py
+    if 'episode_guid' not in columns:
+        cursor.execute("ALTER TABLE transcripts ADD COLUMN episode_guid TEXT")
+    if 'enclosure_url' not in columns:
+        cursor.execute("ALTER TABLE transcripts ADD COLUMN enclosure_url TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transcripts_guid ON transcripts (episode_guid)")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS episode_stages (
+            episode_id INTEGER NOT NULL,
+            stage TEXT NOT NULL,
+            completed_at TEXT NOT NULL,
+            PRIMARY KEY (episode_id, stage),
+            FOREIGN KEY (episode_id) REFERENCES transcripts(id)
+        )
+    """)
+
+def _add_search_index(cursor):
+    # One row per run of words from a speaker turn, the text itself is indexed in transcript_search, see search.py
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS search_rows (
+            id INTEGER PRIMARY KEY,
+            episode_id INTEGER NOT NULL,
+            speaker_id TEXT NOT NULL,
+            word_starts BLOB NOT NULL,
+            FOREIGN KEY (episode_id) REFERENCES transcripts(id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_search_rows_episode ON search_rows (episode_id)")
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS transcript_search USING fts5(text, tokenize = 'unicode61')")
+
+def _add_upload_failures(cursor):
+    # Uploads that failed after every retry, replayed with --retry_uploads, see google_drive.py
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS upload_failures (
+            episode_id INTEGER PRIMARY KEY,
+            error TEXT NOT NULL,
+            failed_at TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 1,
+            FOREIGN KEY (episode_id) REFERENCES transcripts(id)
+        )
+    """)
+
+def _add_stage_metrics(cursor):
+    # Time and resources spent in every stage of every episode, see metrics.py
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stage_metrics (
+            id INTEGER PRIMARY KEY,
+            episode_id INTEGER NOT NULL,
+            stage TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            wall_time REAL NOT NULL,
+            cpu_time REAL NOT NULL,
+            peak_rss INTEGER NOT NULL,
+            audio_duration REAL,
+            real_time_factor REAL,
+            failed INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (episode_id) REFERENCES transcripts(id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stage_metrics_episode ON stage_metrics (episode_id)")
+
+def _add_speech_regions(cursor):
+    # The stretches of every episode that contain speech, see speech_activity.py
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS speech_regions (
+            episode_id INTEGER NOT NULL,
+            start_time REAL NOT NULL,
+            end_time REAL NOT NULL,
+            FOREIGN KEY (episode_id) REFERENCES transcripts(id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_speech_regions_episode ON speech_regions (episode_id)")
+
+def _add_audio_hashes(cursor):
+    # The key of every episode's audio in the shared audio cache, see audio_cache.py
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(transcripts)")}
+    if 'audio_sha256' not in columns:
+        cursor.execute("ALTER TABLE transcripts ADD COLUMN audio_sha256 TEXT")
+
+def _add_stage_fingerprints(cursor):
+    # The inputs the stage outputs of every episode were computed from, see fingerprints.py
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stage_fingerprints (
+            episode_id INTEGER NOT NULL,
+            stage TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            PRIMARY KEY (episode_id, stage),
+            FOREIGN KEY (episode_id) REFERENCES transcripts(id)
+        )
+    """)
+
+# Schema migrations in order. The schema version of a database (PRAGMA user_version) is the number
+# of migrations applied to it, so databases created before versioning start at 0 and get every migration.
+# Migrations must be safe to run on databases that already have parts of the schema.
+MIGRATIONS = [
+    _create_tables,
+    _add_indexes,
+    _add_packed_words,
+    _add_punctuation_cache,
+    _add_episode_keys_and_stages,
+    _add_search_index,
+    _add_upload_failures,
+    _add_stage_metrics,
+    _add_speech_regions,
+    _add_audio_hashes,
+    _add_stage_fingerprints,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate_database(conn):
+    """
+    Brings the schema of the database up to SCHEMA_VERSION, running each pending migration in its own transaction.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f'Database schema version {version} is newer than this version of the code supports ({SCHEMA_VERSION})')
+
+    for target_version in range(version + 1, SCHEMA_VERSION + 1):
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN")
+            MIGRATIONS[target_version - 1](cursor)
+            cursor.execute(f"PRAGMA user_version = {target_version}")
+        if version:
+            print(f'Migrated database to schema version {target_version}')
+
+def create_database(database_name):
+    conn = sqlite3.connect(database_name)
+
+    # WAL lets readers run alongside the writer, and with WAL, synchronous=NORMAL only syncs at checkpoints
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")
+
+    migrate_database(conn)
+    return conn
+
+def connect_database(database_name, busy_timeout=60):
+    """
+    Opens a connection that can write to the database alongside other processes or threads.
+
+    Writers wait up to busy_timeout seconds for the lock instead of failing immediately.
+    """
+    conn = create_database(database_name)
+    conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout * 1000)}")
     return conn
@@ -1,33 +1,172 @@
+import hashlib
+import json
 import subprocess
 import os
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse
 from config import FRAME_RATE
 
-def download_file(url, dest_folder):
+# Size of the blocks read from the network and written to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Number of pooled connections per host, which is also the most transfers that can run at once without reconnecting
+DOWNLOAD_POOL_SIZE = 8
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """
+    Returns the HTTP session shared by all downloads, so connections to the same host are reused.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=DOWNLOAD_POOL_SIZE, pool_maxsize=DOWNLOAD_POOL_SIZE, max_retries=3)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+    return _session
+
+def _checksum_path(local_filename):
+    return local_filename + '.sha256'
+
+def _read_checksum(local_filename):
+    try:
+        with open(_checksum_path(local_filename)) as f:
+            checksum, size = f.read().split()
+        return checksum, int(size)
+    except (OSError, ValueError):
+        return None
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256
+
+def download_checksum(local_filename):
+    """
+    Returns the SHA-256 checksum and size recorded when the file finished downloading, or None if it didn't.
+    """
+    return _read_checksum(local_filename) if is_download_complete(local_filename) else None
+
+def is_download_complete(local_filename):
+    """
+    Checks whether a downloaded file was verified when it finished downloading and hasn't been truncated since.
+    """
+    recorded = _read_checksum(local_filename)
+    return recorded is not None and os.path.exists(local_filename) and os.path.getsize(local_filename) == recorded[1]
+
+def download_file(url, dest_folder, session=None, filename=None):
     """
     Downloads a file from the given URL and saves it to the specified destination folder.
-    
+
+    The file is downloaded to a .part file first. An interrupted download is resumed with an HTTP Range
+    request on the next attempt, and the .part file is only renamed into place once its length matches
+    the size reported by the server. The SHA-256 checksum and size of the finished file are recorded in
+    a .sha256 file next to it, which is what marks the download as complete.
+
     Args:
         url (str): The URL of the file to download.
         dest_folder (str): The destination folder where the file should be saved.
-    
+        session (requests.Session, optional): The session to use, defaults to the shared pooled session.
+        filename (str, optional): The name to save the file as, defaults to the last segment of the URL's path.
+
     Returns:
         str: The local path to the downloaded file.
     """
-    local_filename = os.path.join(dest_folder, urlparse(url).path.split('/')[-1])
+    session = session or get_session()
+    local_filename = os.path.join(dest_folder, filename or urlparse(url).path.split('/')[-1])
+    part_filename = local_filename + '.part'
 
-    if os.path.exists(local_filename):
+    if is_download_complete(local_filename):
         print(f'{local_filename} already exists, skipping download')
         return local_filename
 
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+    if os.path.exists(local_filename):
+        # Left behind by an earlier download that wasn't verified, so treat it as partial
+        print(f'{local_filename} was not verified, resuming it as a partial download')
+        os.replace(local_filename, part_filename)
+
+    offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+    with session.get(url, stream=True, headers=headers) as r:
+        if r.status_code == 416:
+            # The partial file already holds everything the server has, check it below
+            total_size = offset
+        else:
+            r.raise_for_status()
+            if offset and r.status_code != 206:
+                print(f'Server does not support resuming {url}, restarting download')
+                offset = 0
+            if r.status_code == 206:
+                total_size = int(r.headers['Content-Range'].split('/')[-1])
+            else:
+                total_size = int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+
+            if offset:
+                print(f'Resuming {url} at byte {offset}')
+            with open(part_filename, 'ab' if offset else 'wb') as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+
+    size = os.path.getsize(part_filename)
+    if total_size is not None and size != total_size:
+        raise IOError(f'Download of {url} is incomplete: got {size} of {total_size} bytes')
+
+    checksum = hash_file(part_filename).hexdigest()
+    os.replace(part_filename, local_filename)
+    with open(_checksum_path(local_filename), 'w') as f:
+        f.write(f'{checksum} {size}\n')
     return local_filename
 
+def fetch_feed(url, cache_dir, session=None):
+    """
+    Fetches an RSS feed with a conditional GET, reusing the cached copy when the server reports it unchanged.
+
+    The feed body and its ETag/Last-Modified headers are cached in cache_dir, keyed by the feed URL.
+
+    Args:
+        url (str): The URL of the RSS feed.
+        cache_dir (str): Directory where fetched feeds are cached.
+        session (requests.Session, optional): The session to use, defaults to the shared pooled session.
+
+    Returns:
+        str: The content of the feed.
+    """
+    session = session or get_session()
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    content_path = os.path.join(cache_dir, cache_key + '.xml')
+    headers_path = os.path.join(cache_dir, cache_key + '.json')
+
+    headers = {}
+    if os.path.exists(content_path) and os.path.exists(headers_path):
+        with open(headers_path) as f:
+            validators = json.load(f)
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    response = session.get(url, headers=headers)
+    if response.status_code == 304:
+        print(f'Feed {url} has not changed, using the cached copy')
+        with open(content_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    response.raise_for_status()
+
+    with open(content_path, 'w', encoding='utf-8') as f:
+        f.write(response.text)
+    with open(headers_path, 'w') as f:
+        json.dump({'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}, f)
+    return response.text
+
 def convert_audio_to_wav(input_file, output_file):
     """
     Converts an audio file to WAV format with the required settings for transcription.
@@ -39,10 +178,57 @@ def convert_audio_to_wav(input_file, output_file):
     if os.path.exists(output_file):
         print(f'{output_file} already exists, skipping conversion')
         return
-    subprocess.run([
-        'ffmpeg', '-i', input_file,
+    # Write to a temporary name so an interrupted conversion never leaves a truncated WAV behind
+    part_file = output_file + '.part'
+    result = subprocess.run([
+        'ffmpeg', '-y', '-i', input_file,
         '-acodec', 'pcm_s16le',
         '-ac', '1',
         '-ar', str(FRAME_RATE),
-        output_file
+        '-f', 'wav', part_file
     ])
+    if result.returncode != 0:
+        raise RuntimeError(f'ffmpeg failed to convert {input_file}')
+    os.replace(part_file, output_file)
+
+def stream_audio_pcm(input_file, block_frames, wav_file=None, start_time=0.0):
+    """
+    Decodes an audio file with ffmpeg and yields it as raw 16-bit mono PCM blocks at FRAME_RATE, as they are decoded.
+
+    Args:
+        input_file (str): The path to the input audio file.
+        block_frames (int): The number of frames in each yielded block (the last block may be shorter).
+        wav_file (str, optional): If given, ffmpeg also writes the decoded audio to this WAV file in the same pass.
+        start_time (float, optional): Position in seconds to start decoding from. Defaults to 0.
+
+    Yields:
+        bytes: The next block of PCM data.
+    """
+    pcm_args = ['-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(FRAME_RATE)]
+    command = ['ffmpeg', '-loglevel', 'error']
+    if start_time:
+        command += ['-ss', str(start_time)]
+    command += ['-i', input_file]
+    if wav_file:
+        # Write to a temporary name so an interrupted decode never leaves a truncated WAV behind
+        part_wav_file = wav_file + '.part'
+        command += pcm_args + ['-f', 'wav', '-y', part_wav_file]
+    command += pcm_args + ['-f', 's16le', '-']
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    try:
+        block_size = block_frames * 2
+        while True:
+            data = process.stdout.read(block_size)
+            if not data:
+                break
+            yield data
+        if process.wait() != 0:
+            raise RuntimeError(f'ffmpeg failed to decode {input_file}')
+        if wav_file:
+            os.replace(part_wav_file, wav_file)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
@@ -0,0 +1,154 @@
+import heapq
+import json
+import os
+import re
+from word_store import iter_transcription
+
+# Captions are cut when the speaker changes, or when a cue would get longer or wider than this
+MAX_CUE_DURATION = 6.0
+MAX_CUE_CHARS = 84
+
+# A pause of at least this many seconds between words also starts a new caption
+MAX_CUE_GAP = 1.5
+
+FORMATS = ['json', 'ndjson', 'rttm', 'srt', 'vtt']
+
+def _speaker_segments(conn, episode_id):
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT speaker_id, start_time, end_time
+        FROM diarization_results
+        WHERE episode_id = ?
+        ORDER BY start_time
+    """, (episode_id,))
+    return cursor
+
+def iter_words_with_speakers(conn, episode_id):
+    """
+    Yields the words of an episode in order with the speaker from the diarization results filled in.
+
+    Uses the same rules as assign_words_to_speakers: a word belongs to the first segment (in start time
+    order) containing its start time, and words outside every segment go to the previous word's speaker,
+    or to the first speaker at the start of the episode. Words and segments are both read in order in a
+    single sweep, so memory use doesn't depend on the length of the episode. Words keep their stored
+    speaker ID if the episode has no diarization results.
+    """
+    segments = _speaker_segments(conn, episode_id)
+    next_segment = next(segments, None)
+    first_speaker = next_segment[0] if next_segment else None
+    active = []
+    order = 0
+    last_speaker = None
+
+    for word in iter_transcription(conn, episode_id):
+        time = float(word['start'])
+        while next_segment is not None and next_segment[1] <= time:
+            heapq.heappush(active, (order, next_segment))
+            order += 1
+            next_segment = next(segments, None)
+        while active and active[0][1][2] <= time:
+            heapq.heappop(active)
+
+        if active:
+            last_speaker = active[0][1][0]
+        elif last_speaker is None:
+            last_speaker = first_speaker
+        if last_speaker is not None:
+            word = dict(word, speaker_id=last_speaker)
+        yield word
+
+def write_json(conn, episode_id, out):
+    # Same layout as json.dumps(..., indent=2) of the whole list, written one record at a time
+    first = True
+    for word in iter_words_with_speakers(conn, episode_id):
+        record = json.dumps({"word": word["word"], "start_time": word["start"], "end_time": word["end"], "speaker_id": word["speaker_id"]}, indent=2)
+        out.write(('[\n  ' if first else ',\n  ') + record.replace('\n', '\n  '))
+        first = False
+    out.write('[]\n' if first else '\n]\n')
+
+def write_ndjson(conn, episode_id, out):
+    for word in iter_words_with_speakers(conn, episode_id):
+        out.write(json.dumps({"word": word["word"], "start_time": word["start"], "end_time": word["end"], "speaker_id": word["speaker_id"]}) + '\n')
+
+def write_rttm(conn, episode_id, out):
+    cursor = conn.cursor()
+    cursor.execute("SELECT episode_wav_filename FROM transcripts WHERE id = ?", (episode_id,))
+    wav_filename = cursor.fetchone()[0]
+    cursor.execute("SELECT speaker_id, start_time, duration FROM diarization_results WHERE episode_id = ? ORDER BY start_time", (episode_id,))
+    for speaker_id, start_time, duration in cursor:
+        out.write(f"SPEAKER {wav_filename} 1 {start_time} {duration} <NA> <NA> {speaker_id} <NA> <NA>\n")
+
+def iter_captions(conn, episode_id):
+    """
+    Groups the words of an episode into captions, yielding (start, end, speaker ID, text) for each one.
+    """
+    cue = None
+    for word in iter_words_with_speakers(conn, episode_id):
+        if cue is not None and (word['speaker_id'] != cue[2]
+                                or word['end'] - cue[0] > MAX_CUE_DURATION
+                                or word['start'] - cue[1] > MAX_CUE_GAP
+                                or len(cue[3]) + 1 + len(word['word']) > MAX_CUE_CHARS):
+            yield tuple(cue)
+            cue = None
+        if cue is None:
+            cue = [word['start'], word['end'], word['speaker_id'], word['word']]
+        else:
+            cue[1] = word['end']
+            cue[3] += ' ' + word['word']
+    if cue is not None:
+        yield tuple(cue)
+
+def _caption_timestamp(seconds, separator):
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{milliseconds:03d}"
+
+def write_srt(conn, episode_id, out):
+    for number, (start, end, speaker_id, text) in enumerate(iter_captions(conn, episode_id), start=1):
+        out.write(f"{number}\n{_caption_timestamp(start, ',')} --> {_caption_timestamp(end, ',')}\n{speaker_id}: {text}\n\n")
+
+def write_vtt(conn, episode_id, out):
+    out.write("WEBVTT\n\n")
+    for start, end, speaker_id, text in iter_captions(conn, episode_id):
+        out.write(f"{_caption_timestamp(start, '.')} --> {_caption_timestamp(end, '.')}\n<v {speaker_id}>{text}\n\n")
+
+WRITERS = {
+    'json': write_json,
+    'ndjson': write_ndjson,
+    'rttm': write_rttm,
+    'srt': write_srt,
+    'vtt': write_vtt,
+}
+
+def export_episode(conn, episode_id, export_format, out):
+    """
+    Writes the results of one episode to out in the given format, one record at a time.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite database connection.
+        episode_id (int): The ID of the episode in the database.
+        export_format (str): One of FORMATS.
+        out (file): The text stream to write to.
+    """
+    WRITERS[export_format](conn, episode_id, out)
+
+def export_podcast(conn, export_format, output_dir):
+    """
+    Exports every transcribed episode of a podcast to its own file in output_dir, one episode at a time.
+
+    Returns:
+        int: The number of episodes exported.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    episodes = conn.cursor()
+    episodes.execute("SELECT id, episode_title FROM transcripts ORDER BY id")
+    count = 0
+    for episode_id, episode_title in episodes:
+        safe_title = re.sub(r'\W+', '_', episode_title or '').strip('_')
+        filename = os.path.join(output_dir, f"{episode_id}_{safe_title}.{export_format}")
+        with open(filename, 'w', encoding='utf-8') as out:
+            export_episode(conn, episode_id, export_format, out)
+        count += 1
+    return count
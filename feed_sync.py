@@ -0,0 +1,165 @@
+import os
+import re
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+# Stages recorded in episode_stages as an episode is processed
+SPEECH_REGIONS_STAGE = 'speech_regions'
+TRANSCRIPTION_STAGE = 'transcription'
+DIARIZATION_STAGE = 'diarization'
+TRANSCRIPT_STAGE = 'transcript'
+UPLOAD_STAGE = 'upload'
+
+def read_feed(rss_file_or_url, cache_dir=os.path.join(".", ".feed_cache")):
+    """
+    Reads an RSS feed from a file, or from a URL through the conditional-GET feed cache.
+
+    Returns:
+        str: The XML of the feed.
+    """
+    if urlparse(rss_file_or_url).scheme in ('http', 'https'):
+        from download import fetch_feed
+        return fetch_feed(rss_file_or_url, cache_dir)
+    with open(rss_file_or_url, 'r') as f:
+        return f.read()
+
+def read_feed_list(path):
+    """
+    Reads the feeds listed in an OPML file (the xmlUrl of every outline), or in a text file with one feed URL
+    or path per line, where blank lines and lines starting with # are ignored.
+    """
+    with open(path) as f:
+        content = f.read()
+    if content.lstrip().startswith('<'):
+        from bs4 import BeautifulSoup
+        return [outline['xmlUrl'].strip() for outline in BeautifulSoup(content, 'xml').find_all('outline') if outline.get('xmlUrl')]
+    return [line.strip() for line in content.splitlines() if line.strip() and not line.lstrip().startswith('#')]
+
+def podcast_dir_for(soup, root="."):
+    """
+    Returns the directory a podcast's downloads and transcripts.db are kept in, named after the feed's title.
+    """
+    podcast_title = soup.find('title').text.strip()
+    return os.path.join(root, re.sub(r'\W+', '_', podcast_title))
+
+def episode_key(item):
+    """
+    Identifies an episode by its RSS <guid>, or by its enclosure URL if the feed has no guids.
+    """
+    guid = item.find('guid')
+    if guid is not None and guid.text.strip():
+        return guid.text.strip()
+    enclosure = item.find('enclosure')
+    return enclosure['url'] if enclosure is not None else None
+
+def mark_stage_complete(conn, episode_id, stage):
+    """
+    Records that a stage has finished for the episode. The caller is responsible for committing.
+    """
+    conn.execute("INSERT OR REPLACE INTO episode_stages (episode_id, stage, completed_at) VALUES (?, ?, ?)",
+                 (episode_id, stage, datetime.now(timezone.utc).isoformat(timespec='seconds')))
+
+def clear_stages(conn, episode_id, stages=None):
+    """
+    Forgets the completion of the given stages (all stages by default), so the episode is processed again.
+    The caller is responsible for committing.
+    """
+    if stages is None:
+        conn.execute("DELETE FROM episode_stages WHERE episode_id = ?", (episode_id,))
+    else:
+        conn.executemany("DELETE FROM episode_stages WHERE episode_id = ? AND stage = ?", [(episode_id, stage) for stage in stages])
+
+def completed_stages(conn, episode_id):
+    return {row[0] for row in conn.execute("SELECT stage FROM episode_stages WHERE episode_id = ?", (episode_id,))}
+
+def _adopt_legacy_episodes(conn, items_by_key):
+    """
+    Links episodes stored before episodes were keyed by guid to their feed items by title and date,
+    and records the transcript stage of the ones that already have a transcript.
+    """
+    legacy = {}
+    for episode_id, title, date, transcript in conn.execute(
+            "SELECT id, episode_title, episode_date, transcript FROM transcripts WHERE episode_guid IS NULL"):
+        legacy[(title, date)] = (episode_id, transcript)
+    if not legacy:
+        return
+
+    with conn:
+        for key, item in items_by_key.items():
+            match = legacy.get((item.find('title').text.strip(), item.find('pubDate').text.strip()))
+            if match is None:
+                continue
+            episode_id, transcript = match
+            enclosure = item.find('enclosure')
+            conn.execute("UPDATE transcripts SET episode_guid = ?, enclosure_url = ? WHERE id = ?",
+                         (key, enclosure['url'] if enclosure is not None else None, episode_id))
+            if transcript and transcript.strip():
+                mark_stage_complete(conn, episode_id, TRANSCRIPT_STAGE)
+
+def _changed_episode_keys(conn, stage_fingerprints):
+    """
+    Returns the keys of the episodes whose stored stage fingerprints differ from the current ones.
+    """
+    from fingerprints import changed_stages
+
+    stored_by_episode = {}
+    for key, audio_sha256, stage, fingerprint in conn.execute("""
+        SELECT t.episode_guid, t.audio_sha256, f.stage, f.fingerprint
+        FROM transcripts t
+        JOIN stage_fingerprints f ON f.episode_id = t.id
+        WHERE t.episode_guid IS NOT NULL AND t.audio_sha256 IS NOT NULL
+    """):
+        stored_by_episode.setdefault((key, audio_sha256), {})[stage] = fingerprint
+
+    fingerprints_by_audio = {}
+    changed = set()
+    for (key, audio_sha256), stored in stored_by_episode.items():
+        if audio_sha256 not in fingerprints_by_audio:
+            fingerprints_by_audio[audio_sha256] = stage_fingerprints(audio_sha256)
+        if changed_stages(stored, fingerprints_by_audio[audio_sha256]):
+            changed.add(key)
+    return changed
+
+def plan_feed_sync(conn, items, upload_to_google_drive=False, stage_fingerprints=None):
+    """
+    Diffs the feed against the episodes already in the database and returns only the items that still need work.
+
+    An episode is finished once its transcript has been written and, when uploading, once it has been
+    uploaded, and no input of its stages has changed since. Finished episodes are skipped before anything
+    is downloaded or converted, so syncing a feed with no new episodes only costs a couple of queries.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite database connection.
+        items (list): The <item> tags of the feed.
+        upload_to_google_drive (bool, optional): Whether the episodes should also be uploaded to google.
+        stage_fingerprints (callable, optional): Returns the current stage fingerprints of an episode given the
+            SHA-256 of its audio, see fingerprints.options_fingerprints. Finished episodes whose stored
+            fingerprints differ are returned too.
+
+    Returns:
+        list: The items of new or incomplete episodes, in feed order.
+    """
+    required_stages = {TRANSCRIPT_STAGE, UPLOAD_STAGE} if upload_to_google_drive else {TRANSCRIPT_STAGE}
+    items_by_key = {}
+    for item in items:
+        key = episode_key(item)
+        if key is not None:
+            items_by_key.setdefault(key, item)
+
+    _adopt_legacy_episodes(conn, items_by_key)
+
+    stages_by_key = {}
+    for key, stage in conn.execute("""
+        SELECT t.episode_guid, s.stage
+        FROM transcripts t
+        JOIN episode_stages s ON s.episode_id = t.id
+        WHERE t.episode_guid IS NOT NULL
+    """):
+        stages_by_key.setdefault(key, set()).add(stage)
+
+    pending_keys = {key for key in items_by_key if not required_stages <= stages_by_key.get(key, set())}
+    if stage_fingerprints is not None:
+        pending_keys |= _changed_episode_keys(conn, stage_fingerprints)
+    pending = [item for key, item in items_by_key.items() if key in pending_keys]
+    print(f'{len(items_by_key) - len(pending)} of {len(items_by_key)} episodes are already finished, {len(pending)} to process')
+    return pending
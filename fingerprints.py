@@ -0,0 +1,128 @@
+import hashlib
+import json
+from feed_sync import clear_stages, SPEECH_REGIONS_STAGE, TRANSCRIPTION_STAGE, DIARIZATION_STAGE, TRANSCRIPT_STAGE, UPLOAD_STAGE
+
+# The stages whose outputs are fingerprinted, in processing order
+FINGERPRINTED_STAGES = [SPEECH_REGIONS_STAGE, TRANSCRIPTION_STAGE, DIARIZATION_STAGE, TRANSCRIPT_STAGE]
+
+# The tables holding the outputs of every stage. A stage missing here only writes columns of transcripts
+# that its next run overwrites.
+STAGE_OUTPUTS = {
+    SPEECH_REGIONS_STAGE: ['speech_regions'],
+    TRANSCRIPTION_STAGE: ['transcription_results', 'transcription_progress', 'episode_words'],
+    DIARIZATION_STAGE: ['diarization_results'],
+}
+
+# The stages that are done again, without a fingerprint of their own, when a stage they depend on changes
+DEPENDENT_STAGES = {
+    TRANSCRIPT_STAGE: [UPLOAD_STAGE],
+}
+
+def _fingerprint(inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+def stage_fingerprints(audio_sha256, models, speech_detection=None, num_speakers=None, min_speakers=None, max_speakers=None,
+                       diarization_window=None):
+    """
+    Fingerprints the inputs of every stage of an episode: the audio, the model versions and the parameters
+    the stage runs with. A stage's inputs include the fingerprints of the stages whose outputs it reads,
+    so a change to one stage also changes the fingerprints of every stage downstream of it.
+
+    Args:
+        audio_sha256 (str): The SHA-256 of the episode's audio.
+        models (models.ModelRegistry): The registry providing the model versions. No model is loaded.
+        speech_detection (str, optional): The speech detection method, see speech_activity.DETECTION_METHODS.
+        num_speakers (int, optional): Number of speakers in the audio (if known).
+        min_speakers (int, optional): Minimum number of speakers in the audio.
+        max_speakers (int, optional): Maximum number of speakers in the audio.
+        diarization_window (float, optional): The length of the diarization windows in seconds, if diarizing in windows.
+
+    Returns:
+        dict: The fingerprint of every stage in FINGERPRINTED_STAGES.
+    """
+    # Imported here so reading this module doesn't pull in numpy for the read-only commands
+    from speech_activity import PYANNOTE_DETECTION
+
+    fingerprints = {}
+    fingerprints[SPEECH_REGIONS_STAGE] = _fingerprint({
+        'audio': audio_sha256,
+        'method': speech_detection,
+        'model': models.speech_activity_version if speech_detection == PYANNOTE_DETECTION else None,
+    })
+    fingerprints[TRANSCRIPTION_STAGE] = _fingerprint({
+        'audio': audio_sha256,
+        'model': models.recognizer_version,
+        'speech_regions': fingerprints[SPEECH_REGIONS_STAGE],
+    })
+    diarization_inputs = {
+        'audio': audio_sha256,
+        'model': models.diarization_version,
+        'num_speakers': num_speakers,
+        'min_speakers': min_speakers,
+        'max_speakers': max_speakers,
+        'speech_regions': fingerprints[SPEECH_REGIONS_STAGE],
+    }
+    if diarization_window:
+        # Only added when used, so the fingerprints of episodes diarized whole stay the same
+        diarization_inputs.update(window=diarization_window, embedding_model=models.speaker_embedding_version)
+    fingerprints[DIARIZATION_STAGE] = _fingerprint(diarization_inputs)
+    fingerprints[TRANSCRIPT_STAGE] = _fingerprint({
+        'model': models.punctuator_version,
+        'transcription': fingerprints[TRANSCRIPTION_STAGE],
+        'diarization': fingerprints[DIARIZATION_STAGE],
+    })
+    return fingerprints
+
+def options_fingerprints(models, episode_options):
+    """
+    Returns a function computing the stage_fingerprints of an episode's audio for the given process_episode options.
+    """
+    return lambda audio_sha256: stage_fingerprints(
+        audio_sha256,
+        models,
+        speech_detection=episode_options.get('speech_detection'),
+        num_speakers=episode_options.get('num_speakers'),
+        min_speakers=episode_options.get('min_speakers'),
+        max_speakers=episode_options.get('max_speakers'),
+        diarization_window=episode_options.get('diarization_window'),
+    )
+
+def load_stage_fingerprints(conn, episode_id):
+    return dict(conn.execute("SELECT stage, fingerprint FROM stage_fingerprints WHERE episode_id = ?", (episode_id,)))
+
+def changed_stages(stored, fingerprints):
+    """
+    Returns the stages whose stored fingerprint differs from the current one, in processing order. Stages
+    without a stored fingerprint, such as those of episodes processed before stages were fingerprinted,
+    count as unchanged.
+    """
+    return [stage for stage in FINGERPRINTED_STAGES if stored.get(stage, fingerprints[stage]) != fingerprints[stage]]
+
+def discard_stage_outputs(conn, episode_id, stages):
+    """
+    Deletes the outputs of the given stages and of the stages that depend on them, and forgets that they
+    completed, so they're computed again. The caller is responsible for committing.
+    """
+    stages = list(stages) + [dependent for stage in stages for dependent in DEPENDENT_STAGES.get(stage, [])]
+    for stage in stages:
+        for table in STAGE_OUTPUTS.get(stage, []):
+            conn.execute(f"DELETE FROM {table} WHERE episode_id = ?", (episode_id,))
+    clear_stages(conn, episode_id, stages)
+
+def update_stage_fingerprints(conn, episode_id, fingerprints):
+    """
+    Discards the outputs of the stages whose inputs changed since they were computed and records the
+    current fingerprints, in one transaction. Outputs that are kept, including partial ones such as
+    transcription checkpoints, always match the recorded fingerprints.
+
+    Returns:
+        list: The stages whose outputs were discarded.
+    """
+    with conn:
+        changed = changed_stages(load_stage_fingerprints(conn, episode_id), fingerprints)
+        if changed:
+            print(f"The inputs of {', '.join(changed)} changed for episode {episode_id}, computing them again")
+            discard_stage_outputs(conn, episode_id, changed)
+        conn.executemany("INSERT OR REPLACE INTO stage_fingerprints (episode_id, stage, fingerprint) VALUES (?, ?, ?)",
+                         [(episode_id, stage, fingerprint) for stage, fingerprint in fingerprints.items()])
+    return changed
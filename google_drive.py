@@ -1,67 +1,306 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
 from config import GOOGLE_ACCESS_TOKEN_JSON_PATH, GOOGLE_DOC_WRITER_EMAIL
+from feed_sync import mark_stage_complete, UPLOAD_STAGE
+from google.auth.exceptions import TransportError
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from httplib2 import HttpLib2Error
 
-def upload_to_google(db_conn, episode_id, title, overwrite):
-    try:
-        cursor = db_conn.cursor()
-        cursor.execute("SELECT transcript, doc_link FROM transcripts WHERE id = ?", (episode_id,))
-        transcript_data = cursor.fetchone()
-        if not transcript_data:
-            print("Transcript not found in database.")
-            return None
-        transcript, existing_doc_link = transcript_data
+SCOPES = ['https://www.googleapis.com/auth/documents', 'https://www.googleapis.com/auth/drive']
 
-        creds = service_account.Credentials.from_service_account_file(GOOGLE_ACCESS_TOKEN_JSON_PATH)
-        scoped_creds = creds.with_scopes(['https://www.googleapis.com/auth/documents', 'https://www.googleapis.com/auth/drive'])
+# Status codes worth retrying: rate limiting and server errors
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
 
-        docs_service = build('docs', 'v1', credentials=scoped_creds)
+# Errors of the connection rather than of the request, such as timeouts, resets and failed token
+# refreshes (socket.timeout and ConnectionError are OSErrors). They aren't retried in place, since a
+# write may have gone through before the connection failed, and are left to --retry_uploads.
+TRANSPORT_ERRORS = (OSError, TransportError, HttpLib2Error)
 
-        if existing_doc_link and overwrite:
-            document_id = existing_doc_link.split('/')[-1]
-        else:
-            body = {
-                'title': title
-            }
-            doc = docs_service.documents().create(body=body).execute()
-            document_id = doc['documentId']
+class RateLimiter:
+    """
+    Spaces out API requests from all threads so that at most requests_per_second are started per second.
+    """
 
-        requests = [
-            {
-                'insertText': {
-                    'location': {
-                        'index': 1
-                    },
-                    'text': transcript
+    def __init__(self, requests_per_second):
+        self._interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self._interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+class GoogleUploader:
+    """
+    Uploads transcripts to Google Docs, sharing one set of credentials and rate limit across all uploads.
+
+    The docs and drive clients are built once per thread, since the underlying HTTP client isn't
+    thread-safe, and reused for every later upload on that thread. Requests that fail with a
+    retryable status are retried with exponential backoff and jitter.
+
+    Args:
+        credentials (google.auth.credentials.Credentials, optional): Defaults to the service account in GOOGLE_ACCESS_TOKEN_JSON_PATH.
+        requests_per_second (float, optional): Maximum rate of API requests across all threads. Defaults to 5.
+        max_retries (int, optional): Number of retries of a failing request. Defaults to 5.
+        client_options (dict, optional): Passed to the discovery clients, e.g. {'api_endpoint': ...} to use another server.
+        discovery_service_url (str, optional): Where to fetch the discovery documents from, for testing against a fake server.
+    """
+
+    def __init__(self, credentials=None, requests_per_second=5, max_retries=5, client_options=None, discovery_service_url=None):
+        if credentials is None:
+            credentials = service_account.Credentials.from_service_account_file(GOOGLE_ACCESS_TOKEN_JSON_PATH).with_scopes(SCOPES)
+        self._credentials = credentials
+        self._rate_limiter = RateLimiter(requests_per_second)
+        self._max_retries = max_retries
+        self._build_options = {'credentials': credentials, 'client_options': client_options}
+        if discovery_service_url:
+            self._build_options['discoveryServiceUrl'] = discovery_service_url
+        self._local = threading.local()
+
+    def _service(self, name, version):
+        services = getattr(self._local, 'services', None)
+        if services is None:
+            services = self._local.services = {}
+        if name not in services:
+            services[name] = build(name, version, cache_discovery=False, **self._build_options)
+        return services[name]
+
+    def _backoff(self, attempt):
+        time.sleep(min(2 ** attempt, 64) + random.random())
+
+    def _execute(self, request, idempotent=True):
+        # A server error may come after a request that isn't idempotent went through, so those are only
+        # retried when they were rate limited, which the server does before acting on the request
+        retryable = RETRYABLE_STATUS_CODES if idempotent else {429}
+        for attempt in range(self._max_retries + 1):
+            self._rate_limiter.wait()
+            try:
+                return request.execute()
+            except HttpError as error:
+                if error.resp.status not in retryable or attempt == self._max_retries:
+                    raise
+                print(f"Google API returned {error.resp.status}, retrying")
+                self._backoff(attempt)
+
+    def _grant_permissions(self, drive_service, document_id, permissions):
+        """
+        Creates several permissions on a document with one batch request, retrying the ones that fail with a retryable status.
+        """
+        pending = dict(enumerate(permissions))
+        for attempt in range(self._max_retries + 1):
+            errors = {}
+
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    errors[int(request_id)] = exception
+
+            batch = drive_service.new_batch_http_request(callback=callback)
+            for request_id, permission in pending.items():
+                batch.add(drive_service.permissions().create(fileId=document_id, body=permission), request_id=str(request_id))
+            self._execute(batch)
+
+            retryable = {request_id: error for request_id, error in errors.items()
+                         if isinstance(error, HttpError) and error.resp.status in RETRYABLE_STATUS_CODES}
+            fatal = set(errors) - set(retryable)
+            if fatal:
+                raise errors[min(fatal)]
+            if not retryable:
+                return
+            if attempt == self._max_retries:
+                raise retryable[min(retryable)]
+            pending = {request_id: pending[request_id] for request_id in retryable}
+            self._backoff(attempt)
+
+    def _replace_body(self, docs_service, document_id, text, empty=False):
+        """
+        Replaces the whole body of a document with text in one batch update. Documents known to be empty aren't read first.
+        """
+        end_index = 1
+        if not empty:
+            document = self._execute(docs_service.documents().get(documentId=document_id, fields='body(content(endIndex))'))
+            # The body always ends with a newline that can't be deleted
+            end_index = document['body']['content'][-1]['endIndex'] - 1
+        requests = []
+        if end_index > 1:
+            requests.append({
+                'deleteContentRange': {
+                    'range': {
+                        'startIndex': 1,
+                        'endIndex': end_index
+                    }
                 }
+            })
+        requests.append({
+            'insertText': {
+                'location': {
+                    'index': 1
+                },
+                'text': text
             }
-        ]
-        docs_service.documents().batchUpdate(documentId=document_id, body={'requests': requests}).execute()
+        })
+        self._execute(docs_service.documents().batchUpdate(documentId=document_id, body={'requests': requests}))
 
-        drive_service = build('drive', 'v3', credentials=scoped_creds)
+    def _share(self, document_id):
+        self._grant_permissions(self._service('drive', 'v3'), document_id, [
+            # Grant writer access to your email address
+            {
+                'role': 'writer',
+                'type': 'user',
+                'emailAddress': GOOGLE_DOC_WRITER_EMAIL
+            },
+            # Grant reader access to anyone with the link
+            {
+                'role': 'reader',
+                'type': 'anyone'
+            },
+        ])
 
-        # Grant writer access to your email address
-        writer_permissions = {
-            'role': 'writer',
-            'type': 'user',
-            'emailAddress': GOOGLE_DOC_WRITER_EMAIL
-        }
-        drive_service.permissions().create(fileId=document_id, body=writer_permissions).execute()
+    def upload(self, title, transcript, existing_doc_link=None, shared=True, on_create=None):
+        """
+        Uploads a transcript to a Google Doc and shares it.
 
-        # Grant reader access to anyone with the link
-        reader_permissions = {
-            'role': 'reader',
-            'type': 'anyone'
-        }
-        drive_service.permissions().create(fileId=document_id, body=reader_permissions).execute()
+        The document of an earlier upload has its text replaced, so its link stays the same. A new document
+        is created and shared if there's no earlier upload or its document has been deleted.
 
+        Args:
+            title (str): The title of a new document.
+            transcript (str): The text of the document.
+            existing_doc_link (str, optional): The link to the document of an earlier upload.
+            shared (bool, optional): Whether the existing document was shared, which an upload that failed
+                part way may not have done. Defaults to True.
+            on_create (callable, optional): Called with the link to a new document as soon as it's created,
+                so that an upload failing after that can be resumed without creating another document.
+
+        Returns:
+            str: The link to the document.
+        """
+        docs_service = self._service('docs', 'v1')
+
+        if existing_doc_link:
+            document_id = existing_doc_link.split('/')[-1]
+            try:
+                self._replace_body(docs_service, document_id, transcript)
+            except HttpError as error:
+                if error.resp.status != 404:
+                    raise
+                print(f"{existing_doc_link} no longer exists, creating a new document")
+            else:
+                if not shared:
+                    self._share(document_id)
+                return existing_doc_link
+
+        body = {
+            'title': title
+        }
+        doc = self._execute(docs_service.documents().create(body=body), idempotent=False)
+        document_id = doc['documentId']
         doc_link = f"https://docs.google.com/document/d/{document_id}"
-        print(f"Transcript uploaded to Google Docs: {doc_link}")
+        if on_create is not None:
+            on_create(doc_link)
+        self._replace_body(docs_service, document_id, transcript, empty=True)
+        self._share(document_id)
+        return doc_link
+
+_uploader = None
+_uploader_lock = threading.Lock()
+
+def configure_uploader(**options):
+    """
+    Replaces the uploader shared by every upload in this process with one created from the given
+    GoogleUploader options, e.g. requests_per_second.
+    """
+    global _uploader
+    with _uploader_lock:
+        _uploader = GoogleUploader(**options)
+
+def get_uploader():
+    """
+    Returns the uploader shared by every upload in this process, creating it on first use.
+    """
+    global _uploader
+    with _uploader_lock:
+        if _uploader is None:
+            _uploader = GoogleUploader()
+    return _uploader
+
+def record_upload_failure(db_conn, episode_id, error):
+    db_conn.execute("""
+        INSERT INTO upload_failures (episode_id, error, failed_at, attempts) VALUES (?, ?, ?, 1)
+        ON CONFLICT (episode_id) DO UPDATE SET error = excluded.error, failed_at = excluded.failed_at, attempts = attempts + 1
+    """, (episode_id, str(error), datetime.now(timezone.utc).isoformat(timespec='seconds')))
+    db_conn.commit()
+
+def upload_to_google(db_conn, episode_id, title, uploader=None):
+    cursor = db_conn.cursor()
+    cursor.execute("SELECT transcript, doc_link FROM transcripts WHERE id = ?", (episode_id,))
+    transcript_data = cursor.fetchone()
+    if not transcript_data:
+        print("Transcript not found in database.")
+        return None
+    transcript, existing_doc_link = transcript_data
+    # An upload that failed may have stopped between creating the document and sharing it
+    failed_before = cursor.execute("SELECT 1 FROM upload_failures WHERE episode_id = ?", (episode_id,)).fetchone() is not None
 
-        cursor.execute("UPDATE transcripts SET doc_link = ? WHERE id = ?", (doc_link, episode_id))
+    def save_doc_link(doc_link):
+        db_conn.execute("UPDATE transcripts SET doc_link = ? WHERE id = ?", (doc_link, episode_id))
         db_conn.commit()
 
-    except HttpError as error:
-        print(f"An error occurred: {error}")
+    try:
+        doc_link = (uploader or get_uploader()).upload(title, transcript, existing_doc_link, not failed_before, save_doc_link)
+    except (HttpError,) + TRANSPORT_ERRORS as error:
+        # Recorded so --retry_uploads replays it
+        print(f"An error occurred: {error!r}")
+        record_upload_failure(db_conn, episode_id, error)
         return None
+
+    print(f"Transcript uploaded to Google Docs: {doc_link}")
+
+    cursor.execute("UPDATE transcripts SET doc_link = ? WHERE id = ?", (doc_link, episode_id))
+    cursor.execute("DELETE FROM upload_failures WHERE episode_id = ?", (episode_id,))
+    mark_stage_complete(db_conn, episode_id, UPLOAD_STAGE)
+    db_conn.commit()
+    return doc_link
+
+def retry_failed_uploads(database_path, max_concurrent=4):
+    """
+    Replays the uploads recorded in upload_failures, several at a time.
+
+    Args:
+        database_path (str): Path to the podcast's transcripts.db file.
+        max_concurrent (int, optional): Number of uploads running at once. Defaults to 4.
+
+    Returns:
+        int: The number of uploads that still failed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from database import connect_database
+
+    conn = connect_database(database_path)
+    episodes = conn.execute("""
+        SELECT f.episode_id, t.episode_title
+        FROM upload_failures f
+        JOIN transcripts t ON t.id = f.episode_id
+        ORDER BY f.failed_at
+    """).fetchall()
+    conn.close()
+    print(f"Retrying {len(episodes)} failed upload(s)")
+
+    local = threading.local()
+
+    def retry(episode):
+        # sqlite3 connections can't be shared between threads
+        if not hasattr(local, 'conn'):
+            local.conn = connect_database(database_path)
+        return upload_to_google(local.conn, episode[0], episode[1])
+
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        results = list(executor.map(retry, episodes))
+    return sum(1 for doc_link in results if doc_link is None)
@@ -0,0 +1,205 @@
+import json
+import os
+import socket
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+# Kinds of jobs, see service.py for how each is run
+EPISODE_JOB = 'episode'
+WAV_JOB = 'wav'
+
+# Priority of the jobs found by polling feeds, jobs enqueued by hand default to a higher one
+POLL_PRIORITY = 0
+MANUAL_PRIORITY = 10
+
+# Delay before the first retry of a failed job in seconds, doubled for every further attempt
+RETRY_DELAY = 60
+
+def _now():
+    return time.time()
+
+def _timestamp():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+def connect_queue(queue_path, busy_timeout=60):
+    """
+    Opens the job queue database, creating it if needed. The queue is shared by every podcast, so it lives
+    in its own database rather than in any podcast's transcripts.db.
+    """
+    conn = sqlite3.connect(queue_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout * 1000)}")
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                dedupe_key TEXT,
+                priority INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL DEFAULT 3,
+                run_after REAL NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires_at REAL,
+                last_error TEXT,
+                result TEXT,
+                created_at TEXT NOT NULL,
+                finished_at TEXT
+            )
+        """)
+        # Queues created before jobs had results
+        if 'result' not in {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}:
+            conn.execute("ALTER TABLE jobs ADD COLUMN result TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (status, priority DESC, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_dedupe_key ON jobs (dedupe_key)")
+    return conn
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def enqueue_job(conn, kind, payload, priority=POLL_PRIORITY, dedupe_key=None, max_attempts=3, retry_failed=False):
+    """
+    Adds a job to the queue, unless a job with the same dedupe_key is already queued or running.
+
+    Jobs that failed for good also block new jobs with the same dedupe_key unless retry_failed is set,
+    so polling a feed doesn't retry a broken episode forever.
+
+    Returns:
+        int: The ID of the new job, or None if it was a duplicate.
+    """
+    blocking = ('queued', 'running', 'failed') if not retry_failed else ('queued', 'running')
+    with conn:
+        if dedupe_key is not None:
+            placeholders = ', '.join('?' * len(blocking))
+            if conn.execute(f"SELECT 1 FROM jobs WHERE dedupe_key = ? AND status IN ({placeholders})", (dedupe_key,) + blocking).fetchone():
+                return None
+            if retry_failed:
+                # The new job replaces the failed one
+                conn.execute("UPDATE jobs SET status = 'superseded' WHERE dedupe_key = ? AND status = 'failed'", (dedupe_key,))
+        cursor = conn.execute("""
+            INSERT INTO jobs (kind, payload, dedupe_key, priority, max_attempts, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (kind, json.dumps(payload), dedupe_key, priority, max_attempts, _timestamp()))
+    return cursor.lastrowid
+
+def claim_job(conn, owner, lease_seconds):
+    """
+    Leases the next job to run: the queued job with the highest priority, oldest first, or a job whose
+    previous lease expired because its worker died.
+
+    Returns:
+        tuple: The ID, kind, payload and attempt number of the job, or None if there's nothing to run.
+    """
+    now = _now()
+    # BEGIN IMMEDIATE takes the write lock up front, so two workers can't claim the same job
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # A job whose worker keeps dying, e.g. because it runs out of memory, isn't retried forever
+        conn.execute("""
+            UPDATE jobs SET status = 'failed', lease_owner = NULL, lease_expires_at = NULL, finished_at = ?,
+                            last_error = 'The worker stopped while running the job'
+            WHERE status = 'running' AND lease_expires_at < ? AND attempts >= max_attempts
+        """, (_timestamp(), now))
+        row = conn.execute("""
+            SELECT id, kind, payload, attempts FROM jobs
+            WHERE (status = 'queued' AND run_after <= ?) OR (status = 'running' AND lease_expires_at < ?)
+            ORDER BY priority DESC, id
+            LIMIT 1
+        """, (now, now)).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute("""
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_owner = ?, lease_expires_at = ?
+            WHERE id = ?
+        """, (owner, now + lease_seconds, row[0]))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return row[0], row[1], json.loads(row[2]), row[3] + 1
+
+def renew_lease(conn, job_id, owner, lease_seconds):
+    """
+    Extends the lease of a running job.
+
+    Returns:
+        bool: False if the job is no longer leased to owner.
+    """
+    with conn:
+        cursor = conn.execute("UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                              (_now() + lease_seconds, job_id, owner))
+    return cursor.rowcount == 1
+
+def update_payload(conn, job_id, owner, payload):
+    """
+    Replaces the payload of a running job, which the next attempts of the job run with.
+    """
+    with conn:
+        conn.execute("UPDATE jobs SET payload = ? WHERE id = ? AND lease_owner = ?", (json.dumps(payload), job_id, owner))
+
+def complete_job(conn, job_id, owner, result=None):
+    """
+    Marks a job as done, recording where its result can be found if it has one that isn't stored elsewhere.
+    """
+    with conn:
+        conn.execute("""
+            UPDATE jobs SET status = 'done', lease_owner = NULL, lease_expires_at = NULL, last_error = NULL, result = ?, finished_at = ?
+            WHERE id = ? AND lease_owner = ?
+        """, (result, _timestamp(), job_id, owner))
+
+def fail_job(conn, job_id, owner, error):
+    """
+    Records a failed attempt. The job is queued again after an exponential backoff, or marked as failed
+    once it has used up its attempts.
+    """
+    with conn:
+        row = conn.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ? AND lease_owner = ?", (job_id, owner)).fetchone()
+        if row is None:
+            return
+        attempts, max_attempts = row
+        if attempts >= max_attempts:
+            conn.execute("""
+                UPDATE jobs SET status = 'failed', lease_owner = NULL, lease_expires_at = NULL, last_error = ?, finished_at = ?
+                WHERE id = ?
+            """, (error, _timestamp(), job_id))
+        else:
+            conn.execute("""
+                UPDATE jobs SET status = 'queued', lease_owner = NULL, lease_expires_at = NULL, last_error = ?, run_after = ?
+                WHERE id = ?
+            """, (error, _now() + RETRY_DELAY * 2 ** (attempts - 1), job_id))
+
+def list_jobs(conn, statuses=None, limit=50):
+    """
+    Returns the most recent jobs, optionally only those with the given statuses.
+
+    Returns:
+        list: (id, kind, payload, priority, status, attempts, max_attempts, last_error, result, created_at) tuples, newest first.
+    """
+    query = "SELECT id, kind, payload, priority, status, attempts, max_attempts, last_error, result, created_at FROM jobs"
+    parameters = []
+    if statuses:
+        query += f" WHERE status IN ({', '.join('?' * len(statuses))})"
+        parameters.extend(statuses)
+    query += " ORDER BY id DESC LIMIT ?"
+    parameters.append(limit)
+    return [row[:2] + (json.loads(row[2]),) + row[3:] for row in conn.execute(query, parameters)]
+
+def print_jobs(conn, limit=50):
+    counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+    if not counts:
+        print("The job queue is empty.")
+        return
+    print(', '.join(f'{count} {status}' for status, count in sorted(counts.items())))
+    for job_id, kind, payload, priority, status, attempts, max_attempts, last_error, result, created_at in list_jobs(conn, limit=limit):
+        description = payload.get('title') or payload.get('wav_file') or ''
+        line = f"{job_id:6d} {status:10} {kind:8} p{priority:<3} {attempts}/{max_attempts} {created_at} {description}"
+        if last_error and status != 'done':
+            line += f"  ({last_error.splitlines()[-1][:80]})"
+        elif result and status == 'done':
+            line += f" -> {result}"
+        print(line)
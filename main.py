@@ -1,26 +1,18 @@
 import os
 import argparse
-import re
-import requests
 import sys
-from bs4 import BeautifulSoup
-from punctuator import Punctuator
-from urllib.parse import urlparse
-from vosk import Model, KaldiRecognizer
-from config import VOSK_MODEL_PATH, FRAME_RATE, PUNCTUATOR_MODEL_PATH
 from database import create_database
-from output import print_google_doc_urls, print_diarization_as_rttm, print_transcription_as_json, print_episode_transcript
-from audio_processing import process_episode, transcribe_wav_file
+from export import FORMATS as EXPORT_FORMATS
+from output import print_google_doc_urls, print_diarization_as_rttm, print_transcription_as_json, print_episode_transcript, print_episode_export
 
 def main(args):
-    model = Model(VOSK_MODEL_PATH)
-    recognizer = KaldiRecognizer(model, FRAME_RATE)
-    recognizer.SetWords(True)
-
-    punctuator = Punctuator(PUNCTUATOR_MODEL_PATH)
-
-    if args.wav_transcribe:
-        transcribe_wav_file(args.wav_transcribe, recognizer, punctuator)
+    # The read-only commands below only query the database, so the model libraries, the
+    # HTTP/XML stack and the Google client are imported further down, on the paths that use them.
+    if args.wav_transcribe and not args.enqueue:
+        from models import ModelRegistry
+        from audio_processing import transcribe_wav_file
+        models = ModelRegistry()
+        transcribe_wav_file(args.wav_transcribe, models.recognizer, models.punctuator)
         return
 
     if args.podcast_dir:
@@ -43,37 +35,166 @@ def main(args):
         print_episode_transcript(conn, args.episode_title)
         return
 
-    parsed_url = urlparse(args.rss_file_or_url)
-    if parsed_url.scheme in ('http', 'https'):
-        response = requests.get(args.rss_file_or_url)
-        response.raise_for_status()
-        rss_content = response.text
-    else:
-        with open(args.rss_file_or_url, 'r') as f:
-            rss_content = f.read()
+    if args.export:
+        if args.episode_title:
+            print_episode_export(conn, args.episode_title, args.export)
+        else:
+            from export import export_podcast
+            output_dir = args.output_dir or os.path.join(podcast_dir, "exports")
+            count = export_podcast(conn, args.export, output_dir)
+            print(f"Exported {count} episode(s) to {output_dir}")
+        return
+
+    if args.search:
+        from search import print_search_results
+        print_search_results(conn, args.search)
+        return
+
+    if args.stats:
+        from metrics import print_stage_stats
+        print_stage_stats(conn, args.episode_title)
+        return
 
-    soup = BeautifulSoup(rss_content, 'xml')
-    podcast_title = soup.find('title').text.strip()
-    podcast_title = re.sub(r'\W+', '_', podcast_title)
+    if args.compact_database:
+        from word_store import pack_all_episode_words
+        print(f"Packed the transcriptions of {pack_all_episode_words(conn)} episode(s)")
+        return
+
+    if args.upload_to_google or args.retry_uploads:
+        from google_drive import configure_uploader
+        configure_uploader(requests_per_second=args.upload_rate)
+
+    if args.retry_uploads:
+        from google_drive import retry_failed_uploads
+        failed = retry_failed_uploads(os.path.join(podcast_dir, "transcripts.db"), args.upload_workers)
+        if failed:
+            print(f"{failed} upload(s) failed again, run --retry_uploads later to try them again")
+        return
 
-    podcast_dir = os.path.join(".", podcast_title)
+    if args.jobs:
+        from jobs import connect_queue, print_jobs
+        print_jobs(connect_queue(args.queue_db))
+        return
+
+    episode_options = dict(num_speakers=args.num_speakers, min_speakers=args.min_speakers, max_speakers=args.max_speakers,
+                           upload_to_google_drive=args.upload_to_google, overwrite=args.overwrite)
+    if args.metrics_file:
+        episode_options['metrics_file'] = os.path.abspath(args.metrics_file)
+    if args.cache_budget is not None:
+        episode_options['cache_budget'] = int(args.cache_budget * 2**30)
+    if args.parallel_asr > 1:
+        if args.stream_audio:
+            print("--parallel_asr needs WAV files, so it is ignored with --stream_audio")
+        elif args.pipeline:
+            print("--parallel_asr is not supported with --pipeline, use --asr_workers instead")
+        else:
+            episode_options['parallel_asr'] = args.parallel_asr
+    if args.stream_audio:
+        if args.pipeline:
+            print("--stream_audio is not supported with --pipeline, converting to WAV files instead")
+        else:
+            episode_options['stream_audio'] = True
+    if args.concurrent_diarization:
+        if args.stream_audio:
+            print("--concurrent_diarization needs the WAV file before transcription, so it is ignored with --stream_audio")
+        elif args.pipeline:
+            print("--concurrent_diarization is not supported with --pipeline, which already overlaps the stages of consecutive episodes")
+        else:
+            episode_options['concurrent_diarization'] = True
+    if args.diarization_window:
+        episode_options['diarization_window'] = args.diarization_window * 60
+        episode_options['window_workers'] = args.window_workers
+    if args.speech_detection:
+        if args.stream_audio and not args.pipeline:
+            print("--speech_detection needs the WAV file before transcription, so it is ignored with --stream_audio")
+        else:
+            episode_options['speech_detection'] = args.speech_detection
+
+    if args.enqueue:
+        from jobs import connect_queue
+        from service import enqueue_feed_episodes, enqueue_wav
+        queue = connect_queue(args.queue_db)
+        if args.wav_transcribe:
+            enqueue_wav(queue, args.wav_transcribe, args.priority)
+            print(f"Enqueued {args.wav_transcribe}")
+        else:
+            enqueued = enqueue_feed_episodes(queue, args.rss_file_or_url, episode_options, args.episode_title, args.priority)
+            print(f"Enqueued {enqueued} episode(s)")
+        return
+
+    if args.serve:
+        from service import serve
+        from feed_sync import read_feed_list
+        feeds = ([args.rss_file_or_url] if args.rss_file_or_url else []) + (read_feed_list(args.feeds) if args.feeds else [])
+        serve(feeds, args.queue_db, episode_options, args.poll_interval * 60, args.serve_workers, args.lease_time * 60, os.path.abspath(args.audio_cache))
+        return
+
+    if args.feeds:
+        from batch import process_feeds
+        from feed_sync import read_feed_list
+        if args.pipeline:
+            print("--pipeline is not supported with --feeds, use --workers to process several episodes at once")
+        feeds = ([args.rss_file_or_url] if args.rss_file_or_url else []) + read_feed_list(args.feeds)
+        failures = process_feeds(feeds, args.audio_cache, args.workers, args.episode_title, download_workers=args.download_workers, **episode_options)
+        if failures:
+            print(f"{len(failures)} episode(s) or feed(s) failed:")
+            for title, error in failures:
+                print(f"{title}: {error}")
+        return
+
+    from bs4 import BeautifulSoup
+    from models import ModelRegistry
+    from audio_processing import process_episode, prefetch_episode_audio, import_legacy_downloads
+    from feed_sync import read_feed, podcast_dir_for, plan_feed_sync
+    from fingerprints import options_fingerprints
+
+    soup = BeautifulSoup(read_feed(args.rss_file_or_url), 'xml')
+    podcast_dir = podcast_dir_for(soup)
     os.makedirs(podcast_dir, exist_ok=True)
 
-    downloads_dir = os.path.join(podcast_dir, "downloads")
+    # Downloaded audio goes to the audio cache shared by every podcast
+    downloads_dir = args.audio_cache
     transcripts_dir = os.path.join(podcast_dir, "transcripts")
-    os.makedirs(downloads_dir, exist_ok=True)
     os.makedirs(transcripts_dir, exist_ok=True)
     conn = create_database(os.path.join(podcast_dir, "transcripts.db"))
     items = soup.find_all('item')
 
-    found = False
-
+    selected_items = []
     for item in items:
         title = item.find('title').text.strip()
         if args.episode_title and args.episode_title.lower() not in title.lower():
             continue
-        found = True
-        process_episode(item, downloads_dir, conn, recognizer, punctuator, args.num_speakers, args.min_speakers, args.max_speakers, args.upload_to_google, args.overwrite)
+        selected_items.append(item)
+    found = bool(selected_items)
+    matching_items = selected_items
+
+    if not args.overwrite:
+        selected_items = plan_feed_sync(conn, selected_items, args.upload_to_google, options_fingerprints(ModelRegistry(), episode_options))
+    import_legacy_downloads(podcast_dir, matching_items, selected_items, downloads_dir, episode_options.get('cache_budget'))
+
+    if args.pipeline:
+        from pipeline import process_episodes_pipelined
+        conn.close()
+        failures = process_episodes_pipelined(selected_items, os.path.join(podcast_dir, "transcripts.db"), downloads_dir, ModelRegistry(),
+                                              download_workers=args.download_workers, asr_workers=args.asr_workers,
+                                              diarization_workers=args.diarization_workers, upload_workers=args.upload_workers,
+                                              max_pending_audio=args.max_pending_audio, **episode_options)
+        for title, stage, error in failures:
+            print(f"{title}: {stage} failed: {error}")
+    elif args.workers > 1 and len(selected_items) > 1:
+        from workers import process_episodes_in_pool
+        conn.close()
+        failures = process_episodes_in_pool(selected_items, os.path.join(podcast_dir, "transcripts.db"), downloads_dir, args.workers,
+                                            args.download_workers, **episode_options)
+        if failures:
+            print(f"{len(failures)} episode(s) failed:")
+            for title, error in failures:
+                print(f"{title}: {error}")
+    else:
+        models = ModelRegistry()
+        # The next episodes download while the current one is processed
+        for item in prefetch_episode_audio(selected_items, downloads_dir, args.download_workers, episode_options.get('cache_budget')):
+            process_episode(item, downloads_dir, conn, models, **episode_options)
 
     if not found and args.episode_title:
         print(f"Episode with keyword '{args.episode_title}' not found")
@@ -87,29 +208,77 @@ if __name__ == '__main__':
     parser.add_argument('-m', '--min_speakers', type=int, default=None, help='Minimum number of speakers to try (default is None)')
     parser.add_argument('-x', '--max_speakers', type=int, default=None, help='Maximum number of speakers to try (default is None)')
     parser.add_argument('-g', '--upload_to_google', action='store_true', help='Enable uploading transcripts to Google Docs (default is False)')
-    parser.add_argument('--overwrite', action='store_true', help='Overwrite existing information in the database.')
+    parser.add_argument('--overwrite', action='store_true', help='Overwrite existing information in the database. Without it, only the stages whose audio, model or parameters changed are run again')
     parser.add_argument('-p', '--print_urls', action='store_true', help='Print Google Doc URLs for all episodes or a specific episode')
     parser.add_argument('--export_diarization', action='store_true', help='Export diarization results to RTTM format')
     parser.add_argument('--export_transcription', action='store_true', help='Export transcription results to JSON format')
     parser.add_argument('--print_transcript', action='store_true', help='Print episode transcript')
+    parser.add_argument('--export', choices=EXPORT_FORMATS, help='Export an episode (with -e) to stdout, or every episode to --output_dir, in the given format')
+    parser.add_argument('--output_dir', help='Directory to export every episode to with --export (default is <podcast_dir>/exports)')
+    parser.add_argument('--search', help='Search the transcripts of all episodes, supports "phrase" and NEAR(word1 word2, N) queries')
+    parser.add_argument('--stats', action='store_true', help='Summarize the time and resources spent in each processing stage, for all episodes or the episode given with -e')
+    parser.add_argument('--metrics_file', help='Also write the stage metrics of every processed episode to this file, as a Prometheus textfile if it ends in .prom or else as JSON lines')
+    parser.add_argument('--compact_database', action='store_true', help='Move transcriptions stored one row per word into packed per-episode storage')
+    parser.add_argument('--retry_uploads', action='store_true', help='Upload the transcripts whose Google Docs upload failed, --upload_workers at a time')
+    parser.add_argument('--upload_rate', type=float, default=5, help='Maximum Google API requests per second across all uploads (default is 5)')
     parser.add_argument('-d', '--podcast_dir', help='Podcast directory to locate the correct transcripts.db file')
     parser.add_argument('-e', '--episode_title', help='Specify the episode title for exporting, printing or processing')
     parser.add_argument('-w', '--wav-transcribe', help='Specify a single wav file to transcribe only')
+    parser.add_argument('--workers', type=int, default=1, help='Number of episodes to process in parallel, each worker loads its own models (default is 1)')
+    parser.add_argument('--audio_cache', default='.audio_cache', help='Directory of the audio cache shared by every podcast (default is .audio_cache)')
+    parser.add_argument('--cache_budget', type=float, help='Disk budget of the audio cache in GB. WAV files and the audio of processed episodes are evicted, least recently used first, to stay within it')
+    parser.add_argument('--stream_audio', action='store_true', help='Stream decoded audio straight into the recognizer instead of transcribing from WAV files')
+    parser.add_argument('--parallel_asr', type=int, default=1, help='Split each episode at quiet points and transcribe the parts on this many processes (default is 1)')
+    parser.add_argument('--concurrent_diarization', action='store_true', help='Diarize each episode on another thread while it is transcribed, both reading the same memory-mapped audio')
+    parser.add_argument('--speech_detection', choices=['energy', 'pyannote'], help='Find the speech in each episode first and only transcribe and diarize that, skipping silence and music. energy is fast, pyannote uses its segmentation model')
+    parser.add_argument('--diarization_window', type=float, help='Diarize each episode in overlapping windows of this many minutes and link the speakers across windows by their voice, so diarization memory stays bounded for very long episodes')
+    parser.add_argument('--window_workers', type=int, default=1, help='Number of --diarization_window windows diarized at once (default is 1)')
+    parser.add_argument('--pipeline', action='store_true', help='Overlap downloading, transcription, diarization and uploading of consecutive episodes')
+    parser.add_argument('--download_workers', type=int, default=2, help='Concurrent downloads and conversions in --pipeline mode, and downloads running ahead of processing otherwise (default is 2)')
+    parser.add_argument('--asr_workers', type=int, default=1, help='Concurrent transcriptions in --pipeline mode (default is 1)')
+    parser.add_argument('--diarization_workers', type=int, default=1, help='Concurrent diarizations in --pipeline mode (default is 1)')
+    parser.add_argument('--upload_workers', type=int, default=1, help='Concurrent Google Docs uploads in --pipeline and --retry_uploads mode (default is 1)')
+    parser.add_argument('--max_pending_audio', type=int, default=2, help='Maximum number of downloaded episodes waiting to be processed in --pipeline mode (default is 2)')
+    parser.add_argument('--serve', action='store_true', help='Keep running with the models loaded, polling the feed (and the --feeds list) and running queued jobs')
+    parser.add_argument('--feeds', help='OPML file, or file listing one RSS feed URL or path per line. Processes the new episodes of every feed in one batch shared by --workers, or polls the feeds in --serve mode')
+    parser.add_argument('--poll_interval', type=float, default=60, help='Minutes between polls of the feeds in --serve mode (default is 60)')
+    parser.add_argument('--serve_workers', type=int, default=1, help='Number of jobs run at once in --serve mode (default is 1)')
+    parser.add_argument('--lease_time', type=float, default=10, help='Minutes a running job is leased for before another worker may take it over if it is not renewed (default is 10)')
+    parser.add_argument('--enqueue', action='store_true', help='Queue the episodes of the feed (filtered with -e, from scratch with --overwrite) or the WAV file given with -w for --serve')
+    parser.add_argument('--priority', type=int, default=10, help='Priority of the jobs queued with --enqueue, higher runs first; polled episodes have priority 0 (default is 10)')
+    parser.add_argument('--jobs', action='store_true', help='Show the job queue')
+    parser.add_argument('--queue_db', default='jobs.db', help='Path to the job queue database used by --serve, --enqueue and --jobs (default is jobs.db)')
     args = parser.parse_args()
 
     if args.num_speakers is not None and (args.min_speakers is not None or args.max_speakers is not None):
         print("Error: You cannot specify both num_speakers and min_speakers/max_speakers. Please choose one approach.")
         sys.exit(1)
 
-    if not (args.print_urls or args.export_diarization or args.export_transcription or args.print_transcript or args.wav_transcribe) and not args.rss_file_or_url:
+    if not (args.print_urls or args.export_diarization or args.export_transcription or args.print_transcript or args.export or args.search or args.stats or args.compact_database or args.retry_uploads or args.wav_transcribe or args.jobs or args.feeds) and not args.rss_file_or_url:
         print("Error: Please provide an RSS file or URL when not using the --print_urls, --export_diarization, --export_transcription, or --print_transcript options.")
         sys.exit(1)
 
+    if args.pipeline and args.workers > 1:
+        print("Error: You cannot use --pipeline together with --workers. Please choose one approach.")
+        sys.exit(1)
+
+    if args.parallel_asr > 1 and args.workers > 1:
+        # Every worker process would start its own pool of parallel_asr processes, each loading Vosk
+        print("Error: You cannot use --parallel_asr together with --workers. Please choose one approach.")
+        sys.exit(1)
+
+    if args.diarization_window:
+        # Only imported when windows are used, since it loads the audio processing modules
+        from windowed_diarization import WINDOW_OVERLAP
+        if args.diarization_window * 60 <= 2 * WINDOW_OVERLAP:
+            print(f"Error: --diarization_window must be longer than {2 * WINDOW_OVERLAP / 60:g} minute(s), twice the overlap of the windows.")
+            sys.exit(1)
+
     if (args.export_diarization or args.export_transcription or args.print_transcript) and not args.episode_title:
         print("Error: Please provide an episode title when using the --print_urls, --export_diarization, --export_transcription, or --print_transcript options.")
         sys.exit(1)
 
-    if (args.print_urls or args.export_diarization or args.export_transcription or args.print_transcript) and not args.podcast_dir:
+    if (args.print_urls or args.export_diarization or args.export_transcription or args.print_transcript or args.export or args.search or args.stats or args.compact_database or args.retry_uploads) and not args.podcast_dir:
         print("Error: Please provide an episode title when using the --print_urls, --export_diarization, --export_transcription, or --print_transcript options.")
         sys.exit(1)
 
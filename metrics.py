@@ -0,0 +1,237 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import wave
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Stages measured while an episode is processed, in processing order
+DOWNLOAD_STAGE = 'download'
+CONVERT_STAGE = 'convert'
+SPEECH_DETECTION_STAGE = 'speech_detection'
+ASR_STAGE = 'asr'
+DIARIZATION_STAGE = 'diarization'
+SPEAKER_ASSIGNMENT_STAGE = 'speaker_assignment'
+PUNCTUATION_STAGE = 'punctuation'
+UPLOAD_STAGE = 'upload'
+
+STAGES = [DOWNLOAD_STAGE, CONVERT_STAGE, SPEECH_DETECTION_STAGE, ASR_STAGE, DIARIZATION_STAGE, SPEAKER_ASSIGNMENT_STAGE, PUNCTUATION_STAGE, UPLOAD_STAGE]
+
+# The episode being processed on each thread, see collecting()
+_local = threading.local()
+
+def _reset_peak_rss():
+    # Linux resets the VmHWM high-water mark of the process when "5" is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _peak_rss():
+    """
+    Returns the peak resident set size of the process in bytes, since the last reset where supported.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS, and is never reset
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _cpu_time():
+    # The CPU time of finished child processes, such as ffmpeg, counts towards the stage that waited for them
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+class EpisodeMetrics:
+    """
+    Collects the measurements of the stages of one episode until they're saved with flush().
+
+    Stages run on the thread the collector is active on, see collecting(). The CPU time and peak RSS
+    are those of the whole process, so they overlap between stages that run at the same time, such as
+    in --pipeline mode.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def flush(self, conn, episode_id, audio_duration=None, metrics_file=None):
+        """
+        Stores the collected measurements in stage_metrics and appends them to metrics_file, if given.
+
+        Args:
+            conn (sqlite3.Connection): The SQLite database connection.
+            episode_id (int): The ID of the episode in the database.
+            audio_duration (float, optional): The duration of the episode's audio in seconds, used for the real-time factor.
+            metrics_file (str, optional): A Prometheus textfile (.prom) to rewrite with the totals of every stage,
+                or a JSON lines file to append the measurements to.
+        """
+        records, self.records = self.records, []
+        if not records:
+            return
+        for record in records:
+            record['episode_id'] = episode_id
+            record['audio_duration'] = audio_duration
+            record['real_time_factor'] = record['wall_time'] / audio_duration if audio_duration else None
+
+        columns = ['episode_id', 'stage', 'started_at', 'wall_time', 'cpu_time', 'peak_rss', 'audio_duration', 'real_time_factor', 'failed']
+        with conn:
+            conn.executemany(f"INSERT INTO stage_metrics ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                             [tuple(record[column] for column in columns) for record in records])
+
+        if metrics_file is None:
+            return
+        if metrics_file.endswith('.prom'):
+            write_prometheus_textfile(conn, metrics_file)
+        else:
+            with open(metrics_file, 'a') as f:
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+
+@contextmanager
+def collecting(episode_metrics):
+    """
+    Makes episode_metrics the collector of the stages that run on this thread until the block ends.
+    """
+    previous = getattr(_local, 'collector', None)
+    _local.collector = episode_metrics
+    try:
+        yield episode_metrics
+    finally:
+        _local.collector = previous
+
+def current_collector():
+    """
+    Returns the collector active on this thread, to carry over to work started on other threads.
+    """
+    return getattr(_local, 'collector', None)
+
+@contextmanager
+def stage(name):
+    """
+    Measures the wall time, CPU time and peak RSS of the block as the given stage of the episode being
+    collected on this thread. Does nothing if no episode is being collected.
+    """
+    collector = current_collector()
+    if collector is None:
+        yield
+        return
+
+    _reset_peak_rss()
+    started_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    start_wall = time.perf_counter()
+    start_cpu = _cpu_time()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        collector.records.append({
+            'stage': name,
+            'started_at': started_at,
+            'wall_time': time.perf_counter() - start_wall,
+            'cpu_time': _cpu_time() - start_cpu,
+            'peak_rss': _peak_rss(),
+            'failed': int(failed),
+        })
+
+def episode_audio_duration(conn, episode_id, wav_file=None):
+    """
+    Returns the duration of an episode's audio in seconds, from its finished transcription or else from
+    its WAV file, or None if neither is available.
+    """
+    row = conn.execute("SELECT audio_offset FROM transcription_progress WHERE episode_id = ? AND completed", (episode_id,)).fetchone()
+    if row and row[0]:
+        return row[0]
+    if wav_file and os.path.exists(wav_file):
+        try:
+            with wave.open(wav_file, 'rb') as wf:
+                return wf.getnframes() / wf.getframerate()
+        except (wave.Error, EOFError):
+            pass
+    return None
+
+def stage_totals(conn):
+    """
+    Sums up the measurements of every stage.
+
+    Returns:
+        list: (stage, runs, failures, wall time, CPU time, audio duration, max peak RSS, wall time of the runs with
+            a known audio duration) tuples in processing order.
+    """
+    rows = conn.execute("""
+        SELECT stage, COUNT(*), SUM(failed), SUM(wall_time), SUM(cpu_time), SUM(audio_duration), MAX(peak_rss),
+               SUM(CASE WHEN audio_duration > 0 THEN wall_time END)
+        FROM stage_metrics
+        GROUP BY stage
+    """).fetchall()
+    order = {name: index for index, name in enumerate(STAGES)}
+    return sorted(rows, key=lambda row: order.get(row[0], len(order)))
+
+def write_prometheus_textfile(conn, path):
+    """
+    Writes the totals of every stage in the Prometheus text format, for the node_exporter textfile collector.
+    """
+    metrics = [
+        ('speakcast_stage_runs_total', 'counter', 'Number of times the stage ran.', 1),
+        ('speakcast_stage_failures_total', 'counter', 'Number of times the stage failed.', 2),
+        ('speakcast_stage_wall_seconds_total', 'counter', 'Wall time spent in the stage.', 3),
+        ('speakcast_stage_cpu_seconds_total', 'counter', 'CPU time spent in the stage.', 4),
+        ('speakcast_stage_audio_seconds_total', 'counter', 'Duration of the audio the stage processed.', 5),
+        ('speakcast_stage_peak_rss_bytes', 'gauge', 'Highest peak resident set size seen during the stage.', 6),
+    ]
+    totals = stage_totals(conn)
+    lines = []
+    for name, metric_type, help_text, column in metrics:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for row in totals:
+            lines.append(f'{name}{{stage="{row[0]}"}} {row[column] or 0}')
+
+    # The collector may read the file at any time, so replace it in one step
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temporary_path, path)
+
+def print_stage_stats(conn, episode_title=None):
+    """
+    Prints the time spent in every stage, for all episodes or the episodes matching episode_title.
+    """
+    if episode_title:
+        rows = conn.execute("""
+            SELECT t.episode_title, m.stage, m.wall_time, m.cpu_time, m.peak_rss, m.real_time_factor, m.failed
+            FROM stage_metrics m
+            JOIN transcripts t ON t.id = m.episode_id
+            WHERE t.episode_title LIKE ?
+            ORDER BY m.id
+        """, (f"%{episode_title}%",)).fetchall()
+        if not rows:
+            print(f"No stage metrics found for episode '{episode_title}'.")
+            return
+        print(f"{'episode':40} {'stage':18} {'wall':>10} {'cpu':>10} {'peak rss':>10} {'rtf':>8}")
+        for title, name, wall_time, cpu_time, peak_rss, real_time_factor, failed in rows:
+            rtf = f'{real_time_factor:8.3f}' if real_time_factor is not None else ''
+            print(f"{title[:40]:40} {name:18} {wall_time:9.1f}s {cpu_time:9.1f}s {peak_rss / 2**20:8.0f}MB {rtf:>8}" + ('  failed' if failed else ''))
+        return
+
+    totals = stage_totals(conn)
+    if not totals:
+        print("No stage metrics found.")
+        return
+    total_wall = sum(row[3] for row in totals) or 1
+    print(f"{'stage':18} {'runs':>6} {'failed':>7} {'wall':>10} {'share':>6} {'cpu':>10} {'audio':>10} {'rtf':>8} {'peak rss':>10}")
+    for name, runs, failures, wall_time, cpu_time, audio_duration, peak_rss, audio_wall_time in totals:
+        rtf = f'{audio_wall_time / audio_duration:8.3f}' if audio_duration else ''
+        print(f"{name:18} {runs:6d} {failures:7d} {wall_time:9.1f}s {wall_time / total_wall:6.1%} {cpu_time:9.1f}s "
+              f"{(audio_duration or 0) / 3600:9.2f}h {rtf:>8} {peak_rss / 2**20:8.0f}MB")
@@ -0,0 +1,151 @@
+import os
+import threading
+import time
+from config import VOSK_MODEL_PATH, FRAME_RATE, PUNCTUATOR_MODEL_PATH, PYANNOTE_ACCESS_TOKEN
+
+# The pyannote models, as named on the Hugging Face hub
+DIARIZATION_MODEL = "pyannote/speaker-diarization"
+SEGMENTATION_MODEL = "pyannote/segmentation"
+EMBEDDING_MODEL = "pyannote/embedding"
+
+def model_version(path):
+    """
+    Identifies the version of a model file or directory by its name, size and modification time.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return os.path.basename(os.path.normpath(path))
+    return f'{os.path.basename(os.path.normpath(path))}:{stat.st_size}:{int(stat.st_mtime)}'
+
+class _PyannoteModel:
+    """
+    Calls a pyannote pipeline or inference with the dict of audio_buffer.diarization_input, turning its numpy
+    waveform into the torch tensor pyannote expects, so torch is only needed once a pyannote model is loaded.
+    """
+
+    def __init__(self, model):
+        self._model = model
+
+    def __call__(self, file, **kwargs):
+        import torch
+        return self._model(dict(file, waveform=torch.from_numpy(file['waveform'])), **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+class ModelRegistry:
+    """
+    Holds the Vosk model, the Punctuator, the pyannote diarization and speech activity pipelines and the speaker
+    embedding model for the lifetime of a run.
+
+    Each model is loaded the first time it is requested and reused for every later episode, so a feed
+    backfill pays the model setup cost once instead of once per episode. The model libraries themselves
+    are only imported when a model is first loaded.
+    """
+
+    def __init__(self):
+        self._vosk_model = None
+        self._punctuator = None
+        self._diarization_pipeline = None
+        self._speech_activity_pipeline = None
+        self._speaker_embedding = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.load_times = {}
+
+    def _get_or_load(self, attribute, name, loader):
+        model = getattr(self, attribute)
+        if model is None:
+            with self._lock:
+                model = getattr(self, attribute)
+                if model is None:
+                    print(f'Loading {name}')
+                    start_time = time.perf_counter()
+                    model = loader()
+                    self.load_times[name] = time.perf_counter() - start_time
+                    print(f'Loaded {name} in {self.load_times[name]:.2f}s')
+                    setattr(self, attribute, model)
+        return model
+
+    @property
+    def vosk_model(self):
+        def load():
+            from vosk import Model
+            return Model(VOSK_MODEL_PATH)
+        return self._get_or_load('_vosk_model', 'Vosk model', load)
+
+    @property
+    def recognizer(self):
+        # Recognizers keep decoding state, so each thread gets its own on top of the shared model
+        recognizer = getattr(self._local, 'recognizer', None)
+        if recognizer is None:
+            recognizer = self._local.recognizer = self.new_recognizer()
+        return recognizer
+
+    def new_recognizer(self):
+        """
+        Creates a new recognizer on top of the shared Vosk model.
+
+        Returns:
+            vosk.KaldiRecognizer: A recognizer with word timings enabled.
+        """
+        from vosk import KaldiRecognizer
+        recognizer = KaldiRecognizer(self.vosk_model, FRAME_RATE)
+        recognizer.SetWords(True)
+        return recognizer
+
+    @property
+    def recognizer_version(self):
+        return model_version(VOSK_MODEL_PATH)
+
+    @property
+    def punctuator(self):
+        def load():
+            from punctuator import Punctuator
+            return Punctuator(PUNCTUATOR_MODEL_PATH)
+        return self._get_or_load('_punctuator', 'Punctuator', load)
+
+    @property
+    def punctuator_version(self):
+        return model_version(PUNCTUATOR_MODEL_PATH)
+
+    @property
+    def diarization_pipeline(self):
+        def load():
+            from pyannote.audio import Pipeline
+            return _PyannoteModel(Pipeline.from_pretrained(
+                DIARIZATION_MODEL,
+                use_auth_token=PYANNOTE_ACCESS_TOKEN,
+            ))
+        return self._get_or_load('_diarization_pipeline', 'diarization pipeline', load)
+
+    @property
+    def diarization_version(self):
+        return DIARIZATION_MODEL
+
+    @property
+    def speech_activity_pipeline(self):
+        def load():
+            from pyannote.audio.pipelines import VoiceActivityDetection
+            pipeline = VoiceActivityDetection(segmentation=SEGMENTATION_MODEL, use_auth_token=PYANNOTE_ACCESS_TOKEN)
+            # The regions are smoothed afterwards, see speech_activity.py
+            pipeline.instantiate({"onset": 0.5, "offset": 0.5, "min_duration_on": 0.0, "min_duration_off": 0.0})
+            return _PyannoteModel(pipeline)
+        return self._get_or_load('_speech_activity_pipeline', 'speech activity pipeline', load)
+
+    @property
+    def speech_activity_version(self):
+        return SEGMENTATION_MODEL
+
+    @property
+    def speaker_embedding(self):
+        def load():
+            from pyannote.audio import Inference, Model
+            # One embedding for all the audio it's given, see windowed_diarization.py
+            return _PyannoteModel(Inference(Model.from_pretrained(EMBEDDING_MODEL, use_auth_token=PYANNOTE_ACCESS_TOKEN), window="whole"))
+        return self._get_or_load('_speaker_embedding', 'speaker embedding model', load)
+
+    @property
+    def speaker_embedding_version(self):
+        return EMBEDDING_MODEL
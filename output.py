@@ -1,4 +1,5 @@
-import json
+import sys
+from export import export_episode
 
 def print_google_doc_urls(conn, episode_title=None):
     cursor = conn.cursor()
@@ -18,17 +19,11 @@ def print_google_doc_urls(conn, episode_title=None):
 
 def print_diarization_as_rttm(conn, episode_title):
     cursor = conn.cursor()
-    cursor.execute("SELECT id, episode_wave_filename FROM transcripts WHERE episode_title = ?", (episode_title,))
+    cursor.execute("SELECT id FROM transcripts WHERE episode_title = ?", (episode_title,))
     result = cursor.fetchone()
 
     if result:
-        episode_id = result[0]
-        wav_filename = result[1]
-        cursor.execute("SELECT * FROM diarization_results WHERE episode_id = ? ORDER BY start_time", (episode_id,))
-        diarization_results = cursor.fetchall()
-
-        for result in diarization_results:
-            print(f"SPEAKER {wav_filename} 1 {result[3]} {result[5]} <NA> <NA> {result[2]} <NA> <NA>")
+        export_episode(conn, result[0], 'rttm', sys.stdout)
     else:
         print(f"No diarization results found for episode '{episode_title}'.")
 
@@ -38,22 +33,19 @@ def print_transcription_as_json(conn, episode_title):
     result = cursor.fetchone()
 
     if result:
-        episode_id = result[0]
-        cursor.execute("SELECT * FROM transcription_results WHERE episode_id = ? ORDER BY start_time", (episode_id,))
-        transcription_results = cursor.fetchall()
+        export_episode(conn, result[0], 'json', sys.stdout)
+    else:
+        print(f"No transcription results found for episode '{episode_title}'.")
 
-        json_data = []
-        for result in transcription_results:
-            json_data.append({
-                "word": result[2],
-                "start_time": result[3],
-                "end_time": result[4],
-                "speaker_id": result[5]
-            })
+def print_episode_export(conn, episode_title, export_format):
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM transcripts WHERE episode_title = ?", (episode_title,))
+    result = cursor.fetchone()
 
-        print(json.dumps(json_data, indent=2))
+    if result:
+        export_episode(conn, result[0], export_format, sys.stdout)
     else:
-        print(f"No transcription results found for episode '{episode_title}'.")
+        print(f"No results found for episode '{episode_title}'.")
 
 def print_episode_transcript(conn, episode_title):
     cursor = conn.cursor()
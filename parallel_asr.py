@@ -0,0 +1,137 @@
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from audio_buffer import EpisodeAudio, open_audio
+
+# Length of the windows the energy is measured over when looking for silence, in seconds
+ENERGY_WINDOW = 0.1
+
+# How far from an evenly spaced split point to look for a quieter place to split, in seconds
+SPLIT_SEARCH_RADIUS = 30.0
+
+# Audio shared by neighbouring segments, so a word cut by a split is heard in full by at least one of them
+SEGMENT_OVERLAP = 1.0
+
+_pool = None
+_pool_workers = 0
+_worker_models = None
+
+def _window_energies(audio):
+    """
+    Returns the mean squared amplitude of every ENERGY_WINDOW of the mapped audio, reducing many windows at a time.
+    """
+    window_frames = int(audio.sample_rate * ENERGY_WINDOW)
+    block_frames = window_frames * 600
+    energies = np.empty(-(-len(audio) // window_frames))
+    for start in range(0, len(audio), block_frames):
+        # Only the block is converted to floats, the rest of the audio stays in the page cache
+        block = audio.samples[start:start + block_frames].astype(np.float32)
+        full = len(block) // window_frames * window_frames
+        first = start // window_frames
+        energies[first:first + full // window_frames] = (block[:full].reshape(-1, window_frames) ** 2).mean(axis=1)
+        if full < len(block):
+            energies[-1] = (block[full:] ** 2).mean()
+    return energies
+
+def find_split_points(wav_file, num_segments):
+    """
+    Picks the times to split an episode's audio at so it falls into num_segments segments of roughly equal length.
+
+    Each split is placed at the quietest window within SPLIT_SEARCH_RADIUS of the evenly spaced position,
+    so splits land in pauses between words where possible.
+
+    Args:
+        wav_file (str or audio_buffer.EpisodeAudio): The path to the WAV file, or its mapped audio.
+        num_segments (int): The number of segments to split into.
+
+    Returns:
+        list: The segment boundaries in seconds, starting with 0 and ending with the duration of the file.
+    """
+    energies = _window_energies(open_audio(wav_file))
+    duration = len(energies) * ENERGY_WINDOW
+    radius = int(SPLIT_SEARCH_RADIUS / ENERGY_WINDOW)
+
+    boundaries = [0.0]
+    for i in range(1, num_segments):
+        target = int(len(energies) * i / num_segments)
+        low = max(target - radius, int(boundaries[-1] / ENERGY_WINDOW) + 1)
+        high = min(target + radius, len(energies) - 1)
+        if low >= high:
+            continue
+        quietest = low + int(np.argmin(energies[low:high]))
+        boundaries.append(quietest * ENERGY_WINDOW + ENERGY_WINDOW / 2)
+    boundaries.append(duration)
+    return boundaries
+
+def _init_worker():
+    global _worker_models
+    from models import ModelRegistry
+    _worker_models = ModelRegistry()
+
+def _transcribe_segment(wav_file, ranges):
+    """
+    Transcribes the (start time, end time) ranges of one segment of the WAV file in a pool process and
+    returns their words on the episode's time axis.
+    """
+    from audio_processing import _words_from_result, PCM_BLOCK_FRAMES
+
+    recognizer = _worker_models.recognizer
+    # Every worker maps the same WAV file, so the segments share the audio in the page cache
+    audio = EpisodeAudio(wav_file)
+    words = []
+    for start_time, end_time in ranges:
+        recognizer.Reset()
+        for data in audio.pcm_blocks(PCM_BLOCK_FRAMES, start_time, end_time):
+            if recognizer.AcceptWaveform(data):
+                words.extend(_words_from_result(recognizer.Result(), start_time))
+        words.extend(_words_from_result(recognizer.FinalResult(), start_time))
+    return words
+
+def _get_pool(workers):
+    # The pool is kept across episodes so each worker loads its Vosk model only once
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker)
+        _pool_workers = workers
+    return _pool
+
+def transcribe_wav_parallel(wav_file, workers, start_time=0.0, speech_regions=None):
+    """
+    Transcribes a WAV file on several processes at once by splitting it into segments at quiet points.
+
+    Neighbouring segments overlap by SEGMENT_OVERLAP seconds. Every word is kept only by the segment
+    its midpoint falls in, so a word that straddles a split is kept exactly once, from whichever
+    segment it falls in, regardless of how the workers are scheduled.
+
+    Args:
+        wav_file (str or audio_buffer.EpisodeAudio): The path to the WAV file, or its mapped audio.
+        workers (int): The number of processes to transcribe on.
+        start_time (float, optional): Position in seconds to start transcribing from. Defaults to 0.
+        speech_regions (speech_activity.SpeechRegions, optional): If given, only the speech regions are transcribed.
+
+    Returns:
+        list: The transcribed words in order, with their timings and speaker ID placeholders.
+    """
+    audio = open_audio(wav_file)
+    boundaries = [time for time in find_split_points(audio, workers) if time > start_time]
+    boundaries.insert(0, start_time)
+    print(f'Transcribing {audio.path} in {len(boundaries) - 1} segments')
+
+    pool = _get_pool(workers)
+    futures = []
+    for segment_start, segment_end in zip(boundaries, boundaries[1:]):
+        ranges = [(max(segment_start - SEGMENT_OVERLAP, start_time), min(segment_end + SEGMENT_OVERLAP, boundaries[-1]))]
+        if speech_regions is not None:
+            ranges = speech_regions.within(*ranges[0])
+        futures.append(pool.submit(_transcribe_segment, audio.path, ranges))
+
+    transcription = []
+    for future, segment_start, segment_end in zip(futures, boundaries, boundaries[1:]):
+        last_segment = segment_end == boundaries[-1]
+        for word in future.result():
+            midpoint = (word['start'] + word['end']) / 2
+            if segment_start <= midpoint and (midpoint < segment_end or last_segment):
+                transcription.append(word)
+    return transcription
@@ -0,0 +1,163 @@
+import queue
+import threading
+import metrics
+from database import connect_database
+from audio_processing import fetch_episode_audio, release_episode_audio, register_episode, transcribe_audio, diarize_and_write_transcript
+from fingerprints import stage_fingerprints, update_stage_fingerprints
+from speech_activity import episode_speech_regions
+
+# Tells a stage worker that no more episodes are coming
+_DONE = object()
+
+def _run_stage(name, handler, inbox, outbox, workers, database_path, failures, on_finished=None):
+    """
+    Starts the worker threads of one pipeline stage.
+
+    Each worker takes episodes from inbox, runs handler(conn, episode) on them and passes them on to
+    outbox, blocking while outbox is full. Failed episodes are recorded and dropped from the pipeline.
+    on_finished is called once per episode that leaves the pipeline at this stage.
+    """
+    def work():
+        conn = connect_database(database_path)
+        while True:
+            episode = inbox.get()
+            if episode is _DONE:
+                break
+            try:
+                handler(conn, episode)
+            except Exception as error:
+                print(f"{name} failed for '{episode['title']}': {error!r}")
+                failures.append((episode['title'], name, str(error)))
+                if on_finished:
+                    on_finished(episode)
+                continue
+            if outbox is not None:
+                outbox.put(episode)
+            elif on_finished:
+                on_finished(episode)
+        conn.close()
+
+    threads = [threading.Thread(target=work, name=f'{name}-{i}', daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+def _finish_stage(threads, outbox, next_workers):
+    for thread in threads:
+        thread.join()
+    if outbox is not None:
+        for _ in range(next_workers):
+            outbox.put(_DONE)
+
+def process_episodes_pipelined(items, database_path, downloads_dir, models, download_workers=2, asr_workers=1, diarization_workers=1,
+                               upload_workers=1, max_pending_audio=2, num_speakers=None, min_speakers=None, max_speakers=None,
+                               upload_to_google_drive=False, overwrite=False, metrics_file=None, speech_detection=None,
+                               cache_budget=None, diarization_window=None, window_workers=1):
+    """
+    Processes episodes through a pipeline of stages connected by bounded queues, so that downloading and
+    converting the next episodes overlaps with transcribing and diarizing the current ones, and uploads
+    run in the background.
+
+    The stages are download (download and ffmpeg conversion), ASR, diarization (diarization, speaker
+    assignment and punctuation) and upload. At most max_pending_audio episodes are in flight between the
+    start of their download and the end of their diarization, which bounds the disk space used by
+    converted WAVs that are waiting to be processed.
+
+    Args:
+        items (list): The <item> tags of the episodes to process.
+        database_path (str): Path to the podcast's transcripts.db file.
+        downloads_dir (str): The audio cache directory, see audio_cache.AudioCache.
+        models (models.ModelRegistry): The registry holding the models shared by the stages.
+        download_workers (int, optional): Number of concurrent downloads and conversions.
+        asr_workers (int, optional): Number of concurrent transcriptions, each with its own recognizer.
+        diarization_workers (int, optional): Number of concurrent diarizations sharing one pipeline.
+        upload_workers (int, optional): Number of concurrent Google Docs uploads.
+        max_pending_audio (int, optional): Maximum number of episodes with audio in flight.
+        num_speakers (int, optional): Number of speakers in the audio (if known).
+        min_speakers (int, optional): Minimum number of speakers in the audio.
+        max_speakers (int, optional): Maximum number of speakers in the audio.
+        upload_to_google_drive (bool, optional): Whether or not to upload the transcripts to google.
+        overwrite (bool, optional): Whether to overwrite existing results in the database.
+        metrics_file (str, optional): File to write the stage metrics of every episode to, see metrics.EpisodeMetrics.flush.
+        speech_detection (str, optional): One of speech_activity.DETECTION_METHODS to only transcribe and diarize the speech.
+        cache_budget (int, optional): Disk budget of the audio cache in bytes, see audio_cache.AudioCache.
+        diarization_window (float, optional): If given, episodes are diarized in overlapping windows of this many seconds.
+        window_workers (int, optional): Number of diarization windows of an episode processed at once.
+
+    Returns:
+        list: The (episode title, stage, error message) triples of the episodes that failed.
+    """
+    failures = []
+    audio_slots = threading.BoundedSemaphore(max_pending_audio)
+
+    download_queue = queue.Queue()
+    asr_queue = queue.Queue(maxsize=max_pending_audio)
+    diarization_queue = queue.Queue(maxsize=max_pending_audio)
+    upload_queue = queue.Queue() if upload_to_google_drive else None
+
+    def measured(handler):
+        # Stage metrics are saved after every stage, from the stage that registers the episode on
+        def run(conn, episode):
+            try:
+                with metrics.collecting(episode['metrics']):
+                    handler(conn, episode)
+            finally:
+                if 'episode_id' in episode:
+                    audio_duration = metrics.episode_audio_duration(conn, episode['episode_id'], episode.get('wav_file'))
+                    episode['metrics'].flush(conn, episode['episode_id'], audio_duration, metrics_file)
+        return run
+
+    def release_audio(episode):
+        if 'audio' in episode:
+            release_episode_audio(episode['audio'], downloads_dir, episode.get('processed', False), cache_budget)
+        audio_slots.release()
+
+    def download(conn, episode):
+        episode['audio'] = fetch_episode_audio(episode['item'], downloads_dir, cache_budget=cache_budget)
+        episode['wav_file'] = episode['audio'].wav_file
+
+    def transcribe(conn, episode):
+        episode['episode_id'] = register_episode(conn, episode['item'], episode['audio'].sha256, overwrite)
+        fingerprints = stage_fingerprints(episode['audio'].sha256, models, speech_detection, num_speakers, min_speakers, max_speakers,
+                                          diarization_window)
+        update_stage_fingerprints(conn, episode['episode_id'], fingerprints)
+        if speech_detection:
+            episode['speech_regions'] = episode_speech_regions(conn, episode['episode_id'], episode['wav_file'], models, speech_detection)
+        print(f"Transcribing {episode['wav_file']}")
+        episode['words'] = transcribe_audio(conn, episode['episode_id'], episode['wav_file'], models, speech_regions=episode.get('speech_regions'))
+
+    def diarize(conn, episode):
+        try:
+            diarize_and_write_transcript(conn, episode['item'], episode['episode_id'], episode['wav_file'], episode.pop('words'),
+                                         models, num_speakers, min_speakers, max_speakers, speech_regions=episode.get('speech_regions'),
+                                         window=diarization_window, window_workers=window_workers)
+            episode['processed'] = True
+        finally:
+            release_audio(episode)
+
+    def upload(conn, episode):
+        from google_drive import upload_to_google
+        with metrics.stage(metrics.UPLOAD_STAGE):
+            upload_to_google(conn, episode['episode_id'], episode['title'])
+
+    # Episodes that fail before diarization give their audio slot back when they leave the pipeline
+    download_threads = _run_stage('Download', measured(download), download_queue, asr_queue, download_workers, database_path, failures, release_audio)
+    asr_threads = _run_stage('ASR', measured(transcribe), asr_queue, diarization_queue, asr_workers, database_path, failures, release_audio)
+    diarization_threads = _run_stage('Diarization', measured(diarize), diarization_queue, upload_queue, diarization_workers, database_path, failures)
+    upload_threads = []
+    if upload_queue is not None:
+        upload_threads = _run_stage('Upload', measured(upload), upload_queue, None, upload_workers, database_path, failures)
+
+    for item in items:
+        # Wait for a free audio slot before starting another download
+        audio_slots.acquire()
+        download_queue.put({'item': item, 'title': item.find('title').text.strip(), 'metrics': metrics.EpisodeMetrics()})
+    for _ in range(download_workers):
+        download_queue.put(_DONE)
+
+    _finish_stage(download_threads, asr_queue, asr_workers)
+    _finish_stage(asr_threads, diarization_queue, diarization_workers)
+    _finish_stage(diarization_threads, upload_queue, upload_workers)
+    _finish_stage(upload_threads, None, 0)
+
+    return failures
@@ -0,0 +1,119 @@
+import hashlib
+import re
+import time
+import metrics
+
+# Stands in for a turn boundary when several turns are punctuated in one call. The punctuator treats it
+# as an unknown word, and it never occurs in a Vosk transcript, which is all lowercase letters and apostrophes.
+TURN_BREAK = 'turnbreak0'
+
+_TURN_BREAK_PATTERN = re.compile(r'\s*\b' + TURN_BREAK + r'\b[^\w\s]*\s*', re.IGNORECASE)
+
+# Maximum number of words punctuated in one call
+PUNCTUATION_BATCH_WORDS = 2000
+
+def _cache_key(model_version, text):
+    return hashlib.sha1(f'{model_version}\0{text}'.encode('utf-8')).hexdigest()
+
+def _finish_turn(text):
+    """
+    Cleans up one turn cut out of a batch: the punctuation the model put after the turn break is dropped
+    with the break, and every turn starts with a capital letter and ends with a full stop, like a turn
+    punctuated on its own.
+    """
+    text = text.strip()
+    if not text:
+        return text
+    if text[-1] not in '.?!':
+        text = text.rstrip(',;:-') + '.'
+    return text[0].upper() + text[1:]
+
+def _punctuate_batch(punctuator, texts):
+    """
+    Punctuates several turns with a single call, splitting the result back into turns at the turn breaks.
+
+    Falls back to punctuating the turns one by one if the output doesn't split into the same number of turns.
+    """
+    if len(texts) == 1:
+        return [punctuator.punctuate(texts[0])]
+
+    punctuated = punctuator.punctuate(f' {TURN_BREAK} '.join(texts))
+    turns = _TURN_BREAK_PATTERN.split(punctuated)
+    if len(turns) != len(texts):
+        print(f'Could not split a batch of {len(texts)} punctuated turns, punctuating them one by one')
+        return [punctuator.punctuate(text) for text in texts]
+    return [_finish_turn(turn) for turn in turns]
+
+def punctuate_turns(conn, models, texts):
+    """
+    Punctuates the text of several speaker turns, using the punctuation cache where possible.
+
+    Turns that aren't cached yet are packed into batches of up to PUNCTUATION_BATCH_WORDS words,
+    punctuated with one model call per batch and added to the cache, keyed by a hash of the turn
+    text and the version of the punctuator model. The Punctuator is only loaded if some turns
+    aren't cached.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite database connection holding the punctuation cache.
+        models (models.ModelRegistry): The registry providing the Punctuator.
+        texts (list): The raw text of every turn.
+
+    Returns:
+        list: The punctuated text of every turn, in the same order.
+    """
+    model_version = models.punctuator_version
+    keys = [_cache_key(model_version, text) for text in texts]
+    results = [None] * len(texts)
+
+    cached = {}
+    unique_keys = list(set(keys))
+    for i in range(0, len(unique_keys), 900):
+        chunk = unique_keys[i:i + 900]
+        placeholders = ', '.join('?' * len(chunk))
+        cached.update(conn.execute(f"SELECT key, punctuated FROM punctuation_cache WHERE key IN ({placeholders})", chunk))
+
+    # Turns to punctuate, with identical turns only punctuated once
+    pending = {}
+    cached_turns = 0
+    for index, (key, text) in enumerate(zip(keys, texts)):
+        if not text.strip():
+            results[index] = ""
+        elif key in cached:
+            results[index] = cached[key]
+            cached_turns += 1
+        else:
+            pending.setdefault(key, (text, []))[1].append(index)
+
+    if not pending:
+        return results
+
+    batches = [[]]
+    batch_words = 0
+    for key, (text, _) in pending.items():
+        words = len(text.split())
+        if batches[-1] and batch_words + words > PUNCTUATION_BATCH_WORDS:
+            batches.append([])
+            batch_words = 0
+        batches[-1].append(key)
+        batch_words += words
+
+    with metrics.stage(metrics.PUNCTUATION_STAGE):
+        punctuator = models.punctuator
+        start_time = time.perf_counter()
+        total_words = 0
+        new_entries = []
+        for batch in batches:
+            batch_texts = [pending[key][0] for key in batch]
+            total_words += sum(len(text.split()) for text in batch_texts)
+            for key, punctuated in zip(batch, _punctuate_batch(punctuator, batch_texts)):
+                new_entries.append((key, punctuated))
+                for index in pending[key][1]:
+                    results[index] = punctuated
+        elapsed = time.perf_counter() - start_time
+
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO punctuation_cache (key, punctuated) VALUES (?, ?)", new_entries)
+
+    print(f'Punctuated {len(pending)} turns ({total_words} tokens) in {len(batches)} batches at {total_words / max(elapsed, 1e-9):.0f} tokens/s, '
+          f'{cached_turns} turns were cached')
+    return results
@@ -0,0 +1,117 @@
+import sqlite3
+from feed_sync import mark_stage_complete
+from speaker_assignment import assign_words_to_speakers
+from word_store import load_transcription, pack_array, unpack_array, TIME_TYPECODE
+
+SEARCH_STAGE = 'search_index'
+
+# Longest run of words indexed as one row. Phrase and proximity queries only match within a row.
+MAX_ROW_WORDS = 200
+
+# Marks the matched words in highlight(), used to find the word a hit starts at
+_MATCH_START = '\x01'
+_MATCH_END = '\x02'
+
+def format_timecode(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+def index_episode(conn, episode_id, speaker_word_list):
+    """
+    Replaces the search index rows of an episode with its speaker turns. The caller is responsible for committing.
+
+    Every turn is indexed as one or more rows of at most MAX_ROW_WORDS words, with the start time
+    of each word stored next to the row so hits can be located to the word.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite database connection.
+        episode_id (int): The ID of the episode in the database.
+        speaker_word_list (list): The speaker turns from assign_words_to_speakers.
+    """
+    conn.execute("DELETE FROM transcript_search WHERE rowid IN (SELECT id FROM search_rows WHERE episode_id = ?)", (episode_id,))
+    conn.execute("DELETE FROM search_rows WHERE episode_id = ?", (episode_id,))
+
+    for speaker_entry in speaker_word_list:
+        words = speaker_entry["words"]
+        for i in range(0, len(words), MAX_ROW_WORDS):
+            row_words = words[i:i + MAX_ROW_WORDS]
+            cursor = conn.execute("INSERT INTO search_rows (episode_id, speaker_id, word_starts) VALUES (?, ?, ?)",
+                                  (episode_id, str(speaker_entry["speaker_id"]), pack_array(TIME_TYPECODE, [word['start'] for word in row_words])))
+            conn.execute("INSERT INTO transcript_search (rowid, text) VALUES (?, ?)",
+                         (cursor.lastrowid, ' '.join(word['word'] for word in row_words)))
+
+    mark_stage_complete(conn, episode_id, SEARCH_STAGE)
+
+def _index_missing_episodes(conn):
+    """
+    Indexes the finished episodes that aren't in the search index yet, such as episodes transcribed before it existed.
+    """
+    episode_ids = [row[0] for row in conn.execute("""
+        SELECT id FROM transcripts
+        WHERE transcript IS NOT NULL AND transcript != ''
+        AND id NOT IN (SELECT episode_id FROM episode_stages WHERE stage = ?)
+    """, (SEARCH_STAGE,))]
+    if not episode_ids:
+        return
+
+    print(f'Adding {len(episode_ids)} episode(s) to the search index')
+    with conn:
+        for episode_id in episode_ids:
+            words = load_transcription(conn, episode_id)
+            has_segments = conn.execute("SELECT 1 FROM diarization_results WHERE episode_id = ? LIMIT 1", (episode_id,)).fetchone()
+            if not words or not has_segments:
+                continue
+            index_episode(conn, episode_id, assign_words_to_speakers(conn, episode_id, list(words)))
+
+def search_transcripts(conn, query, limit=20):
+    """
+    Searches the transcripts of every episode with an FTS5 query.
+
+    Plain words match rows containing all of them, "quoted phrases" match the words in order, and
+    NEAR(word1 word2, N) matches words at most N words apart.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite database connection.
+        query (str): The FTS5 query.
+        limit (int, optional): The maximum number of hits to return. Defaults to 20.
+
+    Returns:
+        list: (episode title, speaker ID, start time of the first matched word, snippet) for every hit, best first.
+    """
+    _index_missing_episodes(conn)
+
+    rows = conn.execute("""
+        SELECT t.episode_title, r.speaker_id, r.word_starts,
+               highlight(transcript_search, 0, ?, ?),
+               snippet(transcript_search, 0, '[', ']', '...', 16)
+        FROM transcript_search
+        JOIN search_rows r ON r.id = transcript_search.rowid
+        JOIN transcripts t ON t.id = r.episode_id
+        WHERE transcript_search MATCH ?
+        ORDER BY rank
+        LIMIT ?
+    """, (_MATCH_START, _MATCH_END, query, limit)).fetchall()
+
+    hits = []
+    for title, speaker_id, word_starts, highlighted, snippet in rows:
+        # The indexed text is the words joined by single spaces, so the n-th token is the n-th word
+        tokens = highlighted.split(' ')
+        word_index = next((i for i, token in enumerate(tokens) if _MATCH_START in token), 0)
+        hits.append((title, speaker_id, unpack_array(TIME_TYPECODE, word_starts)[word_index], snippet))
+    return hits
+
+def print_search_results(conn, query, limit=20):
+    try:
+        hits = search_transcripts(conn, query, limit)
+    except sqlite3.OperationalError as error:
+        print(f"Invalid search query '{query}': {error}")
+        return
+
+    if not hits:
+        print(f"No matches found for '{query}'.")
+        return
+
+    for title, speaker_id, start_time, snippet in hits:
+        print(f"{title} [{format_timecode(start_time)}] {speaker_id}: {snippet}")
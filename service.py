@@ -0,0 +1,194 @@
+import os
+import signal
+import threading
+import traceback
+from bs4 import BeautifulSoup
+from database import connect_database
+from feed_sync import read_feed, podcast_dir_for, plan_feed_sync, episode_key
+from fingerprints import options_fingerprints
+from jobs import (EPISODE_JOB, WAV_JOB, POLL_PRIORITY, MANUAL_PRIORITY, connect_queue, worker_name, enqueue_job, claim_job,
+                  renew_lease, update_payload, complete_job, fail_job)
+
+# How long a worker waits before looking for work again when the queue is empty, in seconds
+IDLE_WAIT = 5
+
+def _open_podcast(soup):
+    podcast_dir = os.path.abspath(podcast_dir_for(soup))
+    os.makedirs(os.path.join(podcast_dir, "transcripts"), exist_ok=True)
+    return podcast_dir, connect_database(os.path.join(podcast_dir, "transcripts.db"))
+
+def _enqueue_episode(queue, podcast_dir, item, episode_options, priority, retry_failed):
+    title = item.find('title').text.strip()
+    payload = {'podcast_dir': podcast_dir, 'title': title, 'item_xml': str(item), 'options': episode_options}
+    return enqueue_job(queue, EPISODE_JOB, payload, priority, dedupe_key=f'{podcast_dir}\0{episode_key(item)}', retry_failed=retry_failed)
+
+def poll_feed(queue, rss_file_or_url, episode_options, models, audio_cache=None):
+    """
+    Reads a feed and enqueues a job for every episode that still needs work and isn't queued yet, including
+    finished episodes whose stages would now run with another model version or other parameters.
+
+    If audio_cache is given, the feed's audio in the old per-podcast downloads directory is moved into it.
+
+    Returns:
+        int: The number of jobs enqueued.
+    """
+    soup = BeautifulSoup(read_feed(rss_file_or_url), 'xml')
+    podcast_dir, conn = _open_podcast(soup)
+    try:
+        items = plan_feed_sync(conn, soup.find_all('item'), episode_options.get('upload_to_google_drive', False),
+                               options_fingerprints(models, episode_options))
+    finally:
+        conn.close()
+    if audio_cache is not None:
+        from audio_processing import import_legacy_downloads
+        import_legacy_downloads(podcast_dir, soup.find_all('item'), items, audio_cache, episode_options.get('cache_budget'))
+    return sum(1 for item in items if _enqueue_episode(queue, podcast_dir, item, episode_options, POLL_PRIORITY, retry_failed=False) is not None)
+
+def enqueue_feed_episodes(queue, rss_file_or_url, episode_options, episode_title=None, priority=MANUAL_PRIORITY):
+    """
+    Enqueues the episodes of a feed whose title contains episode_title (all episodes if not given), including
+    finished and failed ones, so they're run again. With overwrite in episode_options, they're processed from scratch.
+
+    Returns:
+        int: The number of jobs enqueued.
+    """
+    soup = BeautifulSoup(read_feed(rss_file_or_url), 'xml')
+    podcast_dir, conn = _open_podcast(soup)
+    conn.close()
+    enqueued = 0
+    for item in soup.find_all('item'):
+        if episode_title and episode_title.lower() not in item.find('title').text.strip().lower():
+            continue
+        if _enqueue_episode(queue, podcast_dir, item, episode_options, priority, retry_failed=True) is not None:
+            enqueued += 1
+    return enqueued
+
+def enqueue_wav(queue, wav_file, priority=MANUAL_PRIORITY):
+    return enqueue_job(queue, WAV_JOB, {'wav_file': os.path.abspath(wav_file)}, priority)
+
+def run_job(kind, payload, models, connections, audio_cache, on_overwritten=None):
+    """
+    Runs one job with the resident models.
+
+    Args:
+        kind (str): The kind of the job.
+        payload (dict): The parameters of the job.
+        models (models.ModelRegistry): The registry shared by every job of the service.
+        connections (dict): The worker's transcripts.db connections by podcast directory, reused across jobs.
+        audio_cache (str): The audio cache directory shared by every podcast.
+        on_overwritten (callable, optional): Called once an episode job with overwrite has discarded the earlier results.
+
+    Returns:
+        str: Where the result of the job was written, for jobs whose result isn't stored in a transcripts.db.
+    """
+    if kind == WAV_JOB:
+        from audio_processing import transcribe_wav_file
+        transcript = transcribe_wav_file(payload['wav_file'], models.recognizer, models.punctuator)
+        # Written next to the WAV file, since the service's output isn't seen by whoever queued it
+        transcript_file = os.path.splitext(payload['wav_file'])[0] + '.txt'
+        with open(transcript_file, 'w') as f:
+            f.write(transcript + '\n')
+        return transcript_file
+    elif kind == EPISODE_JOB:
+        from audio_processing import process_episode
+        podcast_dir = payload['podcast_dir']
+        if podcast_dir not in connections:
+            connections[podcast_dir] = connect_database(os.path.join(podcast_dir, "transcripts.db"))
+        item = BeautifulSoup(payload['item_xml'], 'xml').find('item')
+        process_episode(item, audio_cache, connections[podcast_dir], models, on_overwritten=on_overwritten, **payload['options'])
+    else:
+        raise ValueError(f"Unknown job kind '{kind}'")
+
+def _keep_lease(queue_path, job_id, owner, lease_seconds, finished):
+    # Runs on its own thread with its own connection while the job runs
+    queue = connect_queue(queue_path)
+    while not finished.wait(lease_seconds / 3):
+        if not renew_lease(queue, job_id, owner, lease_seconds):
+            print(f"Lost the lease on job {job_id}")
+            break
+    queue.close()
+
+def _work(queue_path, models, owner, lease_seconds, audio_cache, stop):
+    queue = connect_queue(queue_path)
+    connections = {}
+    while not stop.is_set():
+        job = claim_job(queue, owner, lease_seconds)
+        if job is None:
+            stop.wait(IDLE_WAIT)
+            continue
+
+        job_id, kind, payload, attempt = job
+        print(f"Starting {kind} job {job_id} (attempt {attempt}): {payload.get('title') or payload.get('wav_file')}")
+        finished = threading.Event()
+        lease_thread = threading.Thread(target=_keep_lease, args=(queue_path, job_id, owner, lease_seconds, finished), daemon=True)
+        lease_thread.start()
+
+        def overwritten():
+            # Later attempts resume from the transcription checkpoints of this one instead of discarding them again
+            update_payload(queue, job_id, owner, dict(payload, options=dict(payload['options'], overwrite=False)))
+
+        try:
+            result = run_job(kind, payload, models, connections, audio_cache, overwritten)
+        except Exception as error:
+            print(f"Job {job_id} failed: {error!r}")
+            fail_job(queue, job_id, owner, traceback.format_exc())
+        else:
+            print(f"Finished job {job_id}")
+            complete_job(queue, job_id, owner, result)
+        finally:
+            finished.set()
+            lease_thread.join()
+
+    for conn in connections.values():
+        conn.close()
+    queue.close()
+
+def serve(feeds, queue_path, episode_options, poll_interval=3600, workers=1, lease_seconds=600, audio_cache='.audio_cache'):
+    """
+    Runs until interrupted, polling the feeds every poll_interval seconds and running the queued jobs on
+    worker threads that share one set of resident models.
+
+    Jobs are leased to a worker for lease_seconds and the lease is renewed while the job runs. If the
+    service dies, the lease of its running jobs expires and they're picked up again on the next start
+    (or by another service sharing the queue), resuming from their last checkpoint. Failed jobs are
+    retried with an exponential backoff up to their maximum number of attempts.
+
+    Args:
+        feeds (list): The RSS feed URLs or paths to poll.
+        queue_path (str): Path to the job queue database.
+        episode_options (dict): Keyword arguments passed to process_episode for the episodes found by polling.
+        poll_interval (float, optional): Seconds between polls of the feeds. Defaults to an hour.
+        workers (int, optional): Number of jobs run at once. Defaults to 1.
+        lease_seconds (float, optional): How long a job stays leased without renewal. Defaults to 10 minutes.
+        audio_cache (str, optional): The audio cache directory shared by every podcast. Defaults to .audio_cache.
+    """
+    from models import ModelRegistry
+
+    models = ModelRegistry()
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    threads = [threading.Thread(target=_work, args=(queue_path, models, f'{worker_name()}:{i}', lease_seconds, audio_cache, stop), name=f'Worker-{i}')
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    queue = connect_queue(queue_path)
+    print(f"Serving {len(feeds)} feed(s) with {workers} worker(s), polling every {poll_interval / 60:.0f} minutes")
+    try:
+        while not stop.is_set():
+            for rss_file_or_url in feeds:
+                try:
+                    enqueued = poll_feed(queue, rss_file_or_url, episode_options, models, audio_cache)
+                    print(f"Polled {rss_file_or_url}: {enqueued} new job(s)")
+                except Exception as error:
+                    print(f"Polling {rss_file_or_url} failed: {error!r}")
+            stop.wait(poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Stopping, waiting for the running jobs to finish")
+        stop.set()
+        for thread in threads:
+            thread.join()
+        queue.close()
@@ -0,0 +1,72 @@
+import heapq
+
+def assign_words_to_speakers(conn, episode_id, words):
+    """
+    Assigns words to speakers based on the speaker diarization information.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite database connection.
+        episode_id (int): The ID of the episode in the database.
+        words (list): The list of words and their timings from the transcription.
+
+    Returns:
+        list: A list of dictionaries containing speaker IDs and their associated words.
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT speaker_id, start_time, end_time
+        FROM diarization_results
+        WHERE episode_id = ?
+        ORDER BY start_time
+    """, (episode_id,))
+    speaker_segments = cursor.fetchall()
+    segment_indices = _containing_segments(speaker_segments, [float(word['start']) for word in words])
+
+    speaker_word_list = []
+
+    for word, segment_index in zip(words, segment_indices):
+        if segment_index is not None:
+            speaker_id = speaker_segments[segment_index][0]
+            if not speaker_word_list or speaker_word_list[-1]["speaker_id"] != speaker_id:
+                speaker_word_list.append({"speaker_id": speaker_id, "words": []})
+            speaker_word_list[-1]["words"].append(word)
+        elif not speaker_word_list:
+            # Assign the unassigned word(s) at the beginning of the transcript to the first speaker
+            speaker_word_list.append({"speaker_id": speaker_segments[0][0], "words": [word]})
+        else:
+            # Assign the unassigned word to the last speaker segment
+            speaker_word_list[-1]["words"].append(word)
+
+    return speaker_word_list
+
+def _containing_segments(speaker_segments, times):
+    """
+    Finds, for every time, the first segment (in start time order) with start_time <= time < end_time.
+
+    Sweeps over the times in sorted order while keeping a heap of the segments that have started,
+    ordered by their position in speaker_segments. Segments that have ended are dropped from the top
+    of the heap as the sweep passes them, so the whole lookup is O((words + segments) log segments).
+
+    Args:
+        speaker_segments (list): The (speaker_id, start_time, end_time) rows, ordered by start time.
+        times (list): The times to look up.
+
+    Returns:
+        list: The index of the containing segment for every time, or None if no segment contains it.
+    """
+    result = [None] * len(times)
+    active = []
+    next_segment = 0
+
+    for time_index in sorted(range(len(times)), key=times.__getitem__):
+        time = times[time_index]
+        while next_segment < len(speaker_segments) and speaker_segments[next_segment][1] <= time:
+            heapq.heappush(active, next_segment)
+            next_segment += 1
+        # Times only increase, so a segment that has ended will never contain a later time
+        while active and speaker_segments[active[0]][2] <= time:
+            heapq.heappop(active)
+        if active:
+            result[time_index] = active[0]
+
+    return result
@@ -0,0 +1,241 @@
+import numpy as np
+import metrics
+from audio_buffer import diarization_input, open_audio
+from feed_sync import mark_stage_complete, completed_stages, SPEECH_REGIONS_STAGE
+
+# Ways of finding the speech in an episode, see detect_speech_regions
+ENERGY_DETECTION = 'energy'
+PYANNOTE_DETECTION = 'pyannote'
+DETECTION_METHODS = [ENERGY_DETECTION, PYANNOTE_DETECTION]
+
+# Length of the frames the energy is measured over, in seconds
+FRAME_LENGTH = 0.02
+
+# Number of frames reduced at a time, so only a minute of audio is converted to floats at once
+CHUNK_FRAMES = 3000
+
+# The noise floor is this percentile of the frame levels and the loud level this one, in dB
+NOISE_FLOOR_PERCENTILE = 10
+LOUD_PERCENTILE = 95
+
+# A frame is active if it's this many dB above the noise floor, or halfway to the loud level if that's closer
+ENERGY_THRESHOLD = 15.0
+
+# Speech keeps dropping well below its average energy between syllables, while music rarely does. In every
+# MUSIC_WINDOW seconds, if fewer than MIN_LOW_ENERGY_RATIO of the frames are below half the window's
+# mean energy, the window sounds like music. Only runs of at least MIN_MUSIC seconds are dropped, so
+# speech is kept if in doubt.
+MUSIC_WINDOW = 2.0
+MIN_LOW_ENERGY_RATIO = 0.1
+MIN_MUSIC = 6.0
+
+# Gaps shorter than this are kept as part of the speech around them, in seconds
+MIN_GAP = 1.0
+
+# Active stretches shorter than this are dropped as clicks, in seconds
+MIN_REGION = 0.2
+
+# Audio kept on both sides of every region, so the first and last words aren't clipped, in seconds
+REGION_PADDING = 0.25
+
+class SpeechRegions:
+    """
+    The stretches of an episode that contain speech, as (start time, end time) pairs in seconds.
+
+    Besides selecting the audio to transcribe, the regions map between the episode's time axis and
+    the time axis of the speech alone played back to back (see extract), so models can be run on the
+    speech only and their results placed at the original timestamps.
+
+    Args:
+        regions (list): The (start time, end time) of every region, in order and not overlapping.
+        sample_rate (int): The sample rate of the audio the regions are applied to.
+    """
+
+    def __init__(self, regions, sample_rate):
+        self.regions = [(float(start), float(end)) for start, end in regions]
+        self.sample_rate = sample_rate
+        # Regions start and end on whole samples, so the two time axes line up exactly
+        self._frames = np.array([(round(start * sample_rate), round(end * sample_rate)) for start, end in self.regions],
+                                dtype=np.int64).reshape(-1, 2)
+        self._offsets = np.concatenate([[0], np.cumsum(self._frames[:, 1] - self._frames[:, 0])])
+
+    def __iter__(self):
+        return iter(self.regions)
+
+    def __len__(self):
+        return len(self.regions)
+
+    @property
+    def duration(self):
+        return self._offsets[-1] / self.sample_rate
+
+    def after(self, start_time):
+        """
+        Returns the regions, or the parts of them, from start_time on.
+        """
+        return [(max(start, start_time), end) for start, end in self.regions if end > start_time]
+
+    def within(self, start_time, end_time):
+        """
+        Returns the regions, or the parts of them, between start_time and end_time.
+        """
+        return [(max(start, start_time), min(end, end_time)) for start, end in self.regions if end > start_time and start < end_time]
+
+    def extract(self, samples):
+        """
+        Returns the samples of the regions back to back.
+        """
+        if not len(self._frames):
+            return samples[:0]
+        return np.concatenate([samples[start:end] for start, end in self._frames])
+
+    def to_original(self, start_time, end_time):
+        """
+        Maps a span of the extracted speech back to the episode's time axis. A span that crosses from
+        one region into the next is split at the join.
+
+        Returns:
+            list: The (start time, end time) pairs the span covers in the episode.
+        """
+        start_frame, end_frame = start_time * self.sample_rate, end_time * self.sample_rate
+        spans = []
+        index = max(int(np.searchsorted(self._offsets, start_frame, side='right')) - 1, 0)
+        while index < len(self._frames) and self._offsets[index] < end_frame:
+            region_start, region_end = self._frames[index]
+            start = region_start + max(start_frame - self._offsets[index], 0)
+            end = min(region_start + end_frame - self._offsets[index], region_end)
+            if end > start:
+                spans.append((float(start / self.sample_rate), float(end / self.sample_rate)))
+            index += 1
+        return spans
+
+def _runs(mask):
+    """
+    Returns the start and end indices of the runs of True in a boolean array.
+    """
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+def frame_energies(audio):
+    """
+    Returns the mean squared amplitude of every FRAME_LENGTH of the audio.
+    """
+    frame_frames = int(audio.sample_rate * FRAME_LENGTH)
+    count = len(audio) // frame_frames
+    energies = np.empty(count, dtype=np.float32)
+    for first in range(0, count, CHUNK_FRAMES):
+        frames = min(CHUNK_FRAMES, count - first)
+        block = audio.samples[first * frame_frames:(first + frames) * frame_frames].astype(np.float32).reshape(frames, frame_frames)
+        energies[first:first + frames] = np.einsum('ij,ij->i', block, block) / frame_frames
+    return energies
+
+def _music_frames(energies, active):
+    """
+    Marks the frames in runs of at least MIN_MUSIC seconds of active windows that sound like music.
+    """
+    window = int(MUSIC_WINDOW / FRAME_LENGTH)
+    windows = len(energies) // window
+    music = np.zeros(len(energies), dtype=bool)
+    if not windows:
+        return music
+    blocks = energies[:windows * window].reshape(windows, window)
+    low_energy_ratio = (blocks < blocks.mean(axis=1, keepdims=True) / 2).mean(axis=1)
+    steady = (low_energy_ratio < MIN_LOW_ENERGY_RATIO) & (active[:windows * window].reshape(windows, window).mean(axis=1) > 0.9)
+    for start, end in zip(*_runs(steady)):
+        if (end - start) * MUSIC_WINDOW >= MIN_MUSIC:
+            music[start * window:end * window] = True
+    return music
+
+def _energy_regions(audio):
+    energies = frame_energies(audio)
+    if not len(energies):
+        return []
+    levels = 10 * np.log10(energies + 1)
+    noise_floor, loud = np.percentile(levels, [NOISE_FLOOR_PERCENTILE, LOUD_PERCENTILE])
+    active = levels > noise_floor + min(ENERGY_THRESHOLD, (loud - noise_floor) / 2)
+    active &= ~_music_frames(energies, active)
+    starts, ends = _runs(active)
+    return list(zip(starts * FRAME_LENGTH, ends * FRAME_LENGTH))
+
+def _pyannote_regions(audio, models):
+    speech = models.speech_activity_pipeline(diarization_input(audio))
+    return [(segment.start, segment.end) for segment in speech.get_timeline().support()]
+
+def _smooth(regions, duration):
+    """
+    Bridges the short gaps between regions, drops the short regions that are left and pads the rest.
+    """
+    merged = []
+    for start, end in regions:
+        if merged and start - merged[-1][1] < MIN_GAP:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end])
+
+    padded = []
+    for start, end in merged:
+        if end - start < MIN_REGION:
+            continue
+        start, end = max(start - REGION_PADDING, 0.0), min(end + REGION_PADDING, duration)
+        if padded and start <= padded[-1][1]:
+            padded[-1][1] = end
+        else:
+            padded.append([start, end])
+    return [(start, end) for start, end in padded]
+
+def detect_speech_regions(audio, models=None, method=ENERGY_DETECTION):
+    """
+    Finds the speech in an episode, leaving out silence and long stretches of music such as intros,
+    outros and ad jingles.
+
+    The energy method measures the level of every frame against the noise floor of the episode and
+    drops sustained music by its steady energy. It takes a fraction of a second per hour of audio.
+    The pyannote method uses pyannote's segmentation model instead, which is slower but also tells
+    speech from music and noise at similar levels.
+
+    Args:
+        audio (str or audio_buffer.EpisodeAudio): The episode's WAV file or its mapped audio.
+        models (models.ModelRegistry, optional): The registry providing the pyannote pipeline, only needed for that method.
+        method (str, optional): One of DETECTION_METHODS. Defaults to the energy method.
+
+    Returns:
+        SpeechRegions: The speech regions of the episode.
+    """
+    audio = open_audio(audio)
+    if method == ENERGY_DETECTION:
+        regions = _energy_regions(audio)
+    elif method == PYANNOTE_DETECTION:
+        regions = _pyannote_regions(audio, models)
+    else:
+        raise ValueError(f"Unknown speech detection method '{method}'")
+    return SpeechRegions(_smooth(regions, audio.duration), audio.sample_rate)
+
+def load_speech_regions(conn, episode_id, sample_rate):
+    """
+    Returns the stored speech regions of an episode, or None if they haven't been detected yet.
+    """
+    if SPEECH_REGIONS_STAGE not in completed_stages(conn, episode_id):
+        return None
+    rows = conn.execute("SELECT start_time, end_time FROM speech_regions WHERE episode_id = ? ORDER BY start_time", (episode_id,)).fetchall()
+    return SpeechRegions(rows, sample_rate)
+
+def save_speech_regions(conn, episode_id, speech_regions):
+    with conn:
+        conn.execute("DELETE FROM speech_regions WHERE episode_id = ?", (episode_id,))
+        conn.executemany("INSERT INTO speech_regions (episode_id, start_time, end_time) VALUES (?, ?, ?)",
+                         [(episode_id, start, end) for start, end in speech_regions])
+        mark_stage_complete(conn, episode_id, SPEECH_REGIONS_STAGE)
+
+def episode_speech_regions(conn, episode_id, audio, models=None, method=ENERGY_DETECTION):
+    """
+    Returns the speech regions of an episode, detecting and storing them the first time, so transcription,
+    diarization and later runs all use the same regions.
+    """
+    audio = open_audio(audio)
+    speech_regions = load_speech_regions(conn, episode_id, audio.sample_rate)
+    if speech_regions is None:
+        with metrics.stage(metrics.SPEECH_DETECTION_STAGE):
+            speech_regions = detect_speech_regions(audio, models, method)
+        save_speech_regions(conn, episode_id, speech_regions)
+        print(f'Found {speech_regions.duration / 60:.1f} minutes of speech in {audio.duration / 60:.1f} minutes of audio')
+    return speech_regions
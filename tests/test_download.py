@@ -0,0 +1,113 @@
+"""
+Tests of download.download_file against a local HTTP server.
+
+Usage:
+    python -m pytest tests
+"""
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from download import download_file, download_checksum
+
+CONTENT = bytes(range(256)) * 4096
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves CONTENT at every path, honouring single "bytes=N-" Range requests unless the server has
+    supports_range set to False. Every request's Range header is recorded in the server's ranges list.
+    """
+
+    def do_GET(self):
+        requested = self.headers.get('Range')
+        self.server.ranges.append(requested)
+        start = 0
+        if requested and self.server.supports_range:
+            start = int(requested[len('bytes='):].rstrip('-'))
+            if start >= len(CONTENT):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(CONTENT)}')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(CONTENT) - start))
+        self.end_headers()
+        self.wfile.write(CONTENT[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+class DownloadFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.ranges = []
+        self.server.supports_range = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/episode.mp3'
+        self.directory = tempfile.TemporaryDirectory()
+        self.local_file = os.path.join(self.directory.name, 'episode.mp3')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def write_partial(self, size):
+        with open(self.local_file + '.part', 'wb') as f:
+            f.write(CONTENT[:size])
+
+    def assert_downloaded(self):
+        with open(self.local_file, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertFalse(os.path.exists(self.local_file + '.part'))
+        self.assertEqual(download_checksum(self.local_file), (hashlib.sha256(CONTENT).hexdigest(), len(CONTENT)))
+
+    def test_downloads_whole_file(self):
+        self.assertEqual(download_file(self.url, self.directory.name), self.local_file)
+        self.assertEqual(self.server.ranges, [None])
+        self.assert_downloaded()
+
+    def test_resumes_partial_download_with_range_request(self):
+        self.write_partial(300000)
+        download_file(self.url, self.directory.name)
+        self.assertEqual(self.server.ranges, ['bytes=300000-'])
+        self.assert_downloaded()
+
+    def test_resumes_unverified_file_as_partial_download(self):
+        with open(self.local_file, 'wb') as f:
+            f.write(CONTENT[:1000])
+        download_file(self.url, self.directory.name)
+        self.assertEqual(self.server.ranges, ['bytes=1000-'])
+        self.assert_downloaded()
+
+    def test_complete_partial_download_is_verified(self):
+        self.write_partial(len(CONTENT))
+        download_file(self.url, self.directory.name)
+        self.assertEqual(self.server.ranges, [f'bytes={len(CONTENT)}-'])
+        self.assert_downloaded()
+
+    def test_restarts_when_server_ignores_range(self):
+        self.server.supports_range = False
+        self.write_partial(300000)
+        download_file(self.url, self.directory.name)
+        self.assertEqual(self.server.ranges, ['bytes=300000-'])
+        self.assert_downloaded()
+
+    def test_skips_verified_download(self):
+        download_file(self.url, self.directory.name)
+        download_file(self.url, self.directory.name)
+        self.assertEqual(self.server.ranges, [None])
+        self.assert_downloaded()
+
+if __name__ == '__main__':
+    unittest.main()
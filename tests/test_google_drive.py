@@ -0,0 +1,262 @@
+"""
+Tests of google_drive's uploads against a local fake of the Docs and Drive APIs.
+
+Usage:
+    python -m pytest tests
+"""
+import email
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from google.auth.credentials import AnonymousCredentials
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import google_drive
+from database import create_database
+from google_drive import GoogleUploader, configure_uploader, upload_to_google, retry_failed_uploads
+
+def _method(method_id, path, http_method, path_parameters=(), request=True):
+    return {
+        'id': method_id,
+        'path': path,
+        'httpMethod': http_method,
+        'parameters': {name: {'type': 'string', 'required': True, 'location': 'path'} for name in path_parameters},
+        'parameterOrder': list(path_parameters),
+        **({'request': {'$ref': 'Object'}} if request else {}),
+        'response': {'$ref': 'Object'},
+    }
+
+def discovery_document(root_url, api, version):
+    """
+    Returns a discovery document with the methods of the Docs or Drive API used by google_drive.
+    """
+    if api == 'docs':
+        resources = {'documents': {'methods': {
+            'create': _method('docs.documents.create', 'v1/documents', 'POST'),
+            'get': _method('docs.documents.get', 'v1/documents/{documentId}', 'GET', ['documentId'], request=False),
+            'batchUpdate': _method('docs.documents.batchUpdate', 'v1/documents/{documentId}:batchUpdate', 'POST', ['documentId']),
+        }}}
+        service_path = ''
+    else:
+        resources = {'permissions': {'methods': {
+            'create': _method('drive.permissions.create', 'files/{fileId}/permissions', 'POST', ['fileId']),
+        }}}
+        service_path = 'drive/v3/'
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': f'{api}:{version}',
+        'name': api,
+        'version': version,
+        'rootUrl': root_url,
+        'servicePath': service_path,
+        'batchPath': f'batch/{api}/{version}',
+        'parameters': {'fields': {'type': 'string', 'location': 'query'}},
+        'schemas': {'Object': {'id': 'Object', 'type': 'object'}},
+        'resources': resources,
+    }
+
+class FakeGoogleHandler(BaseHTTPRequestHandler):
+    """
+    Serves the discovery documents and keeps the documents and their permissions in the server's docs
+    and permissions dicts. A status queued with the server's fail method is returned by the next
+    requests of that kind instead of handling them.
+    """
+
+    def do_GET(self):
+        match = re.fullmatch(r'/discovery/(\w+)/(\w+)', self.path)
+        if match:
+            self.reply(200, discovery_document(self.server.root_url, *match.groups()))
+        else:
+            self.reply(*self.server.handle('GET', self.path, None))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if not self.path.startswith('/batch/'):
+            self.reply(*self.server.handle('POST', self.path, json.loads(body)))
+            return
+
+        message = email.message_from_bytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+        self.server.batches.append(len(message.get_payload()))
+        parts = []
+        for part in message.get_payload():
+            request_line, rest = part.get_payload().split('\n', 1)
+            method, path = request_line.split()[:2]
+            status, reply = self.server.handle(method, path, json.loads(rest.split('\n\n', 1)[1]))
+            parts.append(f"--END\r\nContent-Type: application/http\r\nContent-ID: <response-{part['Content-ID'][1:-1]}>\r\n\r\n"
+                         f"HTTP/1.1 {status} Status\r\nContent-Type: application/json\r\n\r\n{json.dumps(reply)}\r\n")
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/mixed; boundary=END')
+        content = (''.join(parts) + '--END--\r\n').encode()
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def reply(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeGoogleServer(ThreadingHTTPServer):
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeGoogleHandler)
+        self.root_url = f'http://127.0.0.1:{self.server_address[1]}/'
+        self.docs = {}
+        self.permissions = {}
+        self.batches = []
+        self.requests = []
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def fail(self, kind, *statuses):
+        self._failures.setdefault(kind, []).extend(statuses)
+
+    def handle(self, method, path, body):
+        path = path.split('?')[0]
+        routes = [
+            ('create', 'POST', r'/v1/documents'),
+            ('get', 'GET', r'/v1/documents/(\w+)'),
+            ('batchUpdate', 'POST', r'/v1/documents/(\w+):batchUpdate'),
+            ('permission', 'POST', r'/drive/v3/files/(\w+)/permissions'),
+        ]
+        kind, document_id = next((kind, match.groups()[0] if match.groups() else None)
+                                 for kind, route_method, pattern in routes
+                                 if route_method == method for match in [re.fullmatch(pattern, path)] if match)
+        with self._lock:
+            self.requests.append(kind)
+            if self._failures.get(kind):
+                status = self._failures[kind].pop(0)
+                return status, {'error': {'code': status, 'message': f'{kind} failed'}}
+            if document_id is not None and document_id not in self.docs:
+                return 404, {'error': {'code': 404, 'message': 'Not found'}}
+
+            if kind == 'create':
+                document_id = f'doc{len(self.docs)}'
+                self.docs[document_id] = ''
+                self.permissions[document_id] = []
+                return 200, {'documentId': document_id, 'title': body['title']}
+            if kind == 'get':
+                # Like the Docs API, the body ends with a newline and starts at index 1
+                return 200, {'body': {'content': [{'endIndex': 1}, {'endIndex': len(self.docs[document_id]) + 2}]}}
+            if kind == 'batchUpdate':
+                text = self.docs[document_id]
+                for request in body['requests']:
+                    if 'deleteContentRange' in request:
+                        content_range = request['deleteContentRange']['range']
+                        text = text[:content_range['startIndex'] - 1] + text[content_range['endIndex'] - 1:]
+                    else:
+                        index = request['insertText']['location']['index'] - 1
+                        text = text[:index] + request['insertText']['text'] + text[index:]
+                self.docs[document_id] = text
+                return 200, {}
+            # Like Drive, granting a permission the document already has returns the existing one
+            if body['type'] not in self.permissions[document_id]:
+                self.permissions[document_id].append(body['type'])
+            return 200, {'id': body['type']}
+
+class GoogleUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeGoogleServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.options = {
+            'credentials': AnonymousCredentials(),
+            'requests_per_second': 0,
+            'max_retries': 2,
+            'discovery_service_url': self.server.root_url + 'discovery/{api}/{apiVersion}',
+        }
+        self.uploader = GoogleUploader(**self.options)
+        self.backoff = mock.patch.object(GoogleUploader, '_backoff').start()
+        self.addCleanup(mock.patch.stopall)
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.database_path = os.path.join(self.directory.name, 'transcripts.db')
+        self.conn = create_database(self.database_path)
+        self.episode_id = self.conn.execute("INSERT INTO transcripts (episode_title, transcript) VALUES ('Episode', 'First transcript')").lastrowid
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def upload(self):
+        return upload_to_google(self.conn, self.episode_id, 'Episode', self.uploader)
+
+    def stored(self):
+        doc_link = self.conn.execute("SELECT doc_link FROM transcripts WHERE id = ?", (self.episode_id,)).fetchone()[0]
+        failures = self.conn.execute("SELECT COUNT(*) FROM upload_failures WHERE episode_id = ?", (self.episode_id,)).fetchone()[0]
+        return doc_link, failures
+
+    def test_creates_document_and_grants_permissions_in_one_batch(self):
+        doc_link = self.upload()
+        self.assertEqual(doc_link, 'https://docs.google.com/document/d/doc0')
+        self.assertEqual(self.server.docs, {'doc0': 'First transcript'})
+        self.assertEqual(sorted(self.server.permissions['doc0']), ['anyone', 'user'])
+        self.assertEqual(self.server.batches, [2])
+        self.assertEqual(self.stored(), (doc_link, 0))
+
+    def test_replaces_text_of_existing_document(self):
+        doc_link = self.upload()
+        self.conn.execute("UPDATE transcripts SET transcript = 'Second' WHERE id = ?", (self.episode_id,))
+        self.assertEqual(self.upload(), doc_link)
+        self.assertEqual(self.server.docs, {'doc0': 'Second'})
+        self.assertEqual(self.server.batches, [2])
+
+    def test_retries_rate_limits_and_server_errors_with_backoff(self):
+        self.server.fail('batchUpdate', 429, 503)
+        self.server.fail('permission', 500)
+        self.upload()
+        self.assertEqual(self.server.docs, {'doc0': 'First transcript'})
+        # Only the failed permission is sent again
+        self.assertEqual(self.server.batches, [2, 1])
+        self.assertEqual(self.backoff.call_count, 3)
+
+    def test_create_is_only_retried_when_rate_limited(self):
+        self.server.fail('create', 429)
+        self.upload()
+        self.assertEqual(len(self.server.docs), 1)
+
+        self.conn.execute("UPDATE transcripts SET doc_link = NULL WHERE id = ?", (self.episode_id,))
+        self.server.fail('create', 503)
+        self.assertIsNone(self.upload())
+        self.assertEqual(self.server.requests.count('create'), 3)
+        self.assertEqual(self.stored(), (None, 1))
+
+    def test_creates_new_document_when_existing_one_is_gone(self):
+        self.conn.execute("UPDATE transcripts SET doc_link = 'https://docs.google.com/document/d/deleted' WHERE id = ?", (self.episode_id,))
+        self.assertEqual(self.upload(), 'https://docs.google.com/document/d/doc0')
+        self.assertEqual(self.server.docs, {'doc0': 'First transcript'})
+        self.assertEqual(self.stored()[0], 'https://docs.google.com/document/d/doc0')
+
+    def test_failed_upload_is_recorded_and_replay_reuses_its_document(self):
+        self.server.fail('permission', 403)
+        self.assertIsNone(self.upload())
+        # The document was created before sharing it failed, so its link is kept for the replay
+        self.assertEqual(self.stored(), ('https://docs.google.com/document/d/doc0', 1))
+
+        configure_uploader(**self.options)
+        self.addCleanup(setattr, google_drive, '_uploader', None)
+        self.assertEqual(retry_failed_uploads(self.database_path, max_concurrent=1), 0)
+        self.assertEqual(self.server.docs, {'doc0': 'First transcript'})
+        self.assertEqual(sorted(self.server.permissions['doc0']), ['anyone', 'user'])
+        self.assertEqual(self.stored(), ('https://docs.google.com/document/d/doc0', 0))
+
+if __name__ == '__main__':
+    unittest.main()
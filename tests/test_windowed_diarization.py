@@ -0,0 +1,56 @@
+"""
+Tests of windowed_diarization.diarize_in_windows with canned window results.
+
+Usage:
+    python -m pytest tests
+"""
+import os
+import sys
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import windowed_diarization
+from windowed_diarization import diarize_in_windows
+
+HOST = np.array([1.0, 0.0, 0.0])
+GUEST = np.array([0.0, 1.0, 0.0])
+
+# Two windows of 120 seconds over 200 seconds of audio, whose segments are kept up to and from 105 seconds.
+# At the end of the guest's turn in the second window, the guest says a word, too little for an embedding.
+WINDOW_RESULTS = {
+    0.0: ([('A', 0.0, 50.0), ('B', 50.0, 110.0)],
+          {'A': (HOST, 30.0), 'B': (GUEST, 30.0)}),
+    90.0: ([('C', 90.0, 150.0), ('D', 150.0, 150.4), ('E', 150.6, 200.0)],
+           {'C': (GUEST, 30.0), 'D': (None, 0.4), 'E': (HOST, 30.0)}),
+}
+
+def fake_diarize_window(audio, models, bounds, max_speakers, speech_regions):
+    return WINDOW_RESULTS[bounds[0]]
+
+class DiarizeInWindowsTest(unittest.TestCase):
+
+    def diarize(self, **options):
+        audio = types.SimpleNamespace(duration=200.0)
+        with mock.patch.object(windowed_diarization, '_diarize_window', fake_diarize_window):
+            return diarize_in_windows(audio, None, 120.0, **options)
+
+    def test_links_speakers_across_windows(self):
+        segments = self.diarize()
+        self.assertEqual(segments[0], ('SPEAKER_00', 0.0, 50.0))
+        self.assertEqual(segments[-1], ('SPEAKER_00', 150.6, 200.0))
+
+    def test_short_interjection_goes_to_nearest_speaker(self):
+        for options in ({}, {'num_speakers': 2}):
+            with self.subTest(**options):
+                segments = self.diarize(**options)
+                self.assertEqual({speaker for speaker, _, _ in segments}, {'SPEAKER_00', 'SPEAKER_01'})
+                # The word touches the guest's turn, so it joins it
+                self.assertEqual(segments, [('SPEAKER_00', 0.0, 50.0), ('SPEAKER_01', 50.0, 150.4), ('SPEAKER_00', 150.6, 200.0)])
+
+if __name__ == '__main__':
+    unittest.main()
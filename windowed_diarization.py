@@ -0,0 +1,216 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from audio_buffer import diarization_input
+from audio_processing import run_diarization_pipeline
+from speech_activity import SpeechRegions
+
+# Overlap between consecutive windows, in seconds. Every window's segments are kept up to the middle of
+# its overlaps with its neighbours, where the window has heard the most context on both sides.
+WINDOW_OVERLAP = 30.0
+
+# A speaker's embedding is computed from at most this many seconds of their longest segments in a window,
+# and not at all if they speak for less than the minimum, which is too little to tell voices apart
+EMBEDDING_AUDIO = 30.0
+MIN_EMBEDDING_AUDIO = 1.0
+
+# Cosine similarity of embeddings above which a speaker of a window is linked to a speaker of the earlier windows
+LINK_THRESHOLD = 0.5
+
+class _Speaker:
+    """
+    A speaker of the whole episode, with the sum of the embeddings of the window speakers linked to it,
+    each weighted by the seconds it was computed from.
+    """
+
+    def __init__(self):
+        self.embedding_sum = None
+
+    def add(self, embedding, seconds):
+        if embedding is not None:
+            weighted = embedding * seconds
+            self.embedding_sum = weighted if self.embedding_sum is None else self.embedding_sum + weighted
+
+    def similarity(self, embedding):
+        if self.embedding_sum is None or embedding is None:
+            return -1.0
+        return float(np.dot(self.embedding_sum, embedding) / (np.linalg.norm(self.embedding_sum) + 1e-9))
+
+def window_bounds(duration, window, overlap=WINDOW_OVERLAP):
+    """
+    Splits an episode into windows of window seconds that overlap by overlap seconds.
+
+    Returns:
+        list: The (start, end, keep start, keep end) of every window in seconds, where the segments between
+            keep start and keep end are the ones kept from the window.
+    """
+    if window <= 2 * overlap:
+        raise ValueError(f'Diarization windows of {window:.0f}s are too short for an overlap of {overlap:.0f}s')
+    if duration <= window:
+        return [(0.0, duration, 0.0, duration)]
+    step = window - overlap
+    count = math.ceil((duration - overlap) / step)
+    bounds = []
+    for index in range(count):
+        start = index * step
+        keep_start = 0.0 if index == 0 else start + overlap / 2
+        keep_end = duration if index == count - 1 else start + step + overlap / 2
+        bounds.append((start, min(start + window, duration), keep_start, keep_end))
+    return bounds
+
+def _speaker_embeddings(audio, models, segments):
+    """
+    Computes an embedding of every speaker in a window from their longest segments.
+
+    Returns:
+        dict: The unit-length embedding (or None if they speak too little) and the seconds it was computed from, by speaker.
+    """
+    embeddings = {}
+    for speaker in {speaker for speaker, _, _ in segments}:
+        spans = sorted(((end - start, start, end) for label, start, end in segments if label == speaker), reverse=True)
+        chosen = []
+        seconds = 0.0
+        for length, start, end in spans:
+            if seconds >= EMBEDDING_AUDIO:
+                break
+            length = min(length, EMBEDDING_AUDIO - seconds)
+            chosen.append((start, start + length))
+            seconds += length
+        if seconds < MIN_EMBEDDING_AUDIO:
+            embeddings[speaker] = (None, seconds)
+            continue
+        embedding = np.asarray(models.speaker_embedding(diarization_input(audio, SpeechRegions(sorted(chosen), audio.sample_rate))),
+                               dtype=np.float64).reshape(-1)
+        embeddings[speaker] = (embedding / (np.linalg.norm(embedding) + 1e-9), seconds)
+    return embeddings
+
+def _diarize_window(audio, models, bounds, max_speakers, speech_regions):
+    start, end = bounds[:2]
+    regions = SpeechRegions(speech_regions.within(start, end) if speech_regions is not None else [(start, end)], audio.sample_rate)
+    if not len(regions):
+        return [], {}
+    # A window may hear fewer speakers than the episode, so the speaker count only bounds it
+    segments = run_diarization_pipeline(audio, models, max_speakers=max_speakers, speech_regions=regions)
+    return segments, _speaker_embeddings(audio, models, segments)
+
+def _link_window(speakers, embeddings):
+    """
+    Links the speakers of a window to the speakers found so far, most similar pairs first and at most one
+    window speaker per episode speaker, adding new episode speakers for the ones left over.
+
+    Returns:
+        dict: The episode speaker of every window speaker.
+    """
+    pairs = sorted(((speaker.similarity(embedding), label, index)
+                    for label, (embedding, _) in embeddings.items()
+                    for index, speaker in enumerate(speakers)), reverse=True)
+    links = {}
+    taken = set()
+    for similarity, label, index in pairs:
+        if similarity < LINK_THRESHOLD:
+            break
+        if label not in links and index not in taken:
+            links[label] = speakers[index]
+            taken.add(index)
+    for label in sorted(embeddings):
+        if label not in links:
+            links[label] = _Speaker()
+            speakers.append(links[label])
+        links[label].add(*embeddings[label])
+    return links
+
+def _merge_closest(speakers, limit):
+    """
+    Merges the most similar episode speakers until at most limit speakers with an embedding are left.
+
+    Returns:
+        dict: The speaker every merged speaker ended up in.
+    """
+    merged = {}
+    remaining = [speaker for speaker in speakers if speaker.embedding_sum is not None]
+    while len(remaining) > limit:
+        _, first, second = max((remaining[i].similarity(remaining[j].embedding_sum / np.linalg.norm(remaining[j].embedding_sum)), i, j)
+                               for i in range(len(remaining)) for j in range(i + 1, len(remaining)))
+        into, gone = remaining[first], remaining.pop(second)
+        into.embedding_sum = into.embedding_sum + gone.embedding_sum
+        merged[gone] = into
+        for speaker, target in merged.items():
+            if target is gone:
+                merged[speaker] = into
+    return merged
+
+def _assign_unembedded(kept, merged):
+    """
+    Assigns every speaker without an embedding, who spoke too little in their window to be linked or merged,
+    to the speaker with an embedding whose segments are nearest to theirs in time.
+
+    Returns:
+        dict: merged, extended with the speaker every speaker without an embedding ended up in.
+    """
+    resolved = [(merged.get(speaker, speaker), start, end) for speaker, start, end in kept]
+    embedded = [(start, end, speaker) for speaker, start, end in resolved if speaker.embedding_sum is not None]
+    if not embedded:
+        return merged
+    for speaker in {speaker for speaker, _, _ in resolved if speaker.embedding_sum is None}:
+        spans = [(start, end) for other, start, end in resolved if other is speaker]
+        # The gap between two segments, 0 if they overlap
+        nearest = min(embedded, key=lambda segment: min(max(segment[0] - end, start - segment[1], 0.0) for start, end in spans))
+        merged[speaker] = nearest[2]
+    return merged
+
+def _join_segments(segments):
+    """
+    Sorts the segments, joins the touching or overlapping segments of the same speaker and numbers the
+    speakers in the order they first speak.
+    """
+    joined = []
+    for speaker, start, end in sorted(segments, key=lambda segment: (segment[1], segment[2])):
+        if joined and joined[-1][0] is speaker and start <= joined[-1][2]:
+            joined[-1] = (speaker, joined[-1][1], max(end, joined[-1][2]))
+        else:
+            joined.append((speaker, start, end))
+    labels = {}
+    for speaker, _, _ in joined:
+        labels.setdefault(speaker, f'SPEAKER_{len(labels):02d}')
+    return [(labels[speaker], start, end) for speaker, start, end in joined]
+
+def diarize_in_windows(audio, models, window, num_speakers=None, max_speakers=None, speech_regions=None, workers=1):
+    """
+    Diarizes an episode in overlapping windows of fixed length and links the speakers of the windows by
+    the similarity of their voice embeddings, so the memory and clustering cost of the diarization
+    pipeline is that of one window however long the episode is.
+
+    The windows are linked in order: every speaker of a window is linked to the most similar speaker
+    of the earlier windows, or becomes a new speaker if none is similar enough. Speakers who spoke too
+    little in their window for an embedding are given to the speaker nearest to them in time. With
+    num_speakers or max_speakers, the most similar speakers are merged afterwards until the count fits.
+
+    Args:
+        audio (audio_buffer.EpisodeAudio): The mapped audio of the episode.
+        models (models.ModelRegistry): The registry providing the diarization pipeline and the speaker embedding model.
+        window (float): The length of the windows in seconds.
+        num_speakers (int, optional): Number of speakers in the episode (if known).
+        max_speakers (int, optional): Maximum number of speakers in the episode.
+        speech_regions (speech_activity.SpeechRegions, optional): If given, only the speech regions are diarized.
+        workers (int, optional): Number of windows diarized at once, each holding its window's audio. Defaults to 1.
+
+    Returns:
+        list: The (speaker ID, start time, end time) of every speaker segment.
+    """
+    bounds = window_bounds(audio.duration, window)
+    print(f'Diarizing {audio.duration / 60:.1f} minutes of audio in {len(bounds)} window(s) of {window / 60:.1f} minutes')
+    limit = num_speakers or max_speakers
+
+    speakers = []
+    kept = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Only the segments and embeddings of finished windows are held, not their audio
+        results = executor.map(lambda window_bounds: _diarize_window(audio, models, window_bounds, limit, speech_regions), bounds)
+        for (_, _, keep_start, keep_end), (segments, embeddings) in zip(bounds, results):
+            links = _link_window(speakers, embeddings)
+            kept.extend((links[speaker_id], max(start, keep_start), min(end, keep_end))
+                        for speaker_id, start, end in segments if end > keep_start and start < keep_end)
+
+    # Speakers without an embedding can't be linked across windows, so they'd otherwise each become a speaker of their own
+    merged = _assign_unembedded(kept, _merge_closest(speakers, limit) if limit else {})
+    return _join_segments([(merged.get(speaker, speaker), start, end) for speaker, start, end in kept])
@@ -0,0 +1,194 @@
+import sys
+from array import array
+
+# Typecodes of the packed columns, stored little-endian
+WORD_ID_TYPECODE = 'I'
+TIME_TYPECODE = 'd'
+SPEAKER_ID_TYPECODE = 'i'
+
+# Most SQLite builds allow at most 999 parameters per statement
+_MAX_PARAMETERS = 900
+
+def pack_array(typecode, values):
+    packed = array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+def unpack_array(typecode, data):
+    unpacked = array(typecode)
+    unpacked.frombytes(data)
+    if sys.byteorder == 'big':
+        unpacked.byteswap()
+    return unpacked
+
+def _chunks(values, size=_MAX_PARAMETERS):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+class EpisodeWords:
+    """
+    The words of one episode as stored in episode_words: typed arrays of word ids, start and end times
+    and speaker ids, with the word ids dictionary-encoded against the podcast's vocabulary table.
+
+    Loading an episode only creates the arrays. The vocabulary is looked up, and a word dict is built,
+    only when a word is accessed, so code that only needs the timings never allocates per-word objects.
+    """
+
+    def __init__(self, conn, word_ids, start_times, end_times, speaker_ids):
+        self._conn = conn
+        self._vocabulary = None
+        self.word_ids = word_ids
+        self.start_times = start_times
+        self.end_times = end_times
+        self.speaker_ids = speaker_ids
+
+    def __len__(self):
+        return len(self.word_ids)
+
+    def _word(self, index):
+        if self._vocabulary is None:
+            self._vocabulary = {}
+            unique_ids = list(set(self.word_ids))
+            for chunk in _chunks(unique_ids):
+                placeholders = ', '.join('?' * len(chunk))
+                self._vocabulary.update(self._conn.execute(f"SELECT id, word FROM vocabulary WHERE id IN ({placeholders})", chunk))
+        return {
+            'word': self._vocabulary[self.word_ids[index]],
+            'start': self.start_times[index],
+            'end': self.end_times[index],
+            'speaker_id': self.speaker_ids[index]
+        }
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._word(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('word index out of range')
+        return self._word(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._word(index)
+
+    def __bool__(self):
+        return len(self) > 0
+
+def _encode_words(conn, words):
+    unique_words = list({word['word'] for word in words})
+    conn.executemany("INSERT OR IGNORE INTO vocabulary (word) VALUES (?)", [(word,) for word in unique_words])
+    ids = {}
+    for chunk in _chunks(unique_words):
+        placeholders = ', '.join('?' * len(chunk))
+        ids.update((word, word_id) for word_id, word in conn.execute(f"SELECT id, word FROM vocabulary WHERE word IN ({placeholders})", chunk))
+    return [ids[word['word']] for word in words]
+
+def save_episode_words(conn, episode_id, words):
+    """
+    Stores the words of an episode in packed form, replacing any packed words already stored for it.
+    The caller is responsible for committing.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite database connection.
+        episode_id (int): The ID of the episode in the database.
+        words (list): The words with their timings and speaker IDs, in order.
+    """
+    conn.execute("""
+        INSERT OR REPLACE INTO episode_words (episode_id, word_count, word_ids, start_times, end_times, speaker_ids)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (
+        episode_id,
+        len(words),
+        pack_array(WORD_ID_TYPECODE, _encode_words(conn, words)),
+        pack_array(TIME_TYPECODE, [word['start'] for word in words]),
+        pack_array(TIME_TYPECODE, [word['end'] for word in words]),
+        pack_array(SPEAKER_ID_TYPECODE, [int(word['speaker_id']) for word in words]),
+    ))
+
+def load_episode_words(conn, episode_id):
+    """
+    Loads the packed words of an episode.
+
+    Returns:
+        EpisodeWords: The words of the episode, or None if they aren't stored in packed form.
+    """
+    row = conn.execute("SELECT word_ids, start_times, end_times, speaker_ids FROM episode_words WHERE episode_id = ?", (episode_id,)).fetchone()
+    if row is None:
+        return None
+    return EpisodeWords(
+        conn,
+        unpack_array(WORD_ID_TYPECODE, row[0]),
+        unpack_array(TIME_TYPECODE, row[1]),
+        unpack_array(TIME_TYPECODE, row[2]),
+        unpack_array(SPEAKER_ID_TYPECODE, row[3]),
+    )
+
+def load_transcription(conn, episode_id):
+    """
+    Loads the words of an episode from packed storage, falling back to the rows in transcription_results.
+
+    Returns:
+        Sequence: The words of the episode ordered by start time, as dicts with word, start, end and speaker_id.
+    """
+    packed = load_episode_words(conn, episode_id)
+    if packed is not None:
+        return packed
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT word, start_time, end_time, speaker_id
+        FROM transcription_results
+        WHERE episode_id = ?
+        ORDER BY start_time
+    """, (episode_id,))
+    return [dict(zip(["word", "start", "end", "speaker_id"], row)) for row in cursor.fetchall()]
+
+def iter_transcription(conn, episode_id):
+    """
+    Yields the words of an episode ordered by start time without loading them all into memory,
+    reading row storage straight off the cursor.
+    """
+    packed = load_episode_words(conn, episode_id)
+    if packed is not None:
+        yield from packed
+        return
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT word, start_time, end_time, speaker_id
+        FROM transcription_results
+        WHERE episode_id = ?
+        ORDER BY start_time
+    """, (episode_id,))
+    for row in cursor:
+        yield dict(zip(["word", "start", "end", "speaker_id"], row))
+
+def pack_episode_words(conn, episode_id):
+    """
+    Moves the completed transcription of an episode from transcription_results into packed storage.
+    """
+    words = load_transcription(conn, episode_id)
+    if isinstance(words, EpisodeWords) or not words:
+        return
+    with conn:
+        save_episode_words(conn, episode_id, words)
+        conn.execute("DELETE FROM transcription_results WHERE episode_id = ?", (episode_id,))
+
+def pack_all_episode_words(conn):
+    """
+    Moves every completed transcription still stored one row per word into packed storage.
+
+    Returns:
+        int: The number of episodes packed.
+    """
+    # Transcriptions stored before progress was tracked are complete too
+    episode_ids = [row[0] for row in conn.execute("""
+        SELECT DISTINCT r.episode_id
+        FROM transcription_results r
+        LEFT JOIN transcription_progress p ON p.episode_id = r.episode_id
+        WHERE p.episode_id IS NULL OR p.completed
+    """)]
+    for episode_id in episode_ids:
+        pack_episode_words(conn, episode_id)
+    conn.execute("VACUUM")
+    return len(episode_ids)
@@ -0,0 +1,94 @@
+import itertools
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from database import connect_database
+
+# Per-process state, set up once by init_worker in each pool process
+_worker_state = {}
+
+def init_worker(database_path, downloads_dir):
+    """
+    Sets up a pool process with its own database connection and model registry.
+
+    Every worker loads its own Vosk recognizer, Punctuator and diarization pipeline on first use,
+    so recognizers are never shared between processes. The connection uses WAL journaling and a
+    busy timeout, so concurrent writers wait for the lock instead of failing.
+    """
+    from models import ModelRegistry
+
+    conn = connect_database(database_path)
+
+    _worker_state['conn'] = conn
+    _worker_state['downloads_dir'] = downloads_dir
+    _worker_state['models'] = ModelRegistry()
+
+def run_episode(item_xml, options):
+    """
+    Processes one episode inside a pool process.
+
+    Args:
+        item_xml (str): The serialized <item> tag of the episode.
+        options (dict): Keyword arguments passed through to process_episode.
+
+    Returns:
+        float: The wall time spent on the episode in seconds.
+    """
+    from bs4 import BeautifulSoup
+    from audio_processing import process_episode
+
+    item = BeautifulSoup(item_xml, 'xml').find('item')
+    start_time = time.perf_counter()
+    process_episode(item, _worker_state['downloads_dir'], _worker_state['conn'], _worker_state['models'], **options)
+    return time.perf_counter() - start_time
+
+def process_episodes_in_pool(items, database_path, downloads_dir, workers, download_workers=2, **options):
+    """
+    Processes episodes on a pool of worker processes and reports progress as each one finishes.
+
+    The audio of the next episodes is downloaded in this process while the workers are busy, so a
+    worker that frees up finds the audio of its next episode in the cache.
+
+    Args:
+        items (list): The <item> tags of the episodes to process.
+        database_path (str): Path to the podcast's transcripts.db file.
+        downloads_dir (str): The audio cache directory, see audio_cache.AudioCache.
+        workers (int): Number of worker processes.
+        download_workers (int, optional): Number of downloads running ahead of the workers. Defaults to 2.
+        **options: Keyword arguments passed through to process_episode.
+
+    Returns:
+        list: The (episode title, error message) pairs of the episodes that failed.
+    """
+    from audio_cache import open_audio_cache
+
+    # Use fresh interpreters rather than forking, since torch and the model libraries don't survive fork reliably
+    context = multiprocessing.get_context('spawn')
+    failures = []
+
+    # Create and migrate the database before the workers start so they never race on the schema or the journal mode
+    connect_database(database_path).close()
+
+    prefetched = open_audio_cache(downloads_dir, options.get('cache_budget')).prefetch(
+        ((item.find('enclosure')['url'], item) for item in items), download_workers)
+    completed = 0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(database_path, downloads_dir)) as executor:
+        running = {}
+        while True:
+            # Episodes are handed out as workers free up, so the downloads only run a few episodes ahead
+            for item in itertools.islice(prefetched, workers - len(running)):
+                running[executor.submit(run_episode, str(item), options)] = item.find('title').text.strip()
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                title = running.pop(future)
+                completed += 1
+                try:
+                    elapsed = future.result()
+                    print(f"[{completed}/{len(items)}] Finished '{title}' in {elapsed:.1f}s")
+                except Exception as error:
+                    print(f"[{completed}/{len(items)}] Failed '{title}': {error!r}")
+                    failures.append((title, str(error)))
+
+    return failures